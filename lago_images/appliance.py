@@ -0,0 +1,548 @@
+"""
+Customize, sysprep and trim an image in a single libguestfs appliance
+
+Running virt-customize, virt-sysprep and virt-sparsify one after the other
+boots the appliance and inspects the guest three times. This does all of it
+in one :class:`guestfs.GuestFS` session instead.
+
+The image is attached with discard enabled, so trimming the filesystems
+frees their unused clusters in the image, as virt-sparsify --in-place does.
+If the qemu of the host can't pass the discards through, nothing is freed,
+see :attr:`ApplianceSession.trimmed`.
+
+The sysprep step runs the same default operations as virt-sysprep, see
+:data:`SYSPREP_OPERATIONS`. Only a subset of the virt-customize commands
+is supported, see :data:`COMMANDS`. Specs using any other command, or
+hosts without the libguestfs python bindings, should use the CLI tools,
+see :func:`is_supported`.
+"""
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+
+from lago import log_utils
+
+try:
+    import guestfs
+except ImportError:
+    guestfs = None
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+INSTALL_CMDS = {
+    'yum': 'yum -y install {}',
+    'dnf': 'dnf -y install {}',
+    'apt': 'DEBIAN_FRONTEND=noninteractive apt-get -y install {}',
+    'zypper': 'zypper -n install {}',
+}
+UPDATE_CMDS = {
+    'yum': 'yum -y update',
+    'dnf': 'dnf -y upgrade',
+    'apt': (
+        'apt-get -y update && '
+        'DEBIAN_FRONTEND=noninteractive apt-get -y upgrade'
+    ),
+    'zypper': 'zypper -n update',
+}
+# Network configs of the guest the sysprep step edits
+IFCFG_FILES = ('/etc/sysconfig/network-scripts/ifcfg-*', )
+# Editor backups, removed from everywhere in the guest
+BACKUP_SUFFIXES = ('.bak', '~')
+
+
+class UnsupportedCommand(Exception):
+    pass
+
+
+class ApplianceException(Exception):
+    pass
+
+
+def parse_commands(commands_file):
+    """
+    Parses a virt-builder commands file, as used by the specs
+
+    Args:
+        commands_file (str): path to the file
+
+    Returns:
+        list of tuple(str, str): command and argument of each line, with
+            the continuation lines already joined
+    """
+    commands = []
+    current = ''
+    with open(commands_file) as commands_fd:
+        for line in commands_fd:
+            line = line.rstrip('\n')
+            if not current and (
+                not line.strip() or line.lstrip().startswith('#')
+            ):
+                continue
+
+            if line.endswith('\\'):
+                current += line[:-1] + '\n'
+                continue
+
+            current += line
+            command, _, arg = current.strip().partition(' ')
+            commands.append((command, arg.strip()))
+            current = ''
+
+    return commands
+
+
+def is_supported(commands_file=None):
+    """
+    Args:
+        commands_file (str): virt-builder commands file the image will be
+            customized with, if any
+
+    Returns:
+        bool: If the image can be built in a single appliance on this host
+    """
+    if guestfs is None:
+        LOGGER.debug('libguestfs python bindings not available')
+        return False
+
+    if commands_file is None:
+        return True
+
+    for command, arg in parse_commands(commands_file):
+        if command not in COMMANDS or (
+            command == 'root-password' and not arg.startswith('password:')
+        ):
+            LOGGER.debug('%s not supported in a single appliance', command)
+            return False
+
+    return True
+
+
+class ApplianceSession(object):
+    """
+    A launched appliance with the guest os mounted
+
+    Attributes:
+        timings (OrderedDict of str: float): seconds spent on each stage
+        trimmed (bool): If trimming freed space in the image, False if it
+            was not trimmed or the discards did not reach the image
+    """
+
+    def __init__(self, image, image_format='qcow2', network=True):
+        self.image = image
+        self.image_format = image_format
+        self.network = network
+        self.timings = OrderedDict()
+        self.g = None
+        self.root = None
+        self.package_management = None
+        self.trimmed = False
+
+    def _timed(self, stage, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings[stage] = time.time() - start
+
+    def __enter__(self):
+        self._timed('launch', self._launch)
+        return self
+
+    def __exit__(self, *_):
+        if self.g is None:
+            return
+
+        try:
+            self.g.umount_all()
+            self.g.shutdown()
+        finally:
+            self.g.close()
+            self.g = None
+
+    def _launch(self):
+        self.g = guestfs.GuestFS(python_return_dict=True)
+        self.g.add_drive_opts(
+            self.image,
+            format=self.image_format,
+            readonly=False,
+            discard='besteffort',
+        )
+        self.g.set_network(self.network)
+        self.g.launch()
+
+        roots = self.g.inspect_os()
+        if len(roots) != 1:
+            raise ApplianceException(
+                'Expected one os in {}, found {}'.format(self.image, len(roots))
+            )
+        self.root = roots[0]
+        self.package_management = self.g.inspect_get_package_management(
+            self.root
+        )
+
+        mountpoints = self.g.inspect_get_mountpoints(self.root)
+        for mountpoint in sorted(mountpoints, key=len):
+            self.g.mount(mountpoints[mountpoint], mountpoint)
+
+    def sh(self, command):
+        LOGGER.debug('Running in %s: %s', self.image, command)
+        return self.g.sh(command)
+
+    def customize(self, commands):
+        """
+        Args:
+            commands (list of tuple(str, str)): parsed commands, see
+                :func:`parse_commands`
+        """
+        def _run():
+            for command, arg in commands:
+                if command not in COMMANDS:
+                    raise UnsupportedCommand(command)
+                COMMANDS[command](self, arg)
+
+        self._timed('customize', _run)
+
+    def sysprep(self, selinux_relabel=True):
+        """
+        Runs the default operations of virt-sysprep, see
+        :data:`SYSPREP_OPERATIONS`
+        """
+        def _run():
+            for operation, func in SYSPREP_OPERATIONS.items():
+                LOGGER.debug('Running sysprep operation %s', operation)
+                func(self)
+            if selinux_relabel and self.g.is_dir('/etc/selinux'):
+                self.g.touch('/.autorelabel')
+
+        self._timed('sysprep', _run)
+
+    def remove(self, *patterns):
+        for pattern in patterns:
+            for file_path in self.g.glob_expand(pattern):
+                self.g.rm_rf(file_path)
+
+    def edit_lines(self, patterns, drop):
+        """
+        Removes the lines starting with any of the drop prefixes from the
+        files matching the patterns
+        """
+        for pattern in patterns:
+            for file_path in self.g.glob_expand(pattern):
+                if not self.g.is_file(file_path):
+                    continue
+                lines = self.g.read_lines(file_path)
+                kept = [
+                    line for line in lines
+                    if not line.lstrip().startswith(drop)
+                ]
+                if len(kept) != len(lines):
+                    self.g.write(file_path, ''.join(
+                        line + '\n' for line in kept
+                    ))
+
+    def trim(self):
+        def _run():
+            self.g.sync()
+            allocated = _allocated(self.image)
+            for mountpoint in self.g.inspect_get_mountpoints(self.root):
+                try:
+                    self.g.fstrim(mountpoint)
+                except RuntimeError as e:
+                    LOGGER.debug('Failed to trim %s: %s', mountpoint, e)
+            self.g.sync()
+            freed = allocated - _allocated(self.image)
+            self.trimmed = freed > 0
+            LOGGER.debug('Trimming %s freed %d bytes', self.image, freed)
+
+        self._timed('trim', _run)
+
+
+def _allocated(image):
+    return os.stat(image).st_blocks * 512
+
+
+def _root_password(session, arg):
+    selector, _, password = arg.partition(':')
+    if selector != 'password':
+        raise UnsupportedCommand('root-password {}'.format(selector))
+    session.sh(
+        'echo {} | chpasswd'.format(_shell_quote('root:' + password))
+    )
+
+
+def _install(session, arg):
+    packages = ' '.join(_shell_quote(pkg) for pkg in arg.split(','))
+    session.sh(INSTALL_CMDS[session.package_management].format(packages))
+
+
+def _update(session, arg):
+    session.sh(UPDATE_CMDS[session.package_management])
+
+
+def _run_command(session, arg):
+    session.sh(arg)
+
+
+def _write(session, arg):
+    file_path, _, content = arg.partition(':')
+    session.g.write(file_path, content)
+
+
+def _mkdir(session, arg):
+    session.g.mkdir_p(arg)
+
+
+def _delete(session, arg):
+    session.g.rm_rf(arg)
+
+
+def _touch(session, arg):
+    session.g.touch(arg)
+
+
+def _edit(session, arg):
+    # Same as virt-customize, the perl expression runs on the host
+    file_path, _, expr = arg.partition(':')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        local_path = os.path.join(tmp_dir, 'file')
+        session.g.download(file_path, local_path)
+        subprocess.check_call(['perl', '-i', '-p', '-e', expr, local_path])
+        session.g.upload(local_path, file_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _sysprep_remove(*patterns):
+    return lambda session: session.remove(*patterns)
+
+
+def _sysprep_backup_files(session):
+    for name in session.g.find('/'):
+        file_path = '/' + name
+        if name.endswith(BACKUP_SUFFIXES) and session.g.is_file(file_path):
+            session.g.rm(file_path)
+
+
+def _sysprep_hostname(session):
+    if session.g.is_file('/etc/hostname'):
+        session.g.write('/etc/hostname', 'localhost.localdomain\n')
+
+
+def _sysprep_machine_id(session):
+    # Emptied instead of removed, the guest expects it to exist
+    if session.g.is_file('/etc/machine-id'):
+        session.g.truncate('/etc/machine-id')
+    session.remove('/var/lib/dbus/machine-id')
+
+
+def _sysprep_net_hostname(session):
+    session.edit_lines(IFCFG_FILES, drop=('HOSTNAME=', 'DHCP_HOSTNAME='))
+
+
+def _sysprep_net_hwaddr(session):
+    # The UUID ties the connection to the NIC of the original machine too
+    session.edit_lines(IFCFG_FILES, drop=('HWADDR=', 'UUID='))
+
+
+def _shell_quote(value):
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+COMMANDS = {
+    'root-password': _root_password,
+    'install': _install,
+    'update': _update,
+    'run-command': _run_command,
+    'write': _write,
+    'mkdir': _mkdir,
+    'delete': _delete,
+    'touch': _touch,
+    'edit': _edit,
+}
+
+# The operations virt-sysprep runs by default, with the same names and
+# files, minus the ones for non linux guests
+SYSPREP_OPERATIONS = OrderedDict((
+    ('abrt-data', _sysprep_remove('/var/spool/abrt/*')),
+    ('backup-files', _sysprep_backup_files),
+    ('bash-history', _sysprep_remove(
+        '/root/.bash_history',
+        '/home/*/.bash_history',
+    )),
+    ('blkid-tab', _sysprep_remove(
+        '/var/run/blkid.tab*',
+        '/etc/blkid/blkid.tab*',
+        '/etc/blkid.tab*',
+    )),
+    ('crash-data', _sysprep_remove('/var/crash/*', '/var/log/dump/*')),
+    ('cron-spool', _sysprep_remove(
+        '/var/spool/cron/*',
+        '/var/spool/at/*',
+        '/var/spool/at/.SEQ',
+        '/var/spool/at/spool/*',
+        '/var/spool/atjobs/*',
+        '/var/spool/atspool/*',
+    )),
+    ('dhcp-client-state', _sysprep_remove(
+        '/var/lib/dhclient/*',
+        '/var/lib/dhcp/*',
+        '/var/lib/NetworkManager/*.lease',
+        '/var/lib/NetworkManager/dhclient-*',
+    )),
+    ('dhcp-server-state', _sysprep_remove('/var/lib/dhcpd/*')),
+    ('dovecot-data', _sysprep_remove('/var/lib/dovecot/*')),
+    ('hostname', _sysprep_hostname),
+    ('ipa-client', _sysprep_remove(
+        '/etc/ipa/ca.crt',
+        '/etc/ipa/default.conf',
+        '/var/lib/ipa-client/sysrestore/*',
+        '/var/lib/ipa-client/pki/*',
+    )),
+    ('kerberos-data', _sysprep_remove(
+        '/var/kerberos/krb5kdc/*',
+        '/var/lib/kerberos/*',
+    )),
+    ('kerberos-hostkeys', _sysprep_remove('/etc/krb5.keytab')),
+    ('logfiles', _sysprep_remove(
+        '/root/install.log*',
+        '/root/anaconda-ks.cfg',
+        '/root/anaconda-post.log',
+        '/root/initial-setup-ks.cfg',
+        '/root/original-ks.cfg',
+        '/var/log/anaconda/*',
+        '/var/log/anaconda.*',
+        '/var/log/audit/*',
+        '/var/log/boot.log*',
+        '/var/log/btmp*',
+        '/var/log/cloud-init*.log',
+        '/var/log/cron*',
+        '/var/log/dmesg*',
+        '/var/log/dnf*',
+        '/var/log/hawkey.log*',
+        '/var/log/lastlog*',
+        '/var/log/maillog*',
+        '/var/log/mail/*',
+        '/var/log/messages*',
+        '/var/log/secure*',
+        '/var/log/spooler*',
+        '/var/log/tallylog*',
+        '/var/log/wtmp*',
+        '/var/log/yum.log*',
+        '/var/log/debug*',
+        '/var/log/syslog*',
+        '/var/log/faillog*',
+        '/var/log/firewalld*',
+        '/var/log/grubby*',
+        '/var/log/journal/*',
+        '/var/log/tuned/tuned.log',
+        '/var/log/sa/*',
+        '/var/log/httpd/*',
+        '/var/log/apache2/*',
+        '/var/log/apt/*',
+        '/var/log/dpkg.log*',
+        '/var/log/installer/*',
+        '/var/log/zypper.log*',
+        '/var/log/zypp/*',
+        '/var/log/*.log',
+        '/var/log/*/*.log',
+    )),
+    ('lvm-system-devices', _sysprep_remove(
+        '/etc/lvm/devices/system.devices',
+    )),
+    ('machine-id', _sysprep_machine_id),
+    ('mail-spool', _sysprep_remove('/var/spool/mail/*', '/var/mail/*')),
+    ('net-hostname', _sysprep_net_hostname),
+    ('net-hwaddr', _sysprep_net_hwaddr),
+    ('pacct-log', _sysprep_remove(
+        '/var/account/pacct*',
+        '/var/log/account/pacct*',
+    )),
+    ('package-manager-cache', _sysprep_remove(
+        '/var/cache/yum/*',
+        '/var/cache/dnf/*',
+        '/var/cache/apt/archives/*.deb',
+        '/var/cache/zypp/*',
+    )),
+    ('pam-data', _sysprep_remove(
+        '/var/run/console/*',
+        '/var/run/faillock/*',
+        '/var/run/sepermit/*',
+    )),
+    ('passwd-backups', _sysprep_remove(
+        '/etc/group-',
+        '/etc/gshadow-',
+        '/etc/passwd-',
+        '/etc/shadow-',
+        '/etc/subuid-',
+        '/etc/subgid-',
+    )),
+    ('puppet-data-log', _sysprep_remove(
+        '/var/log/puppet/*',
+        '/var/lib/puppet/*/*',
+    )),
+    ('rh-subscription-manager', _sysprep_remove(
+        '/etc/pki/consumer/*',
+        '/etc/pki/entitlement/*',
+    )),
+    ('rhn-systemid', _sysprep_remove(
+        '/etc/sysconfig/rhn/systemid',
+        '/etc/sysconfig/rhn/osad-auth.conf',
+    )),
+    ('rpm-db', _sysprep_remove('/var/lib/rpm/__db.*')),
+    ('samba-db-log', _sysprep_remove(
+        '/var/log/samba/*',
+        '/var/lib/samba/*/*',
+    )),
+    ('smolt-uuid', _sysprep_remove(
+        '/etc/sysconfig/hw-uuid',
+        '/etc/smolt/uuid',
+        '/etc/smolt/hw-uuid',
+    )),
+    ('ssh-hostkeys', _sysprep_remove('/etc/ssh/*_host_*')),
+    ('ssh-userdir', _sysprep_remove('/root/.ssh', '/home/*/.ssh')),
+    ('sssd-db-log', _sysprep_remove('/var/log/sssd/*', '/var/lib/sss/db/*')),
+    ('tmp-files', _sysprep_remove('/tmp/*', '/var/tmp/*')),
+    ('udev-persistent-net', _sysprep_remove(
+        '/etc/udev/rules.d/70-persistent-net.rules',
+    )),
+    ('utmp', _sysprep_remove('/var/run/utmp')),
+    ('yum-uuid', _sysprep_remove('/var/lib/yum/uuid')),
+))
+
+
+def customize_sysprep_trim(image, commands_file=None, image_format='qcow2'):
+    """
+    Customizes, syspreps and trims the given image in a single appliance
+
+    If trimming freed nothing, the discards most likely did not reach the
+    image, and it should be sparsified with virt-sparsify instead
+
+    Args:
+        image (str): Path to the image
+        commands_file (str): virt-builder commands file to customize it
+            with, if None it's not customized
+        image_format (str): format of the image
+
+    Returns:
+        tuple(OrderedDict of str: float, bool): seconds spent on each stage,
+            and if trimming freed space in the image
+    """
+    with LogTask('Customizing, sysprepping and trimming {}'.format(image)):
+        with ApplianceSession(image, image_format=image_format) as session:
+            if commands_file:
+                session.customize(parse_commands(commands_file))
+            session.sysprep()
+            session.trim()
+
+    if not session.trimmed:
+        LOGGER.warning('Trimming %s did not free any space', image)
+
+    return session.timings, session.trimmed
+
@@ -0,0 +1,336 @@
+"""
+Local store of uncompressed base images, shared by all the specs and runs
+
+Base images are stored by the sha256 of their uncompressed content, and
+each source (URL or local path) points to the object it was last resolved
+to. Before reusing an object its source is revalidated, with a conditional
+HEAD request for URLs (ETag/Last-Modified) or by size and mtime for local
+files. Images then get a reflink, hard link or copy of the object instead
+of downloading or copying the source again.
+
+Layout of the store dir::
+
+    <store_dir>/objects/<sha256>
+    <store_dir>/sources/<sha256 of the source>.json
+    <store_dir>/sources/<sha256 of the source>.lock
+    <store_dir>/objects.lock
+    <store_dir>/tmp/
+
+Each source is populated holding an exclusive lock on its lock file, and
+objects are moved in place by rename, so concurrent builds never see or
+download half populated images. Objects are resolved and cloned holding a
+shared lock on the objects lock file, and only evicted holding an exclusive
+one, so they are never removed while a build is about to clone them.
+"""
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import requests
+
+from lago import log_utils
+
+import build_utils
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+DEFAULT_STORE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'lago-images', 'bases'
+)
+# In GiB
+DEFAULT_STORE_SIZE = 50
+
+
+class SourceRecord(object):
+    """
+    What a source was resolved to, and how to tell if it changed since
+    """
+
+    def __init__(
+        self,
+        src,
+        digest,
+        etag=None,
+        last_modified=None,
+        size=None,
+        mtime=None,
+    ):
+        self.src = src
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.mtime = mtime
+
+    @classmethod
+    def load(cls, record_path):
+        try:
+            with open(record_path) as record_fd:
+                return cls(**json.load(record_fd))
+        except (IOError, OSError, ValueError, TypeError):
+            return None
+
+    def dump(self, record_path):
+        tmp_path = record_path + '.tmp'
+        with open(tmp_path, 'w') as record_fd:
+            json.dump(self.__dict__, record_fd)
+        os.rename(tmp_path, record_path)
+
+
+def _local_validators(src):
+    stat = os.stat(src)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class BaseImageStore(object):
+    def __init__(self, store_dir=DEFAULT_STORE_DIR, max_size=None):
+        """
+        Args:
+            store_dir (str): Path to keep the store in
+            max_size (int): Max size of the store in bytes, the least
+                recently used objects are evicted when it's exceeded
+        """
+        self.store_dir = store_dir
+        self.max_size = max_size
+        self.objects_dir = os.path.join(store_dir, 'objects')
+        self.sources_dir = os.path.join(store_dir, 'sources')
+        self.tmp_dir = os.path.join(store_dir, 'tmp')
+        for dir_path in (self.objects_dir, self.sources_dir, self.tmp_dir):
+            if not os.path.isdir(dir_path):
+                try:
+                    os.makedirs(dir_path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def _source_key(self, src):
+        return hashlib.sha256(src.encode('utf-8')).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    @contextmanager
+    def _locked(self, key):
+        lock_path = os.path.join(self.sources_dir, key + '.lock')
+        with open(lock_path, 'a') as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _objects_locked(self, operation):
+        """
+        Yields:
+            bool: If the lock was taken, it's only False for non blocking
+                operations
+        """
+        lock_path = os.path.join(self.store_dir, 'objects.lock')
+        with open(lock_path, 'a') as lock_fd:
+            try:
+                fcntl.flock(lock_fd, operation)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def _is_fresh(self, record):
+        if not os.path.isfile(self._object_path(record.digest)):
+            return False
+
+        if not build_utils.is_url(record.src):
+            return _local_validators(record.src) == {
+                'size': record.size,
+                'mtime': record.mtime,
+            }
+
+        if not record.etag and not record.last_modified:
+            return False
+
+        headers = {}
+        if record.etag:
+            headers['If-None-Match'] = record.etag
+        if record.last_modified:
+            headers['If-Modified-Since'] = record.last_modified
+
+        r = requests.head(record.src, headers=headers, allow_redirects=True)
+        if r.status_code == 304:
+            return True
+
+        r.raise_for_status()
+        return (
+            r.headers.get('ETag') == record.etag
+            and r.headers.get('Last-Modified') == record.last_modified
+        )
+
+    def _populate(self, src):
+        validators = {}
+        if build_utils.is_url(src):
+            r = requests.head(src, allow_redirects=True)
+            r.raise_for_status()
+            validators['etag'] = r.headers.get('ETag')
+            validators['last_modified'] = r.headers.get('Last-Modified')
+        else:
+            validators = _local_validators(src)
+
+        tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            tmp_path, hashes = build_utils.stream_uncompressed_file(
+                src,
+                os.path.join(tmp_dir, 'image'),
+                checksums=['sha256'],
+            )
+            if hashes is None:
+                digest = build_utils.get_hash(tmp_path, checksum='sha256')
+            else:
+                digest = hashes['sha256']
+
+            object_path = self._object_path(digest)
+            if not os.path.isfile(object_path):
+                os.rename(tmp_path, object_path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return SourceRecord(src=src, digest=digest, **validators)
+
+    def is_stored(self, src):
+        """
+        Args:
+            src (str): URL or path of the, possibly compressed, base image
+
+        Returns:
+            bool: If the store has an up to date copy of src, so getting it
+                does not download or copy it again
+        """
+        record = SourceRecord.load(
+            os.path.join(self.sources_dir, self._source_key(src) + '.json')
+        )
+        return record is not None and self._is_fresh(record)
+
+    def get(self, src):
+        """
+        Makes sure the given source is in the store and up to date
+
+        Args:
+            src (str): URL or path of the, possibly compressed, base image
+
+        Returns:
+            str: Path to the uncompressed base image in the store, it must
+                not be modified, and it might be evicted by the next
+                eviction, see :func:`clone`
+        """
+        with self._objects_locked(fcntl.LOCK_SH):
+            object_path = self._resolve(src)
+
+        self.evict(keep=object_path)
+        return object_path
+
+    def _resolve(self, src):
+        # Called holding the objects lock
+        key = self._source_key(src)
+        record_path = os.path.join(self.sources_dir, key + '.json')
+        with self._locked(key):
+            record = SourceRecord.load(record_path)
+            if record is not None and self._is_fresh(record):
+                LOGGER.debug('Using stored %s for %s', record.digest, src)
+            else:
+                with LogTask('Adding {} to the base image store'.format(src)):
+                    record = self._populate(src)
+                    record.dump(record_path)
+
+            object_path = self._object_path(record.digest)
+            # The mtime of the objects tracks when they were last used
+            os.utime(object_path, None)
+
+        return object_path
+
+    def clone(self, src, dst, writable=True):
+        """
+        Places the uncompressed base image of src at dst
+
+        Args:
+            src (str): URL or path of the, possibly compressed, base image
+            dst (str): Path to put it at, if it's a dir the file name is
+                taken from src, without its compression extension
+            writable (bool): If the image at dst will be modified, if not it
+                can be hard linked to the stored one
+
+        Returns:
+            str: Path to the image
+        """
+        if os.path.isdir(dst):
+            if build_utils.is_url(src):
+                name = build_utils.filename_from_url(src)
+            else:
+                name = os.path.basename(src)
+            dst = os.path.join(dst, build_utils.strip_compression_ext(name))
+
+        with self._objects_locked(fcntl.LOCK_SH):
+            object_path = self._resolve(src)
+            build_utils.clone_file(object_path, dst, writable=writable)
+
+        self.evict(keep=object_path)
+        return dst
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used objects until the store fits in its
+        max size. It's skipped if other builds are getting or cloning
+        objects, the next eviction catches up
+
+        Args:
+            keep (str): Path of an object that must not be evicted
+        """
+        if self.max_size is None:
+            return
+
+        with self._objects_locked(fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if not locked:
+                LOGGER.debug('Base image store in use, not evicting')
+                return
+            self._evict(keep)
+
+    def _evict(self, keep):
+        objects = []
+        for name in os.listdir(self.objects_dir):
+            object_path = os.path.join(self.objects_dir, name)
+            try:
+                stat = os.stat(object_path)
+            except OSError:
+                continue
+            objects.append((stat.st_mtime, stat.st_blocks * 512, object_path))
+
+        objects.sort()
+        total = sum(size for _, size, _ in objects)
+        for mtime, size, object_path in objects:
+            if total <= self.max_size:
+                break
+            if object_path == keep:
+                continue
+
+            LOGGER.info(
+                'Evicting %s from the base image store, last used %s',
+                os.path.basename(object_path),
+                time.ctime(mtime),
+            )
+            try:
+                os.unlink(object_path)
+            except OSError:
+                continue
+            total -= size
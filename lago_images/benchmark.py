@@ -0,0 +1,1056 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the image build primitives, run them on the same host and
+image to compare the results
+
+Compression::
+
+    ./lago_images/benchmark.py compression my-image.qcow2
+
+Compresses and decompresses the image with each of the xz, zstd and gzip
+levels, as a single stream and by blocks (see :mod:`seekable`), and reports
+the compression ratio and throughput of each.
+
+Pipeline::
+
+    ./lago_images/benchmark.py --json results.json pipeline --size 1G
+
+Generates synthetic images, sparse and dense, raw or qcow2 (with
+``qemu-img``), and times the build utils the pipeline runs on each of them:
+hashing, xz and gzip compression and decompression, copying and
+downloading from a local HTTP server.
+
+Createrepo::
+
+    ./lago_images/benchmark.py createrepo --files 5000
+
+Generates that many synthetic image .metadata files and times generating
+the repo metadata from them, from scratch and incrementally.
+
+The json results include the commit, host and parameters of the run, to
+compare the runs of two commits::
+
+    ./lago_images/benchmark.py compare old.json new.json
+
+which fails if any case got slower than the threshold.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from future.moves.http.server import HTTPServer, SimpleHTTPRequestHandler
+from future.moves.socketserver import ThreadingMixIn
+from future.moves.urllib.parse import urlparse
+
+import build_utils
+import compression
+import createrepo
+import download
+import seekable
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_XZ_LEVELS = '1,6,9'
+DEFAULT_ZSTD_LEVELS = '1,3,9,19'
+DEFAULT_GZIP_LEVELS = '6'
+
+DEFAULT_IMAGE_SIZE = '256M'
+DEFAULT_IMAGE_KINDS = 'sparse,dense'
+DEFAULT_IMAGE_FORMATS = 'raw'
+# Fraction of the blocks of the sparse images that hold data
+DEFAULT_DATA_RATIO = 0.25
+IMAGE_BLOCK_SIZE = 1024 * 1024
+DEFAULT_REPEAT = 3
+DEFAULT_METADATA_FILES = 5000
+DEFAULT_TEMPLATES = 50
+# Relative slowdown over which compare reports a regression
+DEFAULT_THRESHOLD = 0.1
+# Cases faster than this are too noisy to compare
+DEFAULT_MIN_SECONDS = 0.05
+
+RANGE_REGEX = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class CompressionCase(object):
+    def __init__(self, name, compress_cmd, decompress_cmd, by_blocks=False):
+        self.name = name
+        self.compress_cmd = compress_cmd
+        self.decompress_cmd = decompress_cmd
+        self.by_blocks = by_blocks
+
+
+def compression_cases(codec_levels, block_size):
+    """
+    Args:
+        codec_levels (dict of str: list of int): levels to benchmark of each
+            codec
+        block_size (int): Uncompressed size of each block, for the cases
+            compressed by blocks
+
+    Returns:
+        list of CompressionCase: each level of each codec, as a single
+            stream and by blocks
+    """
+    cases = []
+    for name, levels in codec_levels.items():
+        codec = compression.get_codec(name)
+        for level in levels:
+            cases.append(
+                CompressionCase(
+                    '{}-{}'.format(name, level),
+                    codec.compress_cmd(level),
+                    codec.decompress_cmd(),
+                )
+            )
+            cases.append(
+                CompressionCase(
+                    '{}-{}-blocks'.format(name, level),
+                    codec.block_compressor(block_size, level),
+                    codec.decompress_cmd(threads=1),
+                    by_blocks=True,
+                )
+            )
+
+    return cases
+
+
+def _timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def _decompress_stream(cmd, src, dst):
+    with open(src, 'rb') as src_fd, open(dst, 'wb') as dst_fd:
+        subprocess.check_call(cmd, stdin=src_fd, stdout=dst_fd)
+
+
+def _mib_per_sec(size, secs):
+    return size / (1024.0 * 1024.0) / secs if secs else None
+
+
+def bench_compression(image, cases, block_size, work_dir=None):
+    """
+    Args:
+        image (str): Path to the image to benchmark with
+        cases (list of CompressionCase): compressions to benchmark
+        block_size (int): Uncompressed size of each block, for the cases
+            compressed by blocks
+        work_dir (str): Dir to write the compressed and decompressed files
+            to, a temporary one is used by default
+
+    Returns:
+        list of dict: results of each case
+    """
+    size = os.stat(image).st_size
+    work_dir = tempfile.mkdtemp(dir=work_dir)
+    results = []
+    try:
+        for case in cases:
+            compressed = os.path.join(work_dir, case.name)
+            decompressed = compressed + '.out'
+            if case.by_blocks:
+                (_, _, index), compress_secs = _timed(
+                    seekable.compress_file,
+                    image,
+                    compressed,
+                    compress_cmd=case.compress_cmd,
+                    block_size=block_size,
+                )
+                _, decompress_secs = _timed(
+                    seekable.decompress_file,
+                    compressed,
+                    decompressed,
+                    index=index,
+                    block_size=block_size,
+                    decompress_cmd=case.decompress_cmd,
+                )
+            else:
+                _, compress_secs = _timed(
+                    build_utils.compress_and_hash,
+                    image,
+                    compressed,
+                    compress_cmd=case.compress_cmd,
+                    checksums=(),
+                    compressed_checksums=(),
+                )
+                _, decompress_secs = _timed(
+                    _decompress_stream,
+                    case.decompress_cmd,
+                    compressed,
+                    decompressed,
+                )
+
+            compressed_size = os.stat(compressed).st_size
+            results.append({
+                'case': case.name,
+                'size': size,
+                'compressed_size': compressed_size,
+                'ratio': float(size) / compressed_size,
+                'compress_seconds': compress_secs,
+                'compress_mib_per_sec': _mib_per_sec(size, compress_secs),
+                'decompress_seconds': decompress_secs,
+                'decompress_mib_per_sec': _mib_per_sec(
+                    size, decompress_secs
+                ),
+            })
+            LOGGER.info('%s: %r', case.name, results[-1])
+            os.unlink(compressed)
+            os.unlink(decompressed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def format_results(results):
+    lines = [
+        '{:<20} {:>8} {:>14} {:>16}'.format(
+            'case', 'ratio', 'compress MiB/s', 'decompress MiB/s'
+        )
+    ]
+    for result in results:
+        lines.append(
+            '{:<20} {:>8.2f} {:>14.1f} {:>16.1f}'.format(
+                result['case'],
+                result['ratio'],
+                result['compress_mib_per_sec'] or 0,
+                result['decompress_mib_per_sec'] or 0,
+            )
+        )
+
+    return '\n'.join(lines)
+
+
+def _synthetic_block(seed, index, size=IMAGE_BLOCK_SIZE):
+    """
+    Returns:
+        bytes: a block of roughly the makeup of an OS image, a quarter of
+            incompressible data, like binaries and compressed files, half
+            text and a quarter of zeros, different for each index
+    """
+    random_size = size // 4
+    random_data = b''.join(
+        hashlib.sha512(
+            '{}-{}-{}'.format(seed, index, counter).encode('utf-8')
+        ).digest()
+        for counter in range(random_size // 64 + 1)
+    )[:random_size]
+    text_size = size // 2
+    line = 'lago-images synthetic block {} of seed {}\n'.format(
+        index, seed
+    ).encode('utf-8')
+    text = (line * (text_size // len(line) + 1))[:text_size]
+    return random_data + text + b'\0' * (size - random_size - text_size)
+
+
+def _is_data_block(index, data_ratio):
+    # Spreads the data blocks evenly over the image
+    return int((index + 1) * data_ratio) > int(index * data_ratio)
+
+
+def make_image(
+    path,
+    size,
+    sparse=False,
+    data_ratio=DEFAULT_DATA_RATIO,
+    image_format='raw',
+    seed=0,
+):
+    """
+    Writes a synthetic image, the same for the same arguments
+
+    Args:
+        path (str): Path to write the image to
+        size (int): Virtual size of the image in bytes
+        sparse (bool): If only data_ratio of its blocks should hold data,
+            the rest being holes
+        data_ratio (float): Fraction of the blocks with data of the sparse
+            images
+        image_format (one of raw, qcow2): qcow2 images are converted from a
+            raw one with ``qemu-img``
+        seed (int): Seed of the data of the image
+
+    Returns:
+        str: path
+    """
+    raw_path = path if image_format == 'raw' else path + '.raw'
+    with open(raw_path, 'wb') as image_fd:
+        for index in range(
+            (size + IMAGE_BLOCK_SIZE - 1) // IMAGE_BLOCK_SIZE
+        ):
+            if sparse and not _is_data_block(index, data_ratio):
+                continue
+            offset = index * IMAGE_BLOCK_SIZE
+            image_fd.seek(offset)
+            image_fd.write(
+                _synthetic_block(
+                    seed, index, min(IMAGE_BLOCK_SIZE, size - offset)
+                )
+            )
+        image_fd.truncate(size)
+
+    if image_format != 'raw':
+        try:
+            build_utils.run_command_with_validation(
+                [
+                    'qemu-img', 'convert', '-f', 'raw', '-O', image_format,
+                    raw_path, path
+                ],
+                msg='Failed to convert {} to {}'.format(path, image_format),
+            )
+        finally:
+            os.unlink(raw_path)
+
+    return path
+
+
+def _allocated(file_path):
+    return os.stat(file_path).st_blocks * 512
+
+
+class PipelineCase(object):
+    def __init__(self, name, run, setup=None):
+        """
+        Args:
+            name (str): Name of the case
+            run (callable): Timed part of the case, called with the output
+                of setup, or the image
+            setup (callable): Untimed preparation of each repetition,
+                called with the image and a scratch dir
+        """
+        self.name = name
+        self.run = run
+        self.setup = setup
+
+
+def _copy_to(image, scratch_dir):
+    dst = os.path.join(scratch_dir, os.path.basename(image))
+    build_utils.cp(image, dst, allow_reflink=False)
+    return dst
+
+
+def _xz_compressed(image, scratch_dir, block_size):
+    src = _copy_to(image, scratch_dir)
+    build_utils.xz_compress_and_hash(src, block_size)
+    os.unlink(src)
+    return src + '.xz'
+
+
+def _gzip_compressed(image, scratch_dir):
+    src = _copy_to(image, scratch_dir)
+    build_utils.gzip_compress(src)
+    return src + '.gz'
+
+
+def pipeline_cases(block_size, base_url=None, segments=None):
+    """
+    Args:
+        block_size (int): xz block size, as used for the images
+        base_url (str): URL the dir of the images is served on, if None
+            the downloads are not benchmarked
+        segments (int): Concurrent range requests of the segmented
+            download
+
+    Returns:
+        list of PipelineCase: the build utils cases
+    """
+    def _dst(scratch_dir):
+        return os.path.join(scratch_dir, 'copy')
+
+    def _url(image):
+        return '{}/{}'.format(base_url, os.path.basename(image))
+
+    cases = [
+        PipelineCase(
+            'get_hash',
+            lambda image: build_utils.get_hash(image, 'sha1'),
+        ),
+        PipelineCase(
+            'get_hashes',
+            lambda image: build_utils.get_hashes(image, ['sha1', 'sha512']),
+        ),
+        PipelineCase(
+            'cp',
+            lambda args: build_utils.cp(*args),
+            setup=lambda image, scratch_dir: (image, _dst(scratch_dir)),
+        ),
+        PipelineCase(
+            'cp-no-reflink',
+            lambda args: build_utils.cp(*args, allow_reflink=False),
+            setup=lambda image, scratch_dir: (image, _dst(scratch_dir)),
+        ),
+        PipelineCase(
+            'xz_compress',
+            lambda src: build_utils.xz_compress(src, block_size),
+            setup=_copy_to,
+        ),
+        PipelineCase(
+            'xz_compress_and_hash',
+            lambda src: build_utils.xz_compress_and_hash(src, block_size),
+            setup=_copy_to,
+        ),
+        PipelineCase(
+            'xz_decompress',
+            build_utils.xz_decompress,
+            setup=lambda image, scratch_dir: _xz_compressed(
+                image, scratch_dir, block_size
+            ),
+        ),
+        PipelineCase(
+            'gzip_compress',
+            build_utils.gzip_compress,
+            setup=_copy_to,
+        ),
+        PipelineCase(
+            'gzip_decompress',
+            build_utils.gzip_decompress,
+            setup=_gzip_compressed,
+        ),
+    ]
+    if base_url is not None:
+        segments = segments or download.DEFAULT_SEGMENTS
+        for name, case_segments in (
+            ('download_from_url', segments),
+            ('download_from_url-1-segment', 1),
+        ):
+            cases.append(
+                PipelineCase(
+                    name,
+                    lambda args, case_segments=case_segments: (
+                        build_utils.download_from_url(
+                            *args,
+                            force=True,
+                            segments=case_segments
+                        )
+                    ),
+                    setup=lambda image, scratch_dir: (
+                        _url(image), _dst(scratch_dir)
+                    ),
+                )
+            )
+
+    return cases
+
+
+def _repeat(run, setup, repeat, work_dir):
+    """
+    Returns:
+        list of float: seconds of each repetition of run, each one with
+            the output of setup on an empty scratch dir
+    """
+    times = []
+    for _ in range(repeat):
+        scratch_dir = tempfile.mkdtemp(dir=work_dir)
+        try:
+            arg = setup(scratch_dir)
+            times.append(_timed(run, arg)[1])
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return times
+
+
+def _result(case, image_name, times, size=None, **extra):
+    result = {
+        'case': case,
+        'image': image_name,
+        'size': size,
+        # The best of the repetitions, the least noisy to compare
+        'seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        'mib_per_sec': _mib_per_sec(size, min(times)) if size else None,
+    }
+    result.update(extra)
+    LOGGER.info('%s: %r', case, result)
+    return result
+
+
+def bench_pipeline(images, cases, repeat=DEFAULT_REPEAT, work_dir=None):
+    """
+    Args:
+        images (dict of str: str): paths of the images to benchmark with,
+            by name
+        cases (list of PipelineCase): cases to run on each image
+        repeat (int): Number of times to run each case
+        work_dir (str): Dir for the scratch files, $TMPDIR by default
+
+    Returns:
+        list of dict: results of each case on each image
+    """
+    results = []
+    for image_name, image in images.items():
+        size = os.stat(image).st_size
+        for case in cases:
+            setup = case.setup or (lambda image, scratch_dir: image)
+            times = _repeat(
+                case.run,
+                lambda scratch_dir: setup(image, scratch_dir),
+                repeat,
+                work_dir,
+            )
+            results.append(
+                _result(
+                    case.name,
+                    image_name,
+                    times,
+                    size=size,
+                    allocated=_allocated(image),
+                )
+            )
+
+    return results
+
+
+class _RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves the files of the server root dir, with single byte ranges
+    support for the segmented downloads
+    """
+
+    def translate_path(self, path):
+        return os.path.join(
+            self.server.root_dir,
+            os.path.basename(urlparse(path).path),
+        )
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        SimpleHTTPRequestHandler.end_headers(self)
+
+    def send_head(self):
+        self.range_size = None
+        match = RANGE_REGEX.match(self.headers.get('Range') or '')
+        if not match:
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        try:
+            src_fd = open(self.translate_path(self.path), 'rb')
+        except IOError:
+            self.send_error(404, 'File not found')
+            return None
+
+        size = os.fstat(src_fd.fileno()).st_size
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        src_fd.seek(start)
+        self.range_size = end - start + 1
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header(
+            'Content-Range', 'bytes {}-{}/{}'.format(start, end, size)
+        )
+        self.send_header('Content-Length', str(self.range_size))
+        self.end_headers()
+        return src_fd
+
+    def copyfile(self, src_fd, dst_fd):
+        if self.range_size is None:
+            return SimpleHTTPRequestHandler.copyfile(self, src_fd, dst_fd)
+
+        remaining = self.range_size
+        while remaining:
+            chunk = src_fd.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            dst_fd.write(chunk)
+            remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def serve_dir(root_dir):
+    """
+    Serves the files of root_dir over HTTP on a random local port
+
+    Yields:
+        str: base URL of the dir
+    """
+    server = _HTTPServer(('127.0.0.1', 0), _RangeRequestHandler)
+    server.root_dir = root_dir
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_metadata_files(
+    repo_dir, count, templates=DEFAULT_TEMPLATES, first_index=0
+):
+    """
+    Writes count synthetic image .metadata files to repo_dir, versions of
+    the given number of templates, each one with a delta over the previous
+    version of its template
+
+    Returns:
+        None
+    """
+    for index in range(first_index, first_index + count):
+        template = 'template-{}'.format(index % templates)
+        version = index // templates
+        metadata = {
+            'name': template,
+            'version': str(version),
+            'timestamp': 1500000000 + index,
+            'distro': 'el7',
+            'size': 10 * 1024 * 1024 * 1024,
+            'compressed_size': 1024 * 1024 * 1024,
+            'sha1': hashlib.sha1(str(index).encode('utf-8')).hexdigest(),
+        }
+        if version:
+            metadata.update({
+                'delta_base': createrepo.version_handle(
+                    template, version - 1
+                ),
+                'delta_base_version': str(version - 1),
+                'delta_compressed_size': 64 * 1024 * 1024,
+                'delta_compressed_sha1': metadata['sha1'],
+            })
+
+        handle = createrepo.version_handle(template, version)
+        with open(
+            os.path.join(repo_dir, handle + '.metadata'), 'w'
+        ) as metadata_fd:
+            json.dump(metadata, metadata_fd)
+
+
+def bench_createrepo(count, repeat=DEFAULT_REPEAT, work_dir=None):
+    """
+    Times :func:`createrepo.create_repo_from_metadata` on a repo with count
+    synthetic metadata files, parsing all of them, none of them and only
+    the one of a newly published version
+
+    Args:
+        count (int): Number of metadata files in the repo
+        repeat (int): Number of times to run each case
+        work_dir (str): Dir to create the repo in, $TMPDIR by default
+
+    Returns:
+        list of dict: results of each case
+    """
+    repo_dir = tempfile.mkdtemp(dir=work_dir)
+    new_versions = [count]
+
+    def _new_version(_):
+        make_metadata_files(repo_dir, 1, first_index=new_versions[0])
+        new_versions[0] += 1
+
+    cases = (
+        ('create_repo_from_metadata-full', True, lambda _: None),
+        ('create_repo_from_metadata-incremental', False, lambda _: None),
+        ('create_repo_from_metadata-new-version', False, _new_version),
+    )
+    results = []
+    try:
+        make_metadata_files(repo_dir, count)
+        for name, full_rescan, setup in cases:
+            times = _repeat(
+                lambda _, full_rescan=full_rescan: (
+                    createrepo.create_repo_from_metadata(
+                        repo_dir,
+                        'benchmark',
+                        'http://localhost/benchmark',
+                        full_rescan=full_rescan,
+                    )
+                ),
+                setup,
+                repeat,
+                work_dir,
+            )
+            results.append(_result(name, None, times, files=count))
+    finally:
+        shutil.rmtree(repo_dir, ignore_errors=True)
+
+    return results
+
+
+def format_timings(results):
+    lines = [
+        '{:<40} {:>10} {:>10} {:>8}'.format(
+            'case', 'seconds', 'mean', 'MiB/s'
+        )
+    ]
+    for result in results:
+        lines.append(
+            '{:<40} {:>10.3f} {:>10.3f} {:>8}'.format(
+                _result_key(result),
+                result['seconds'],
+                result['mean_seconds'],
+                '{:.1f}'.format(result['mib_per_sec'])
+                if result['mib_per_sec'] else '-',
+            )
+        )
+
+    return '\n'.join(lines)
+
+
+def _git_commit():
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=src_dir
+        ).decode('utf-8').strip()
+        dirty = subprocess.call(
+            ['git', 'diff', '--quiet', 'HEAD'], cwd=src_dir
+        ) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_info(benchmark, params):
+    """
+    Returns:
+        dict: what is needed to tell if two runs are comparable, the
+            commit, host and parameters of the run
+    """
+    return {
+        'benchmark': benchmark,
+        'commit': _git_commit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'timestamp': time.time(),
+        'params': params,
+    }
+
+
+def _result_key(result):
+    if result.get('image'):
+        return '{}:{}'.format(result['image'], result['case'])
+    return result['case']
+
+
+def _load_results(json_path):
+    with open(json_path) as json_fd:
+        run = json.load(json_fd)
+
+    # Results written before they had the run info
+    if isinstance(run, list):
+        return {}, run
+    return run['info'], run['results']
+
+
+def compare_results(
+    old_results,
+    new_results,
+    threshold=DEFAULT_THRESHOLD,
+    min_seconds=DEFAULT_MIN_SECONDS,
+):
+    """
+    Compares every timing (the ``seconds`` and ``*_seconds`` fields, except
+    the means) of the cases in both runs
+
+    Returns:
+        list of tuple(str, float, float, bool): key, old and new seconds of
+            each timing and if it's a regression, slower by more than
+            threshold and than min_seconds
+    """
+    old_by_key = dict((_result_key(result), result) for result in old_results)
+    comparison = []
+    for result in new_results:
+        key = _result_key(result)
+        old_result = old_by_key.get(key)
+        if old_result is None:
+            continue
+
+        for field in sorted(result):
+            if not field.endswith('seconds') or field.startswith('mean'):
+                continue
+            old, new = old_result.get(field), result[field]
+            if old is None or new is None:
+                continue
+            regression = (
+                max(old, new) >= min_seconds and new > old * (1 + threshold)
+            )
+            name = key if field == 'seconds' else '{}:{}'.format(
+                key, field[:-len('_seconds')]
+            )
+            comparison.append((name, old, new, regression))
+
+    return comparison
+
+
+def format_comparison(comparison):
+    lines = [
+        '{:<48} {:>10} {:>10} {:>8}'.format('case', 'old', 'new', 'change')
+    ]
+    for name, old, new, regression in comparison:
+        lines.append(
+            '{:<48} {:>10.3f} {:>10.3f} {:>+7.1f}%{}'.format(
+                name,
+                old,
+                new,
+                (new - old) * 100.0 / old if old else 0,
+                '  REGRESSION' if regression else '',
+            )
+        )
+
+    return '\n'.join(lines)
+
+
+def _levels(value):
+    return [int(level) for level in value.split(',') if level]
+
+
+def _size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1:].upper()])
+    return int(value)
+
+
+def _names(value):
+    return [name for name in value.split(',') if name]
+
+
+def _synthetic_images(images_dir, size, kinds, image_formats, data_ratio):
+    images = OrderedDict()
+    for image_format in image_formats:
+        for kind in kinds:
+            name = '{}-{}'.format(image_format, kind)
+            LOGGER.info('Generating %s image', name)
+            images[name] = make_image(
+                os.path.join(images_dir, name),
+                size,
+                sparse=kind == 'sparse',
+                data_ratio=data_ratio,
+                image_format=image_format,
+            )
+
+    return images
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-l',
+        '--loglevel',
+        choices=['info', 'debug', 'error', 'warning'],
+        default='warning',
+        help='Log level to use'
+    )
+    parser.add_argument(
+        '--json',
+        help='Also write the results to this file, as json'
+    )
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    compression_parser = subparsers.add_parser(
+        'compression',
+        help='Compression ratio and throughput of xz, zstd and gzip',
+    )
+    compression_parser.add_argument('image', help='Image to benchmark with')
+    compression_parser.add_argument(
+        '--xz-levels', type=_levels, default=_levels(DEFAULT_XZ_LEVELS),
+        help='Comma separated xz levels, default=%s' % DEFAULT_XZ_LEVELS
+    )
+    compression_parser.add_argument(
+        '--zstd-levels', type=_levels, default=_levels(DEFAULT_ZSTD_LEVELS),
+        help='Comma separated zstd levels, default=%s' % DEFAULT_ZSTD_LEVELS
+    )
+    compression_parser.add_argument(
+        '--gzip-levels', type=_levels, default=_levels(DEFAULT_GZIP_LEVELS),
+        help='Comma separated gzip levels, default=%s' % DEFAULT_GZIP_LEVELS
+    )
+    compression_parser.add_argument(
+        '--block-size', type=int, default=seekable.DEFAULT_BLOCK_SIZE,
+        help='Block size in bytes, default=%(default)s'
+    )
+    compression_parser.add_argument(
+        '--work-dir',
+        help='Dir to write the temporary files to, default is $TMPDIR'
+    )
+
+    pipeline_parser = subparsers.add_parser(
+        'pipeline',
+        help='Build utils on synthetic images',
+    )
+    pipeline_parser.add_argument(
+        '--size', type=_size, default=_size(DEFAULT_IMAGE_SIZE),
+        help='Size of the images, with K, M or G suffix, default=%s' %
+        DEFAULT_IMAGE_SIZE
+    )
+    pipeline_parser.add_argument(
+        '--kinds', type=_names, default=_names(DEFAULT_IMAGE_KINDS),
+        help='Comma separated kinds of images, sparse or dense, default=%s' %
+        DEFAULT_IMAGE_KINDS
+    )
+    pipeline_parser.add_argument(
+        '--formats', type=_names, default=_names(DEFAULT_IMAGE_FORMATS),
+        help='Comma separated formats of the images, raw or qcow2, which '
+        'requires qemu-img, default=%s' % DEFAULT_IMAGE_FORMATS
+    )
+    pipeline_parser.add_argument(
+        '--data-ratio', type=float, default=DEFAULT_DATA_RATIO,
+        help='Fraction of the sparse images with data, default=%(default)s'
+    )
+    pipeline_parser.add_argument(
+        '--cases', type=_names,
+        help='Comma separated cases to run, all of them by default'
+    )
+    pipeline_parser.add_argument(
+        '--block-size', type=int, default=seekable.DEFAULT_BLOCK_SIZE,
+        help='xz block size in bytes, default=%(default)s'
+    )
+    pipeline_parser.add_argument(
+        '--segments', type=int, default=download.DEFAULT_SEGMENTS,
+        help='Concurrent range requests of the segmented download, '
+        'default=%(default)s'
+    )
+
+    createrepo_parser = subparsers.add_parser(
+        'createrepo',
+        help='Repo metadata generation from synthetic metadata files',
+    )
+    createrepo_parser.add_argument(
+        '--files', type=int, default=DEFAULT_METADATA_FILES,
+        help='Number of image metadata files, default=%(default)s'
+    )
+
+    for timed_parser in (pipeline_parser, createrepo_parser):
+        timed_parser.add_argument(
+            '--repeat', type=int, default=DEFAULT_REPEAT,
+            help='Times to run each case, the best one is reported, '
+            'default=%(default)s'
+        )
+        timed_parser.add_argument(
+            '--work-dir',
+            help='Dir to write the temporary files to, default is $TMPDIR'
+        )
+
+    compare_parser = subparsers.add_parser(
+        'compare',
+        help='Compare the json results of two runs, fails on regressions',
+    )
+    compare_parser.add_argument('old', help='Results of the baseline run')
+    compare_parser.add_argument('new', help='Results of the run to check')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='Relative slowdown considered a regression, default=%(default)s'
+    )
+    compare_parser.add_argument(
+        '--min-seconds', type=float, default=DEFAULT_MIN_SECONDS,
+        help='Ignore the cases faster than this, default=%(default)s'
+    )
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+
+    if args.benchmark == 'compare':
+        old_info, old_results = _load_results(args.old)
+        new_info, new_results = _load_results(args.new)
+        if old_info.get('params') != new_info.get('params'):
+            LOGGER.warning(
+                'The runs have different parameters, %r and %r',
+                old_info.get('params'),
+                new_info.get('params'),
+            )
+        comparison = compare_results(
+            old_results,
+            new_results,
+            threshold=args.threshold,
+            min_seconds=args.min_seconds,
+        )
+        print(format_comparison(comparison))
+        return 1 if any(regression for _, _, _, regression in comparison) \
+            else 0
+
+    if args.benchmark == 'compression':
+        results = bench_compression(
+            args.image,
+            compression_cases(
+                OrderedDict((
+                    ('xz', args.xz_levels),
+                    ('zstd', args.zstd_levels),
+                    ('gzip', args.gzip_levels),
+                )),
+                args.block_size,
+            ),
+            args.block_size,
+            work_dir=args.work_dir,
+        )
+        params = {'image': os.path.basename(args.image)}
+        print(format_results(results))
+    elif args.benchmark == 'pipeline':
+        params = {
+            'size': args.size,
+            'kinds': args.kinds,
+            'formats': args.formats,
+            'data_ratio': args.data_ratio,
+            'block_size': args.block_size,
+            'segments': args.segments,
+            'repeat': args.repeat,
+        }
+        images_dir = tempfile.mkdtemp(dir=args.work_dir)
+        try:
+            images = _synthetic_images(
+                images_dir,
+                args.size,
+                args.kinds,
+                args.formats,
+                args.data_ratio,
+            )
+            with serve_dir(images_dir) as base_url:
+                cases = pipeline_cases(
+                    args.block_size,
+                    base_url=base_url,
+                    segments=args.segments,
+                )
+                if args.cases:
+                    cases = [case for case in cases if case.name in args.cases]
+                results = bench_pipeline(
+                    images, cases, repeat=args.repeat, work_dir=args.work_dir
+                )
+        finally:
+            shutil.rmtree(images_dir, ignore_errors=True)
+        print(format_timings(results))
+    elif args.benchmark == 'createrepo':
+        params = {'files': args.files, 'repeat': args.repeat}
+        results = bench_createrepo(
+            args.files, repeat=args.repeat, work_dir=args.work_dir
+        )
+        print(format_timings(results))
+    else:
+        parser.error('A benchmark is required')
+
+    if args.json:
+        with open(args.json, 'w') as json_fd:
+            json.dump(
+                {
+                    'info': run_info(args.benchmark, params),
+                    'results': results,
+                },
+                json_fd,
+                indent=2,
+            )
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,20 +1,26 @@
 
 import requests
-import sys
 from future.moves.urllib.parse import urlparse
 import os
 from os import path
 import logging
 import functools
-import magic
-import re
+import json
+import subprocess
+import tempfile
+import threading
 
 from future.builtins import super
 
 from lago import log_utils
-import lago.utils
 from lago.utils import run_command_with_validation
 
+import compression
+import download
+import fastcopy
+import hashing
+import seekable
+
 
 LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
@@ -136,18 +142,352 @@ def create_layered_image(dst_image, base_image, fail_on_error=True):
         )
 
 
+def image_format(image, fail_on_error=True):
+    """
+    Returns:
+        str: format of the given disk image, as detected by qemu-img
+    """
+    ret = run_command_with_validation(
+        ['qemu-img', 'info', '--output=json', image],
+        fail_on_error,
+        msg='Failed to get the format of {}'.format(image)
+    )
+    return json.loads(ret.out)['format']
+
+
+def create_delta_image(image, base_image, dst_image, fail_on_error=True):
+    """
+    Generates a qcow2 overlay of base_image with the clusters of image that
+    differ from it, so base_image plus the overlay have the same content as
+    image
+
+    The overlay starts empty on top of image, and a safe mode rebase onto
+    base_image copies into it every cluster that reads differently from both
+
+    Args:
+        image (str): Path to the image to generate the delta of
+        base_image (str): Path to the image to generate the delta against,
+            relative to the dir of dst_image, as that's how it's referenced
+            as backing file
+        dst_image (str): Path for the generated delta image
+
+    Returns:
+        None
+    """
+    dst_dir = path.dirname(path.abspath(dst_image))
+    base_format = image_format(path.join(dst_dir, base_image), fail_on_error)
+    create_cmd = [
+        'qemu-img',
+        'create',
+        '-f', 'qcow2',
+        '-b', path.abspath(image),
+        '-F', image_format(image, fail_on_error),
+        dst_image,
+    ]
+    rebase_cmd = [
+        'qemu-img',
+        'rebase',
+        '-f', 'qcow2',
+        '-b', base_image,
+        '-F', base_format,
+        dst_image,
+    ]
+
+    with LogTask('Creating delta of {} over {}'.format(image, base_image)):
+        run_command_with_validation(
+            create_cmd,
+            fail_on_error,
+            msg='Failed to create overlay of {}'.format(image)
+        )
+        return run_command_with_validation(
+            rebase_cmd,
+            fail_on_error,
+            msg='Failed to rebase {} on {}'.format(dst_image, base_image)
+        )
+
+
+def qcow2_convert(
+    src,
+    dst,
+    compress=True,
+    compression_type='zlib',
+    coroutines=8,
+    backing_file=None,
+    backing_format=None,
+    fail_on_error=True,
+):
+    """
+    Converts src into a qcow2 image, flattening its backing chain unless
+    backing_file is given. The zero clusters are left out, and if
+    compressed, the image can still be used without decompressing it
+
+    Args:
+        src (str): Path to the image to convert
+        dst (str): Path to the qcow2 image to generate
+        compress (bool): Compress the clusters of dst
+        compression_type (one of zlib, zstd): Compression of the clusters,
+            zstd requires qemu 5.1 to read and write
+        coroutines (int): Number of parallel coroutines of the conversion
+        backing_file (str): Backing file of dst, only the clusters that
+            differ from it are written to dst
+        backing_format (str): Format of backing_file
+
+    Returns:
+        None
+    """
+    cmd = [
+        'qemu-img',
+        'convert',
+        '-O', 'qcow2',
+        '-m', str(coroutines),
+    ]
+    options = []
+    if compress:
+        cmd.append('-c')
+        if compression_type != 'zlib':
+            options.append('compression_type={}'.format(compression_type))
+    if backing_file is not None:
+        cmd.extend(['-B', backing_file])
+        if backing_format is not None:
+            options.append('backing_fmt={}'.format(backing_format))
+    if options:
+        cmd.extend(['-o', ','.join(options)])
+    cmd.extend([src, dst])
+
+    with LogTask('Converting {} to qcow2'.format(src)):
+        return run_command_with_validation(
+            cmd,
+            fail_on_error,
+            msg='Failed to convert {} to qcow2'.format(src)
+        )
+
+
+def rebase_image(image, backing_file, backing_format, fail_on_error=True):
+    """
+    Points the backing file of the qcow2 image to backing_file, without
+    changing its content, backing_file must have the same content as the
+    current one
+
+    Args:
+        image (str): Path to the qcow2 image
+        backing_file (str): New backing file, relative to the dir of image
+        backing_format (str): Format of backing_file
+
+    Returns:
+        None
+    """
+    cmd = [
+        'qemu-img',
+        'rebase',
+        '-u',
+        '-f', 'qcow2',
+        '-b', backing_file,
+        '-F', backing_format,
+        image,
+    ]
+
+    with LogTask('Rebasing {} on {}'.format(image, backing_file)):
+        return run_command_with_validation(
+            cmd,
+            fail_on_error,
+            msg='Failed to rebase {} on {}'.format(image, backing_file)
+        )
+
+
 def xz_compress(dst, block_size, fail_on_error=True):
+    """
+    Compresses dst into dst.xz, keeping dst, like ``lago.utils.compress``
+    did, but without reading the holes of dst, see
+    :func:`hashing.iter_chunks`
+
+    Returns:
+        str or None: path of the compressed file, None if it failed
+    """
     with LogTask('Compressing {} with xz'.format(dst)):
-        return lago.utils.compress(dst, block_size, fail_on_error)
+        try:
+            compress_and_hash(
+                src=dst,
+                dst=dst + '.xz',
+                compress_cmd=xz_compress_cmd(block_size),
+                checksums=(),
+                compressed_checksums=(),
+            )
+        except LagoImageBuildUtilsException as e:
+            if fail_on_error:
+                raise
+            LOGGER.error('Failed to compress {}: {}'.format(dst, e))
+            return None
+
+        return dst + '.xz'
+
+
+def xz_compress_cmd(block_size):
+    # Same options lago.utils.compress used, but streaming to stdout
+    return [
+        'xz',
+        '--compress',
+        '--threads=0',
+        '--best',
+        '--block-size={}'.format(block_size),
+        '--stdout',
+    ]
+
+
+def filter_and_hash(
+    chunks,
+    dst,
+    cmd,
+    checksums=(),
+    output_checksums=(),
+):
+    """
+    Pipes the given chunks of data through cmd into dst, calculating the
+    digests of the input and the output on the way
 
+    The input data is fed to the digests and to the stdin of the command at
+    the same time, and the output is hashed as it's written to dst, so no
+    data is ever read twice. dst is written atomically.
 
-def xz_decompress(dst, fail_on_error=True):
+    Args:
+        chunks (iterable of tuple(buffer, callable)): input data, along with
+            a callable to release each chunk, see
+            :func:`hashing.iter_chunks`
+        dst (str): Path of the file to write the output of cmd to
+        cmd (list of str): Command that filters its stdin into its stdout
+        checksums (list of str): digests to calculate over the input
+        output_checksums (list of str): digests to calculate over dst
+
+    Returns:
+        tuple(hashing.HashResult, hashing.HashResult): digests of the
+            input and the output, None for the ones without checksums
+
+    Raises:
+        LagoImageBuildUtilsException: if the command failed
+    """
+    tmp_dst = dst + '.tmp'
+    hasher = hashing.MultiHasher(checksums) if checksums else None
+    output_hasher = (
+        hashing.MultiHasher(output_checksums) if output_checksums else None
+    )
+    write_errors = []
+
+    def _drain(proc, dst_fd):
+        try:
+            for chunk in iter(lambda: proc.stdout.read(1024 * 1024), b''):
+                dst_fd.write(chunk)
+                if output_hasher:
+                    output_hasher.update(chunk)
+        except EnvironmentError as e:
+            write_errors.append(e)
+            # Nothing reads its stdout any more, kill it so it does not
+            # block writing it, and the feeding gets EPIPE
+            proc.kill()
+
+    with open(tmp_dst, 'wb') as dst_fd, \
+            tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+        drainer = threading.Thread(target=_drain, args=(proc, dst_fd))
+        drainer.daemon = True
+        drainer.start()
+
+        try:
+            for data, release in chunks:
+                if hasher:
+                    hasher.update_shared(data, on_release=release)
+                proc.stdin.write(data)
+                if not hasher:
+                    release()
+        except EnvironmentError as e:
+            # The command died, its exit code will tell why
+            LOGGER.debug('Failed to feed %s: %s', cmd[0], e)
+        finally:
+            proc.stdin.close()
+            drainer.join()
+            proc.wait()
+            for each_hasher in (hasher, output_hasher):
+                if each_hasher:
+                    each_hasher.finish()
+
+        if proc.returncode != 0 or write_errors:
+            stderr.seek(0)
+            os.unlink(tmp_dst)
+            raise LagoImageBuildUtilsException(
+                'Failed to generate {} with {}'.format(dst, cmd[0]),
+                prv_msg=write_errors[0] if write_errors else
+                stderr.read().decode('utf-8', 'replace'),
+            )
+
+    os.rename(tmp_dst, dst)
+    return (
+        hasher.result() if hasher else None,
+        output_hasher.result() if output_hasher else None,
+    )
+
+
+def compress_and_hash(
+    src,
+    dst,
+    compress_cmd,
+    checksums=('sha1', 'sha512'),
+    compressed_checksums=('sha1', 'sha512'),
+):
+    """
+    Compresses src into dst while calculating the digests of both, reading
+    src only once and never reading dst back, see :func:`filter_and_hash`
+
+    Args:
+        src (str): Path of the file to compress
+        dst (str): Path of the compressed file to generate
+        compress_cmd (list of str): Command that compresses its stdin into
+            its stdout
+        checksums (list of str): digests to calculate over src
+        compressed_checksums (list of str): digests to calculate over dst
+
+    Returns:
+        tuple(hashing.HashResult, hashing.HashResult): digests of the
+            uncompressed and the compressed data
+
+    Raises:
+        LagoImageBuildUtilsException: if the compression command failed
+    """
+    with LogTask('Compressing and hashing {} into {}'.format(src, dst)):
+        with open(src, 'rb', buffering=0) as src_fd:
+            return filter_and_hash(
+                chunks=hashing.iter_chunks(src_fd),
+                dst=dst,
+                cmd=compress_cmd,
+                checksums=checksums,
+                output_checksums=compressed_checksums,
+            )
+
+
+def xz_compress_and_hash(src, block_size, **kwargs):
+    """
+    Compresses src into src.xz with xz, keeping src, and calculates the
+    digests of both in a single pass, see :func:`compress_and_hash`
+    """
+    return compress_and_hash(
+        src=src,
+        dst=src + '.xz',
+        compress_cmd=xz_compress_cmd(block_size),
+        **kwargs
+    )
+
+
+def xz_decompress(dst, fail_on_error=True, keep=False):
     cmd = [
         'xz',
         '--threads=0',
         '--decompress',
         dst
     ]
+    if keep:
+        cmd.insert(-1, '--keep')
 
     with LogTask('Decompressing {} with xz'.format(dst)):
         return run_command_with_validation(
@@ -187,47 +527,110 @@ def gzip_decompress(dst, fail_on_error=True):
         )
 
 
-def report_with_content_length(chunk_size, content_length):
-    acc_data = 0
-    while True:
-        acc_data += chunk_size
-        percent = (acc_data * 100 / float(content_length))
-        sys.stdout.write(
-            "\r% 3.1f%%" % percent + " complete (%d " %
-            (acc_data / 1024) + "Kilobytes)"
-        )
-        sys.stdout.flush()
-        yield
-
-
-def report(chunk_size):
-    acc_data = 0
-    while True:
-        acc_data += chunk_size
-        sys.stdout.write(
-            " complete (%d " % (acc_data / 1024) + "Kilobytes)"
-        )
-        yield
+def download_from_url(
+    url,
+    dst,
+    chunk_size=1024 * 256,
+    force=False,
+    segments=download.DEFAULT_SEGMENTS,
+    checksum='sha1',
+    expected_digest=None,
+):
+    """
+    Downloads url to dst, in parallel segments if the server supports it,
+    resuming any previously interrupted download of it
 
+    Args:
+        url (str): URL to download
+        dst (str): Path to download it to
+        chunk_size (int): Size of each read from the connections
+        force (bool): Download even if dst already exists
+        segments (int): Max number of concurrent range requests
+        checksum (str): hashlib name of the digest to verify
+        expected_digest (str): if given, the download is verified against it
 
-def download_from_url(url, dst, chunk_size=1024 * 256, force=False):
+    Returns:
+        str: dst
+    """
     with LogTask('Downloading {} to {}'.format(url, dst)):
+        # Partial downloads are kept in a separate file, so if dst is there
+        # it was fully downloaded
         if path.isfile(dst) and not force:
             LOGGER.debug('{} Alreday downloaded'.format(dst))
             return dst
 
-        r = requests.get(url, stream=True)
-        r.raise_for_status()
-        content_length = r.headers.get('Content-Length')
-        if content_length:
-            report_gen = report_with_content_length(chunk_size, content_length)
-        else:
-            report_gen = report(chunk_size)
+        return download.Downloader(
+            url,
+            dst,
+            segments=segments,
+            chunk_size=chunk_size,
+        ).download(checksum=checksum, expected_digest=expected_digest)
 
-        with open(dst, mode='wb') as f:
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                f.write(chunk)
-                report_gen.next()
+
+def url_fingerprint(url):
+    """
+    Args:
+        url (str): URL to get the fingerprint of
+
+    Returns:
+        str or None: a string that changes when the content of the url
+            changes, None if the server does not provide one
+    """
+    r = requests.head(url, allow_redirects=True)
+    r.raise_for_status()
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return None
+
+    return '{}:{}:{}:{}'.format(
+        url,
+        etag,
+        last_modified,
+        r.headers.get('Content-Length'),
+    )
+
+
+def url_size(url):
+    """
+    Args:
+        url (str): URL to get the size of
+
+    Returns:
+        int or None: size of the content of the url, None if the server
+            does not provide it
+    """
+    r = requests.head(url, allow_redirects=True)
+    r.raise_for_status()
+    size = r.headers.get('Content-Length')
+    return int(size) if size else None
+
+
+def virt_builder_template_info(base_image, fail_on_error=True):
+    """
+    Args:
+        base_image (str): virt-builder template name, see virt-builder --list
+
+    Returns:
+        dict: The virt-builder index info of the template
+    """
+    cmd = [
+        'virt-builder',
+        '--list',
+        '--list-format=json',
+    ]
+    result = run_command_with_validation(
+        cmd,
+        fail_on_error,
+        msg='Failed to list virt-builder templates'
+    )
+    for template in json.loads(result.out)['templates']:
+        if template['os-version'] == base_image:
+            return template
+
+    raise LagoImageBuildUtilsException(
+        'virt-builder template {} not found'.format(base_image)
+    )
 
 
 def is_url(url):
@@ -251,46 +654,330 @@ def get_file(src, dst):
     return dst
 
 
-def get_uncompressed_file(src, dst):
-    resolved_dst_path = get_file(src, dst)
-    with magic.Magic() as m:
-        f_type = m.id_filename(resolved_dst_path)
-
-    # xz and gzip are expecting that the file will have a type suffix
-    if f_type == 'XZ compressed data':
-        p = re.compile(r'(?P<ext>\.xz)$')
-        default_ext = '.xz'
-        f = xz_decompress
-    elif f_type.startswith('gzip compressed data'):
-        p = re.compile('r(?P<ext>\.gz|.tgz)$')
-        default_ext = '.gz'
-        f = gzip_decompress
+# Magic bytes of the supported compression formats, along with the command
+# to decompress them from stdin and the extensions they usually have
+COMPRESSION_FORMATS = tuple(
+    (codec.magic, codec.decompress_cmd(), codec.exts)
+    for codec in compression.compressed_codecs()
+)
+
+
+# Bytes to get to detect the compression format, more than any magic
+SNIFF_SIZE = 512
+
+
+def sniff_compression(head):
+    """
+    Args:
+        head (bytes): first bytes of a file
+
+    Returns:
+        tuple(list of str, tuple of str) or None: The decompress command and
+            the extensions of the compression format of the file, None if
+            it's not compressed with any of the supported formats
+    """
+    for magic_bytes, decompress_cmd, exts in COMPRESSION_FORMATS:
+        if bytes(head[:len(magic_bytes)]) == magic_bytes:
+            return decompress_cmd, exts
+
+    return None
+
+
+def _strip_ext(file_path, exts):
+    for ext in exts:
+        if file_path.endswith(ext):
+            return file_path[:-len(ext)]
+
+    return file_path
+
+
+def strip_compression_ext(file_path):
+    """
+    Args:
+        file_path (str): path to strip the extension from
+
+    Returns:
+        str: file_path without any of the known compression extensions
+    """
+    for _, _, exts in COMPRESSION_FORMATS:
+        file_path = _strip_ext(file_path, exts)
+
+    return file_path
+
+
+def _noop():
+    pass
+
+
+def _url_chunks(chunks):
+    for chunk in chunks:
+        yield chunk, _noop
+
+
+def _file_chunks(src_fd, first_chunk):
+    yield first_chunk, _noop
+    for chunk in hashing.iter_chunks(src_fd):
+        yield chunk
+
+
+def stream_uncompressed_file(
+    src,
+    dst,
+    checksums=('sha512', ),
+    chunk_size=1024 * 1024,
+):
+    """
+    Gets src into dst, decompressing it on the fly if needed, so compressed
+    files never touch the disk
+
+    The compression format is detected from the first bytes of the file,
+    requested as a range for URLs, and the decompressed data is hashed while
+    it's written. Compressed URLs are streamed, resuming the stream if the
+    connection fails, see :meth:`download.Downloader.stream`.
+
+    Args:
+        src (str): URL or path of the file to get
+        dst (str): Path to put it at, if it's a dir the file name is taken
+            from src, without its compression extension
+        checksums (list of str): digests to calculate over the decompressed
+            data
+        chunk_size (int): Size of each read from src
+
+    Returns:
+        tuple(str, hashing.HashResult): Path of the uncompressed file and
+            its digests, None if it was not compressed
+    """
+    if is_url(src):
+        src_name = filename_from_url(src)
+        downloader = download.Downloader(src, dst, chunk_size=chunk_size)
+        compression = sniff_compression(downloader.head(SNIFF_SIZE))
+        if compression is None:
+            return get_file(src, dst), None
     else:
-        return resolved_dst_path
-        raise RuntimeError('Unknown compression format {}'.format(f_type))
+        src_name = path.basename(src)
+        src_fd = open(src, 'rb', buffering=0)
+        first_chunk = src_fd.read(chunk_size)
+        compression = sniff_compression(first_chunk)
+        if compression is None:
+            src_fd.close()
+            return get_file(src, dst), None
+
+    decompress_cmd, exts = compression
+    if path.isdir(dst):
+        dst = path.join(dst, _strip_ext(src_name, exts))
+    else:
+        dst = _strip_ext(dst, exts)
+
+    with LogTask('Decompressing {} into {}'.format(src, dst)):
+        if is_url(src):
+            input_chunks = _url_chunks(downloader.stream())
+        else:
+            input_chunks = _file_chunks(src_fd, first_chunk)
+
+        try:
+            _, hashes = filter_and_hash(
+                chunks=input_chunks,
+                dst=dst,
+                cmd=decompress_cmd,
+                output_checksums=checksums,
+            )
+        finally:
+            input_chunks.close()
+            if not is_url(src):
+                src_fd.close()
+
+    LOGGER.debug('Decompressed {}: {!r}'.format(dst, hashes))
+    return dst, hashes
+
+
+def get_block_index(src):
+    """
+    Args:
+        src (str): URL or path of a compressed image
+
+    Returns:
+        tuple(int, list, compression.Codec) or None: block size, block index
+            and codec of src, from the image metadata published next to it,
+            None if there's none or it was not compressed by blocks, see
+            :mod:`seekable`
+    """
+    codec = compression.codec_from_ext(src)
+    if codec is None:
+        return None
+
+    metadata_src = strip_compression_ext(src) + '.metadata'
+    try:
+        if is_url(metadata_src):
+            r = requests.get(metadata_src)
+            if r.status_code != 200:
+                return None
+            props = r.json()
+        else:
+            with open(metadata_src) as metadata_fd:
+                props = json.load(metadata_fd)
+    except (IOError, OSError, ValueError, requests.RequestException):
+        return None
+
+    if not props.get('compressed_blocks'):
+        return None
 
-    m = p.match(resolved_dst_path)
+    return (
+        props['compression_block_size'],
+        props['compressed_blocks'],
+        compression.get_codec(props.get('compression')),
+    )
 
-    # Now we know the compression method, lets decompress
-    if m:
-        ext = m.groupdict()['ext']
-        f(resolved_dst_path)
-        resolved_dst_path = resolved_dst_path[:-len(ext)]
+
+def get_uncompressed_file(src, dst):
+    """
+    Gets src into dst, decompressing it if needed, in parallel if it was
+    compressed by blocks, see :func:`get_block_index`
+
+    Returns:
+        str: path of the uncompressed file
+    """
+    block_index = get_block_index(src)
+    if block_index is None:
+        resolved_dst_path, _ = stream_uncompressed_file(
+            src, dst, checksums=()
+        )
+        return resolved_dst_path
+
+    block_size, index, codec = block_index
+    if path.isdir(dst):
+        src_name = filename_from_url(src) if is_url(src) else src
+        dst = path.join(dst, strip_compression_ext(path.basename(src_name)))
     else:
-        os.rename(resolved_dst_path, resolved_dst_path + default_ext)
-        f(resolved_dst_path + default_ext)
+        dst = strip_compression_ext(dst)
 
-    return resolved_dst_path
+    decompress = seekable.decompress_url if is_url(src) else \
+        seekable.decompress_file
+    return decompress(
+        src,
+        dst,
+        index=index,
+        block_size=block_size,
+        decompress_cmd=codec.decompress_cmd(threads=1),
+    )
+
+
+def decompress(src, dst, codec):
+    """
+    Decompresses src into dst, keeping src
+
+    Args:
+        src (str): Path of the compressed file
+        dst (str): Path of the decompressed file
+        codec (compression.Codec): codec src was compressed with
+
+    Returns:
+        None
+    """
+    with LogTask('Decompressing {} with {}'.format(src, codec.name)):
+        with open(src, 'rb', buffering=0) as src_fd:
+            filter_and_hash(
+                chunks=hashing.iter_chunks(src_fd),
+                dst=dst,
+                cmd=codec.decompress_cmd(),
+            )
 
 
 def get_hash(dst, checksum='sha1'):
-    with LogTask('Calculating {} of {}'.format(checksum, dst)):
-        return lago.utils.get_hash(dst, checksum)
+    return get_hashes(dst, [checksum])[checksum]
+
+
+def get_hashes(dst, checksums):
+    """
+    Calculates all the given checksums of dst reading it only once
 
+    Args:
+        dst (str): Path to the file to hash
+        checksums (list of str): hashlib names of the digests to calculate
+
+    Returns:
+        hashing.HashResult: The digests, indexable by checksum name, along
+            with the size and throughput of the hashing
+    """
+    with LogTask('Calculating {} of {}'.format(','.join(checksums), dst)):
+        result = hashing.hash_file(dst, checksums)
+        LOGGER.debug(
+            'Hashed {} bytes in {:.2f}s ({:.1f} MiB/s)'.format(
+                result.size,
+                result.elapsed,
+                result.throughput / (1024 * 1024),
+            )
+        )
+        return result
+
+
+def cp(src, dst, fail_on_error=True, allow_reflink=True):
+    """
+    Copies src to dst, as a reflink if possible and keeping it sparse
+    otherwise, see :func:`fastcopy.copy_file`
+
+    Args:
+        src (str): Path of the file to copy
+        dst (str): Path of the copy, or dir to copy it to
+        fail_on_error (bool): Raise if the copy failed
+        allow_reflink (bool): If it can be a copy on write clone
+
+    Returns:
+        str or None: Strategy used to copy it, None if it failed
+    """
+    if path.isdir(dst):
+        dst = path.join(dst, path.basename(src))
 
-def cp(src, dst, fail_on_error=True):
     with LogTask('Copying {} to {}'.format(src, dst)):
-        return lago.utils.cp(src, dst, fail_on_error)
+        try:
+            strategy = fastcopy.copy_file(
+                src, dst, allow_reflink=allow_reflink
+            )
+        except EnvironmentError as e:
+            if fail_on_error:
+                raise LagoImageBuildUtilsException(
+                    'Failed to copy {} to {}'.format(src, dst),
+                    prv_msg=e,
+                )
+            LOGGER.error('Failed to copy {} to {}: {}'.format(src, dst, e))
+            return None
+
+        LOGGER.info('Copied {} using {}'.format(src, strategy))
+        return strategy
+
+
+def clone_file(src, dst, writable=True, fail_on_error=True):
+    """
+    Makes dst a copy of src as cheaply as possible: a reflink if the
+    filesystem supports it, else a hard link if dst won't be modified, and
+    a full copy as last resort
+
+    Args:
+        src (str): Path of the file to clone
+        dst (str): Path of the clone
+        writable (bool): If dst is going to be modified
+
+    Returns:
+        None
+    """
+    if path.lexists(dst):
+        os.unlink(dst)
+
+    try:
+        fastcopy.reflink_file(src, dst)
+        LOGGER.debug('Reflinked {} to {}'.format(src, dst))
+        return
+    except EnvironmentError:
+        pass
+
+    if not writable:
+        try:
+            os.link(src, dst)
+            LOGGER.debug('Hard linked {} to {}'.format(src, dst))
+            return
+        except OSError:
+            pass
+
+    cp(src, dst, fail_on_error, allow_reflink=False)
 
 
 class LagoImagesException(Exception):
@@ -0,0 +1,380 @@
+"""
+Persistent, content addressed cache of built images
+
+Each entry is keyed by everything that goes into an image build: the spec
+props and commands, a fingerprint of the base image and the versions of the
+tools used to build it. If none of them changed, the published artifacts
+(compressed image, .metadata and .hash) are reused instead of building it
+again.
+
+Layout of the cache dir::
+
+    <cache_dir>/<key>/entry.json
+    <cache_dir>/<key>/<files of the entry>
+
+The mtime of entry.json is the last time the entry was used, used to evict
+the least recently used entries once the cache is over its max size.
+
+Entries are restored holding a shared lock on ``<cache_dir>/.lock``, and
+replaced or evicted holding an exclusive one, so no build, of this or
+other processes sharing the cache, restores an entry while it's removed.
+"""
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+from lago import log_utils
+
+import fastcopy
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'lago-images', 'builds'
+)
+# In GiB
+DEFAULT_CACHE_SIZE = 100
+
+TOOLS = ('virt-builder', 'virt-customize', 'virt-sysprep', 'qemu-img', 'xz')
+
+# Smaller files are copied instead of hard linked, as some of them (like
+# the .metadata) are rewritten in place
+LINK_THRESHOLD = 1024 * 1024
+LOCK_FILE = '.lock'
+
+# Props that are added to the spec by the build itself
+BUILD_PROPS = set((
+    'size',
+    'sha1',
+    'checksum',
+    'compressed_size',
+    'compressed_sha1',
+    'uncompressed_checksum',
+    'timestamp',
+    'compression_block_size',
+    'compressed_blocks',
+    'delta_base',
+    'delta_base_version',
+    'delta_base_sha1',
+    'delta_size',
+    'delta_sha1',
+    'delta_compressed_size',
+    'delta_compressed_sha1',
+    'delta_compressed_checksum',
+    'backing_handle',
+    'backing_sha1',
+    'backing_checksum',
+))
+
+_tool_versions = None
+
+
+def get_tool_versions():
+    """
+    Returns:
+        dict of str: str: version string of each of the build tools, they
+            are only checked once per run
+    """
+    global _tool_versions
+    if _tool_versions is not None:
+        return _tool_versions
+
+    versions = {}
+    for tool in TOOLS:
+        try:
+            out = subprocess.check_output(
+                [tool, '--version'],
+                stderr=subprocess.STDOUT,
+            )
+            versions[tool] = out.decode('utf-8', 'replace').strip()
+        except (OSError, subprocess.CalledProcessError):
+            versions[tool] = None
+
+    _tool_versions = versions
+    return versions
+
+
+def normalize_commands(spec):
+    """
+    Args:
+        spec (spec.Spec): spec to get the commands from
+
+    Returns:
+        list of str: the build commands of the spec, without props,
+            comments, empty lines or trailing whitespace
+    """
+    commands = []
+    with open(spec.commands_file) as spec_fd:
+        for line in spec_fd:
+            line = line.rstrip()
+            if not line or line.lstrip().startswith('#'):
+                continue
+            commands.append(line)
+
+    return commands
+
+
+def build_key(spec, base_fingerprint, tool_versions=None):
+    """
+    Calculates the cache key of the image of the given spec
+
+    Args:
+        spec (spec.Spec): spec of the image, before building it
+        base_fingerprint (str): Something that changes whenever the base
+            image changes, ideally its digest
+        tool_versions (dict of str: str): versions of the build tools,
+            defaults to the ones installed
+
+    Returns:
+        str: the cache key
+    """
+    if tool_versions is None:
+        tool_versions = get_tool_versions()
+
+    props = dict(
+        (key, value) for key, value in spec.props.items()
+        if key not in BUILD_PROPS
+    )
+    key_data = {
+        'props': props,
+        'commands': normalize_commands(spec),
+        'base': base_fingerprint,
+        'tools': tool_versions,
+    }
+    return hashlib.sha256(
+        json.dumps(key_data, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+class CacheException(Exception):
+    pass
+
+
+@contextmanager
+def _flocked(lock_path, operation):
+    """
+    Yields:
+        bool: If the lock was taken, it's only False for non blocking
+            operations
+    """
+    with open(lock_path, 'a') as lock_fd:
+        try:
+            fcntl.flock(lock_fd, operation)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+
+def _clone(src, dst):
+    if os.path.getsize(src) >= LINK_THRESHOLD:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    # A reflink or in kernel copy if possible, see fastcopy
+    fastcopy.copy_file(src, dst)
+
+
+class CacheEntry(object):
+    def __init__(self, path, files, info):
+        """
+        Args:
+            path (str): dir of the entry
+            files (list of str): paths of the files in the entry, relative
+                to its dir
+            info (dict): any extra info stored along with the entry
+        """
+        self.path = path
+        self.files = files
+        self.info = info
+        # Of its entry.json, tells if it was replaced since loaded
+        self._inode = None
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'entry.json')) as entry_fd:
+            data = json.load(entry_fd)
+            inode = os.fstat(entry_fd.fileno()).st_ino
+
+        entry = cls(path=path, files=data['files'], info=data['info'])
+        entry._inode = inode
+        return entry
+
+    def size(self):
+        return sum(
+            os.path.getsize(os.path.join(self.path, file_name))
+            for file_name in self.files
+        )
+
+    def touch(self):
+        os.utime(os.path.join(self.path, 'entry.json'), None)
+
+    def last_used(self):
+        return os.stat(os.path.join(self.path, 'entry.json')).st_mtime
+
+    def restore(self, dst_dir):
+        """
+        Places the files of this entry under dst_dir, with the same
+        relative paths they were stored with
+
+        Raises:
+            CacheException: if the entry was evicted or replaced since it
+                was loaded
+        """
+        lock_path = os.path.join(os.path.dirname(self.path), LOCK_FILE)
+        with _flocked(lock_path, fcntl.LOCK_SH):
+            entry_path = os.path.join(self.path, 'entry.json')
+            if not os.path.isfile(entry_path) or \
+                    os.stat(entry_path).st_ino != self._inode:
+                raise CacheException(
+                    'Cache entry {} is gone'.format(self.path)
+                )
+            for file_name in self.files:
+                dst = os.path.join(dst_dir, file_name)
+                if not os.path.isdir(os.path.dirname(dst)):
+                    os.makedirs(os.path.dirname(dst))
+                _clone(os.path.join(self.path, file_name), dst)
+
+
+class BuildCache(object):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=None):
+        """
+        Args:
+            cache_dir (str): Path to keep the cache in
+            max_size (int): Max size of the cache in bytes, the least
+                recently used entries are evicted when it's exceeded
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _locked(self, operation):
+        return _flocked(os.path.join(self.cache_dir, LOCK_FILE), operation)
+
+    def get(self, key, touch=True):
+        """
+        Args:
+            key (str): key of the entry
+            touch (bool): Mark the entry as used, so it's evicted later
+
+        Returns:
+            CacheEntry or None: the entry if it's in the cache
+        """
+        try:
+            entry = CacheEntry.load(self._entry_path(key))
+        except (IOError, OSError, ValueError):
+            return None
+
+        if touch:
+            entry.touch()
+        return entry
+
+    def put(self, key, src_dir, files, info=None):
+        """
+        Adds an entry to the cache, replacing any existing one with the same
+        key. The entry is staged in a temporary dir and moved in place, so
+        concurrent readers never see half written entries.
+
+        Args:
+            key (str): key of the entry
+            src_dir (str): base dir of the files to store
+            files (list of str): paths of the files relative to src_dir
+            info (dict): extra info to store along with the files
+
+        Returns:
+            CacheEntry: the new entry
+        """
+        with LogTask('Storing {} in the build cache'.format(key)):
+            staging = tempfile.mkdtemp(prefix='.' + key, dir=self.cache_dir)
+            try:
+                entry = CacheEntry(path=staging, files=files, info=info or {})
+                for file_name in files:
+                    dst = os.path.join(staging, file_name)
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        os.makedirs(os.path.dirname(dst))
+                    _clone(os.path.join(src_dir, file_name), dst)
+
+                with open(os.path.join(staging, 'entry.json'), 'w') as fd:
+                    json.dump({'files': files, 'info': entry.info}, fd)
+                entry._inode = os.stat(
+                    os.path.join(staging, 'entry.json')
+                ).st_ino
+
+                dst_path = self._entry_path(key)
+                with self._locked(fcntl.LOCK_EX):
+                    if os.path.exists(dst_path):
+                        shutil.rmtree(dst_path)
+                    os.rename(staging, dst_path)
+                entry.path = dst_path
+            except Exception:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+
+        self.evict()
+        return entry
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            try:
+                entries.append(CacheEntry.load(self._entry_path(name)))
+            except (IOError, OSError, ValueError):
+                LOGGER.debug('Ignoring broken cache entry %s', name)
+
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its
+        max size. It's skipped if other builds are restoring entries, the
+        next eviction catches up
+        """
+        if self.max_size is None:
+            return
+
+        with self._locked(fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+            if not locked:
+                LOGGER.debug('Build cache in use, not evicting')
+                return
+            self._evict()
+
+    def _evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry.last_used())
+        sizes = dict((entry.path, entry.size()) for entry in entries)
+        total = sum(sizes.values())
+        while total > self.max_size and entries:
+            entry = entries.pop(0)
+            LOGGER.info(
+                'Evicting %s from the build cache, last used %s',
+                os.path.basename(entry.path),
+                time.ctime(entry.last_used()),
+            )
+            shutil.rmtree(entry.path, ignore_errors=True)
+            total -= sizes[entry.path]
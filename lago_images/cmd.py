@@ -30,13 +30,25 @@ import os
 import sys
 import functools
 import pkg_resources
+import time
+from collections import OrderedDict
 
-from spec import LagoSpec, VirtBuilderSpec, AllSpec
+import spec as spec_module
 
 from lago import log_utils, utils
 
 import images
 import createrepo
+import distributed
+import journal
+import workspace
+import scheduler
+import cache
+import basestore
+import compression
+import metrics
+import plan
+import publish
 
 LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
@@ -48,10 +60,48 @@ def generate_repo(
     base_url,
     repo_name,
     repo_format='all',
+    jobs=1,
+    memory_budget=None,
+    disk_budget=None,
+    build_memory=scheduler.DEFAULT_BUILD_MEMORY,
+    build_disk=scheduler.DEFAULT_BUILD_DISK,
+    build_cache=None,
+    base_store=None,
+    single_appliance=False,
+    publish_delta=False,
+    seekable=False,
+    compression_name=None,
+    compression_level=None,
+    compression_threads=0,
+    finalize=None,
+    qcow2_compression=None,
+    qcow2_coroutines=images.DEFAULT_QCOW2_COROUTINES,
+    layered=None,
+    publish_workers=publish.DEFAULT_WORKERS,
+    publish_depth=publish.DEFAULT_DEPTH,
+    report_dir=None,
+    prometheus_textfile=None,
+    full_rescan=False,
+    keep_versions=None,
+    keep_days=None,
+    spec_index=None,
+    plan_only=False,
+    coordinator=None,
+    build_workspace=None,
+    build_journal=None,
 ):
     """
     Generates the images from the given specs in the repo_dir
 
+    Images are built in parallel, except for the ones based on another
+    spec, that are built once their base image is ready. Built images are
+    compressed and published by a separate pool of workers, while the next
+    ones are built, see :mod:`publish`
+
+    Each image is published as a new version, the one in its spec or the
+    start time of the run if it has none, next to the already published
+    ones
+
     Args:
         specs (list of str): list of spec paths to generate
         repo_dir (str): Path to the dir to generate the repo on
@@ -59,42 +109,369 @@ def generate_repo(
         repo_name (str): Name for this repo (for the metadata)
         repo_format (one of 'all', 'lago', 'virt-builder'): Format to generate
             the metadata of the repo
+        jobs (int): Max number of images to build at the same time
+        memory_budget (int): Max memory in MiB to use for all the builds,
+            defaults to the host memory
+        disk_budget (int): Max disk in GiB to use for all the builds,
+            defaults to the free space on repo_dir
+        build_memory (int): Estimated memory in MiB needed for each build
+        build_disk (int): Estimated disk in GiB needed for each build
+        build_cache (cache.BuildCache): Cache to reuse unchanged images from,
+            if None, all the images are built
+        base_store (basestore.BaseImageStore): Store to share the base
+            images through, if None they are downloaded or copied for each
+            image
+        single_appliance (bool): Customize, sysprep and sparsify each image
+            in a single libguestfs appliance when possible
+        publish_delta (bool): Also publish a delta from the newest already
+            published version of each image, see
+            :meth:`images.Image.create_delta`
+        seekable (bool): Compress the images by blocks, that can be
+            decompressed in parallel, see :mod:`seekable`
+        compression_name (str): Codec to compress the images with, unless
+            their spec sets one, see :mod:`compression`
+        compression_level (int): Level of that codec, the default of the
+            codec if None
+        compression_threads (int): Threads to compress each image with, 0
+            to use all the cpus
+        finalize (str): How to turn the built images into the published
+            ones, unless their spec sets it, see :data:`images.FINALIZE_MODES`
+        qcow2_compression (str): Compression of the images finalized as
+            qcow2, unless their spec sets it
+        qcow2_coroutines (int): Parallel coroutines of each qcow2 conversion
+        layered (str): How to publish the layered images, unless their spec
+            sets it, see :data:`images.LAYERED_MODES`, the images based on
+            another spec are built as layered images if published as
+            overlays
+        publish_workers (int): Number of images to publish at the same
+            time, if 0 each image is published by the same job that built it
+        publish_depth (int): Max number of built images waiting to be
+            published
+        keep_versions (int): Number of versions to keep of each image, see
+            :func:`createrepo.select_expired`
+        keep_days (int): Days to keep the versions of each image for, see
+            :func:`createrepo.select_expired`
+        spec_index (spec.SpecIndex): Index to get the props of the
+            unchanged specs from, if None all of them are parsed
+        plan_only (bool): Only print what would be built and its estimated
+            cost, see :mod:`plan`
+        coordinator (distributed.Coordinator): Coordinator to build the
+            images through, on its workers, if None they are built by this
+            process
+        build_workspace (workspace.Workspace): Workspace to build the images
+            in, if None they are built in the repo dir
+        build_journal (journal.Journal): Journal to record the build stages
+            of the images in, to resume them if the run dies, see
+            :mod:`journal`, not used with a coordinator
 
     Returns:
-        None
+        list of plan.PlanEntry or None: the plan, if plan_only
     """
+    spec_objs = load_specs(specs, repo_format, spec_index)
+    spec_ids = set(spec_obj.id for spec_obj in spec_objs)
+
+    image_opts = {
+        'base_store': base_store,
+        'single_appliance': single_appliance,
+        'publish_delta': publish_delta,
+        'seekable': seekable,
+        'compression_name': compression_name,
+        'compression_level': compression_level,
+        'compression_threads': compression_threads,
+        'finalize': finalize,
+        'qcow2_compression': qcow2_compression,
+        'qcow2_coroutines': qcow2_coroutines,
+        'layered': layered,
+        'workspace': build_workspace,
+    }
+    run_start = time.strftime('%Y%m%d-%H%M%S')
+    report_dir = report_dir or metrics.DEFAULT_REPORT_DIR
+
+    if plan_only:
+        entries = plan.plan_repo(
+            spec_objs,
+            repo_dir,
+            run_start,
+            build_cache=build_cache,
+            image_opts=image_opts,
+            history=plan.StageHistory.load(report_dir),
+        )
+        print(plan.format_plan(entries, jobs))
+        return entries
+
     LOGGER.info('Creating repo for specs %s', ','.join(specs))
 
     if not os.path.exists(repo_dir):
         os.makedirs(repo_dir)
 
-    if repo_format == 'lago':
-        spec_cls = LagoSpec
-    elif repo_format == 'virt-builder':
-        spec_cls = VirtBuilderSpec
+    started_images = OrderedDict()
+    publish_queue = None
+    if publish_workers and coordinator is None:
+        publish_queue = publish.PublishQueue(
+            workers=publish_workers, depth=publish_depth
+        )
+    parents = dict(
+        (spec_obj.id, scheduler.get_base_reference(spec_obj, spec_ids))
+        for spec_obj in spec_objs
+    )
+    nodes = []
+    for spec_obj in spec_objs:
+        parent = parents[spec_obj.id]
+        if coordinator is None:
+            action = functools.partial(
+                _build_image,
+                spec_obj,
+                repo_dir,
+                run_start,
+                build_cache,
+                image_opts,
+                started_images,
+                publish_queue,
+                keep_uncompressed=spec_obj.id in parents.values(),
+                build_journal=build_journal,
+            )
+        else:
+            action = coordinator.build_action(
+                spec_obj, repo_dir, repo_format, run_start, image_opts
+            )
+        nodes.append(
+            scheduler.BuildNode(
+                name=spec_obj.id,
+                action=action,
+                parents=[parent] if parent else [],
+                memory=build_memory,
+                disk=build_disk,
+            )
+        )
+
+    if coordinator is None:
+        budget = scheduler.ResourceBudget(
+            jobs=jobs,
+            memory=memory_budget or scheduler.total_memory(),
+            disk=disk_budget or scheduler.free_disk(repo_dir),
+        )
     else:
-        spec_cls = AllSpec
+        budget = coordinator.budget(nodes)
+        coordinator.start()
+    try:
+        try:
+            scheduler.BuildScheduler(nodes, budget).run()
+        finally:
+            if publish_queue is not None:
+                publish_queue.drain()
+            if coordinator is not None:
+                coordinator.stop()
+    finally:
+        if coordinator is None:
+            recorders = [image.metrics for image in started_images.values()]
+        else:
+            recorders = coordinator.recorders
+        _write_metrics_reports(
+            report_dir,
+            recorders,
+            run_name='run-' + run_start,
+            prometheus_textfile=prometheus_textfile,
+        )
+        for image in started_images.values():
+            if build_journal is not None and image.built and \
+                    not image.is_published:
+                LOGGER.info(
+                    'Keeping the build of %s to resume it', image.spec.name
+                )
+                continue
+            image.cleanup()
+        if build_workspace is not None:
+            build_workspace.close()
+
+    createrepo.create_repo_from_metadata(
+        repo_dir,
+        repo_name,
+        base_url,
+        full_rescan=full_rescan,
+        keep_versions=keep_versions,
+        keep_days=keep_days,
+    )
+    if build_journal is not None:
+        build_journal.remove()
+
+
+def _write_metrics_reports(
+    report_dir,
+    recorders,
+    run_name,
+    prometheus_textfile=None,
+):
+    with LogTask('Writing build metrics reports to {}'.format(report_dir)):
+        for recorder in recorders:
+            metrics.write_reports(report_dir, [recorder], recorder.name)
+        metrics.write_reports(
+            report_dir,
+            recorders,
+            run_name,
+            prometheus_textfile=prometheus_textfile,
+        )
+
+
+def _build_image(
+    spec,
+    repo_dir,
+    run_version,
+    build_cache=None,
+    image_opts=None,
+    started_images=None,
+    publish_queue=None,
+    base_image=None,
+    keep_uncompressed=False,
+    build_journal=None,
+):
+    """
+    Builds the image for the given spec, unless it's in the build cache, or
+    resumes its build from the journal of a previous run
+
+    Args:
+        spec (spec.Spec): spec of the image to build
+        repo_dir (str): Path to the repo to publish the image on
+        run_version (str): version to publish the image as, if its spec
+            has none
+        build_cache (cache.BuildCache): Cache to reuse the image from or
+            store it in
+        image_opts (dict): Extra options for :func:`images.get_instance`
+        started_images (dict of str: images.Image): the image will be added
+            here before starting the build, keyed by its spec id
+        publish_queue (publish.PublishQueue): Queue to publish the image
+            through, if None it's published right after being built
+        base_image (images.Image): Already built image to use as base, if
+            the spec is based on another spec
+        keep_uncompressed (bool): Keep the intermediate files of the image
+            once published, other images are based on it, see
+            :meth:`images.Image.cleanup`
+        build_journal (journal.Journal): Journal to record the stages of
+            the build in, and to resume it from
+
+    Returns:
+        images.Image: The built image, it might still be waiting to be
+            published
+    """
+    image_opts = dict(image_opts or {})
+    base = None
+    base_fingerprint = None
+    if base_image is not None:
+        layered = images.get_layered_mode(spec, image_opts.get('layered'))
+        if base_image.publish_changes_image or \
+                layered == images.LAYERED_OVERLAY:
+            # Its image is moved or rewritten while publishing it, or this
+            # one refers to the published one
+            base_image.wait_published()
+        base = images.base_reference(
+            spec,
+            base_image.uncompressed_image_path,
+            layered,
+        )
+        if build_cache is not None or build_journal is not None:
+            # Waits for it to be compressed, it's hashed meanwhile
+            base_fingerprint = base_image.get_fingerprint()
+        # No point in storing images of this same repo
+        image_opts['base_store'] = None
+        image_opts['backing_image'] = base_image
+
+    spec_digest = None
+    journal_entry = None
+    if build_journal is not None:
+        spec_digest = build_journal.spec_digest(
+            spec, base_fingerprint or spec.base
+        )
+        journal_entry = build_journal.get(spec.id, spec_digest)
+
+    version = spec.props.get('version') or run_version
+    handle = createrepo.version_handle(spec.name, version)
+    if journal_entry is not None:
+        # Resumed as the version the interrupted run was building
+        version = journal_entry['version']
+        handle = journal_entry['handle']
+    elif createrepo.is_published(repo_dir, handle):
+        # Published images are never overwritten
+        version = '{}-{}'.format(version, run_version)
+        LOGGER.warning(
+            '%s is already published, publishing this build as version %s',
+            handle,
+            version,
+        )
+        handle = createrepo.version_handle(spec.name, version)
+
+    image = images.get_instance(
+        spec, os.path.join(repo_dir, handle), base=base, **image_opts
+    )
+    if started_images is not None:
+        started_images[spec.id] = image
+
+    cache_key = None
+    if build_cache is not None:
+        # The run version is not part of the key, an unchanged image is
+        # restored with the version it was first published as
+        cache_key = image.get_cache_key(base_fingerprint)
+
+    resumed = None
+    if journal_entry is not None:
+        resumed = build_journal.resume(image, journal_entry)
+        if resumed is None:
+            build_journal.discard(spec.id)
+        elif resumed == images.STAGE_PUBLISHED:
+            # It might have died before storing it
+            if cache_key and build_cache.get(cache_key, touch=False) is None:
+                image.store_in_cache(build_cache, cache_key)
+            return image
+
+    if resumed is None:
+        entry = cache_key and build_cache.get(cache_key)
+        if entry:
+            try:
+                image.restore_from_cache(entry)
+                return image
+            except cache.CacheException as e:
+                # Replaced or evicted by another build meanwhile
+                LOGGER.warning('%s, building it', e)
+        if build_journal is not None:
+            build_journal.start(spec.id, spec_digest, handle, version)
 
-    images_to_build = []
-    for spec in specs:
-        spec_obj = spec_cls.from_spec_file(spec)
-        dst_path = os.path.join(repo_dir, spec_obj.name)
-        images_to_build.append(
-            images.get_instance(spec_obj, dst_path)
+    if build_journal is not None:
+        image.checkpoint = functools.partial(
+            build_journal.record, spec.id, image
         )
 
-    for image in images_to_build:
-        image.build()
+    if resumed is None:
+        spec.props['version'] = version
+        image.allocate_workspace()
 
-    createrepo.create_repo_from_metadata(repo_dir, repo_name, base_url)
+        if base_image is not None:
+            # It might have been decompressed to its workspace
+            image.base_image = base_image.ensure_uncompressed()
+
+        image.build(publish=False)
+
+    def _publish():
+        image.publish()
+        if cache_key:
+            image.store_in_cache(build_cache, cache_key)
+        if not keep_uncompressed:
+            image.cleanup()
+
+    if publish_queue is None:
+        _publish()
+    else:
+        publish_queue.submit(spec.id, _publish)
 
+    return image
 
-def resolve_specs(paths):
+
+def resolve_specs(paths, pattern=spec_module.DEFAULT_SPEC_PATTERN):
     """
     Given a list of paths, return the list of specfiles
 
     Args:
         paths (list): paths to look for specs, can be directories or files
+        pattern (str): shell pattern the names of the specs in the
+            directories match, the files given explicitly are always taken,
+            see :func:`spec.is_spec_file`
 
     Returns:
         list: expanded spec file paths
@@ -102,15 +479,55 @@ def resolve_specs(paths):
     specs = []
     for path in paths:
         if os.path.isdir(path):
-            _, _, files = os.walk(path).next()
-            specs.extend(os.path.join(path, fname) for fname in files)
+            _, _, files = next(os.walk(path))
+            specs.extend(
+                os.path.join(path, fname) for fname in sorted(files)
+                if spec_module.is_spec_file(fname, pattern)
+            )
         else:
             specs.append(path)
     return specs
 
 
-def setup_file_log():
-    pass
+def load_specs(specs, repo_format='all', spec_index=None):
+    """
+    Args:
+        specs (list of str): list of spec paths to load
+        repo_format (one of 'all', 'lago', 'virt-builder'): Format the specs
+            have to match
+        spec_index (spec.SpecIndex): Index to get the props of the
+            unchanged specs from, it's saved afterwards
+
+    Returns:
+        list of spec.Spec: the loaded specs
+    """
+    spec_cls = spec_module.get_spec_cls(repo_format)
+    spec_objs = [
+        spec_cls.from_spec_file(spec, index=spec_index) for spec in specs
+    ]
+    if spec_index is not None:
+        LOGGER.debug(
+            'Parsed %d of %d specs, the rest were indexed',
+            spec_index.parsed,
+            len(specs),
+        )
+        spec_index.save()
+
+    return spec_objs
+
+
+def list_specs(spec_objs):
+    """
+    Returns:
+        str: the id, name and base of each spec, one per line
+    """
+    return '\n'.join(
+        '{:<30} {:<30} {}'.format(
+            spec_obj.id,
+            spec_obj.name,
+            getattr(spec_obj, 'base', ''),
+        ) for spec_obj in spec_objs
+    )
 
 
 def main(args):
@@ -170,6 +587,322 @@ def main(args):
         '--create-repo-only', action='store_true',
         help='Only create repo metadata'
     )
+    parser.add_argument(
+        '--full-rescan', action='store_true',
+        help=(
+            'Parse all the image metadata files when creating the repo '
+            'metadata, not only the ones that changed since the last run'
+        )
+    )
+
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=scheduler.default_jobs(),
+        help='Max number of images to build in parallel, default=%(default)s'
+    )
+    parser.add_argument(
+        '--memory-budget', type=int,
+        help=(
+            'Max memory in MiB to use for all the parallel builds, '
+            'default is the host memory'
+        )
+    )
+    parser.add_argument(
+        '--disk-budget', type=int,
+        help=(
+            'Max disk space in GiB to use for all the parallel builds, '
+            'default is the free space on the repo dir'
+        )
+    )
+    parser.add_argument(
+        '--build-memory', type=int, default=scheduler.DEFAULT_BUILD_MEMORY,
+        help='Estimated memory in MiB used by each build, default=%(default)s'
+    )
+    parser.add_argument(
+        '--build-disk', type=int, default=scheduler.DEFAULT_BUILD_DISK,
+        help='Estimated disk in GiB used by each build, default=%(default)s'
+    )
+
+    parser.add_argument(
+        '--scratch-dir',
+        help=(
+            'Path to build the images in, only the published artifacts are '
+            'written to the repo dir, default is a hidden dir of the repo '
+            'dir'
+        )
+    )
+    parser.add_argument(
+        '--no-journal', action='store_true',
+        help=(
+            'Do not journal the build stages of the images in the repo dir, '
+            'by default if a run dies the next one resumes each image from '
+            'its last completed stage'
+        )
+    )
+    parser.add_argument(
+        '--fast-scratch-dir',
+        help=(
+            'Path to build the small images in, like a tmpfs or NVMe mount, '
+            'see --fast-scratch-threshold'
+        )
+    )
+    parser.add_argument(
+        '--fast-scratch-threshold', type=int,
+        default=workspace.DEFAULT_FAST_THRESHOLD,
+        help=(
+            'Max size in GiB of the last published version of the images '
+            'built in --fast-scratch-dir, default=%(default)s'
+        )
+    )
+
+    parser.add_argument(
+        '--cache-dir', default=cache.DEFAULT_CACHE_DIR,
+        help='Path to keep the build cache on, default=%(default)s'
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=cache.DEFAULT_CACHE_SIZE,
+        help=(
+            'Max size in GiB of the build cache, the least recently used '
+            'images are evicted from it when exceeded, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Build all the images, without using the build cache'
+    )
+
+    parser.add_argument(
+        '--single-appliance', action='store_true',
+        help=(
+            'Customize, sysprep and sparsify each image in a single '
+            'libguestfs appliance when possible, requires the libguestfs '
+            'python bindings'
+        )
+    )
+
+    parser.add_argument(
+        '--delta', action='store_true',
+        help=(
+            'Also publish each image as a qcow2 overlay over its newest '
+            'already published version, requires qemu-img'
+        )
+    )
+
+    parser.add_argument(
+        '--seekable', action='store_true',
+        help=(
+            'Compress the images by independent blocks, and publish their '
+            'index in the image metadata, so they can be decompressed in '
+            'parallel or by ranges'
+        )
+    )
+
+    parser.add_argument(
+        '--compression',
+        choices=list(compression.CODECS),
+        default=compression.DEFAULT_CODEC,
+        help=(
+            'Compression to publish the images with, unless their spec has '
+            'a compression prop, only xz is supported by the lago clients, '
+            'default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--compression-level', type=int,
+        help=(
+            'Level of the compression, unless the spec has a '
+            'compression_level prop, default is the one of each codec'
+        )
+    )
+    parser.add_argument(
+        '--compression-threads', type=int, default=0,
+        help=(
+            'Threads to compress each image with, 0 to use all the cpus, '
+            'default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--finalize',
+        choices=images.FINALIZE_MODES,
+        default=images.FINALIZE_COMPRESS,
+        help=(
+            'How to turn the built images into the published ones, unless '
+            'their spec has a finalize prop: sparsify them and compress '
+            'them with --compression, or convert them with qemu-img into '
+            'compressed qcow2 images, that can be used without '
+            'decompressing them, but only by the clients that know about '
+            'them, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--qcow2-compression',
+        choices=images.QCOW2_COMPRESSION_TYPES,
+        default=images.QCOW2_COMPRESSION_TYPES[0],
+        help=(
+            'Compression of the clusters of the images finalized as qcow2, '
+            'unless their spec has a qcow2_compression prop, zstd requires '
+            'qemu 5.1, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--qcow2-coroutines', type=int,
+        default=images.DEFAULT_QCOW2_COROUTINES,
+        help=(
+            'Parallel coroutines of each qcow2 conversion, up to {}, '
+            'default=%(default)s'.format(images.MAX_QCOW2_COROUTINES)
+        )
+    )
+    parser.add_argument(
+        '--layered',
+        choices=images.LAYERED_MODES,
+        default=images.LAYERED_FLATTEN,
+        help=(
+            'How to publish the layered images, unless their spec has a '
+            'layered prop: flattened into standalone images, or as thin '
+            'qcow2 overlays of their base, that has to be a published image '
+            'of the same repo, recorded in their metadata. With overlay, '
+            'the images based on another spec are published as overlays of '
+            'it too, default=%(default)s'
+        )
+    )
+
+    parser.add_argument(
+        '--report-dir',
+        help=(
+            'Dir to write the per image and per run stage metrics reports '
+            'to, default=%(default)s'
+        ),
+        default=metrics.DEFAULT_REPORT_DIR,
+    )
+    parser.add_argument(
+        '--prometheus-textfile',
+        help=(
+            'Also write the stage metrics of the run to this file, in the '
+            'node_exporter textfile collector format'
+        )
+    )
+
+    parser.add_argument(
+        '--base-store-dir', default=basestore.DEFAULT_STORE_DIR,
+        help=(
+            'Path to keep the downloaded and uncompressed base images on, '
+            'default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--base-store-size', type=int, default=basestore.DEFAULT_STORE_SIZE,
+        help=(
+            'Max size in GiB of the base image store, the least recently '
+            'used images are evicted from it when exceeded, '
+            'default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--no-base-store', action='store_true',
+        help='Download or copy the base image for each image'
+    )
+
+    parser.add_argument(
+        '--keep-versions', type=int,
+        help=(
+            'Number of published versions to keep of each image, older ones '
+            'are removed from the repo, default is to keep all of them'
+        )
+    )
+    parser.add_argument(
+        '--keep-days', type=int,
+        help=(
+            'Days to keep the published versions of each image for, with '
+            '--keep-versions a version is kept if either keeps it, the '
+            'newest one is always kept'
+        )
+    )
+
+    parser.add_argument(
+        '--publish-workers', type=int, default=publish.DEFAULT_WORKERS,
+        help=(
+            'Number of built images to compress and publish at the same '
+            'time, while the next ones are built, 0 to publish each image '
+            'right after building it, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--publish-queue-depth', type=int, default=publish.DEFAULT_DEPTH,
+        help=(
+            'Max number of built images waiting to be published, builds '
+            'wait while it is reached, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--spec-pattern', default=spec_module.DEFAULT_SPEC_PATTERN,
+        help=(
+            'Shell pattern the names of the specs in the given dirs match, '
+            'hidden files and editor backups are always skipped, '
+            'default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--spec-index', default=spec_module.DEFAULT_INDEX_PATH,
+        help=(
+            'Path to keep the index of the parsed spec props on, so '
+            'unchanged specs are not parsed again, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--no-spec-index', action='store_true',
+        help='Parse all the specs on each run'
+    )
+    parser.add_argument(
+        '--coordinator', metavar='QUEUE_DIR',
+        help=(
+            'Build the images on the workers of the job queue in this dir, '
+            'it and the repo dir must be shared with them at the same paths'
+        )
+    )
+    parser.add_argument(
+        '--local-workers', type=int, default=0,
+        help=(
+            'With --coordinator, number of workers to run on this host, '
+            'default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--max-attempts', type=int, default=distributed.DEFAULT_MAX_ATTEMPTS,
+        help=(
+            'With --coordinator, times to try to build each image before '
+            'giving up on it, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--heartbeat-timeout', type=int,
+        default=distributed.DEFAULT_HEARTBEAT_TIMEOUT,
+        help=(
+            'With --coordinator, seconds without heartbeats from a worker '
+            'after which its job is queued again, default=%(default)s'
+        )
+    )
+    parser.add_argument(
+        '--worker', metavar='QUEUE_DIR',
+        help=(
+            'Only build the jobs of the job queue in this dir, until its '
+            'coordinator is done'
+        )
+    )
+    parser.add_argument(
+        '--worker-id',
+        help='Unique id of this worker, default is the host name and pid'
+    )
+    parser.add_argument(
+        '--plan', action='store_true',
+        help=(
+            'Only print which images would be built and which restored '
+            'from the build cache, with their estimated duration, disk and '
+            'download size from the metrics of the previous runs'
+        )
+    )
+    parser.add_argument(
+        '--list-specs', action='store_true',
+        help='Only list the id, name and base of the specs'
+    )
     args = parser.parse_args(args)
 
     logging.basicConfig(level=logging.DEBUG)
@@ -186,16 +919,56 @@ def main(args):
 
     LOGGER.debug(args)
 
-    specs_paths = resolve_specs(
-        args.specs or [os.path.join(os.curdir, 'image-specs')]
+    build_cache = None if args.no_cache else cache.BuildCache(
+        cache_dir=args.cache_dir,
+        max_size=args.cache_size * 1024 * 1024 * 1024,
     )
+    base_store = None if args.no_base_store else basestore.BaseImageStore(
+        store_dir=args.base_store_dir,
+        max_size=args.base_store_size * 1024 * 1024 * 1024,
+    )
+    build_workspace = workspace.Workspace(
+        scratch_dir=args.scratch_dir,
+        fast_dir=args.fast_scratch_dir,
+        fast_threshold=args.fast_scratch_threshold * 1024 * 1024 * 1024,
+        default_size=args.build_disk * 1024 * 1024 * 1024,
+    )
+
+    if args.worker:
+        return distributed.run_worker(
+            args.worker,
+            _build_image,
+            worker_id=args.worker_id,
+            build_cache=build_cache,
+            base_store=base_store,
+            build_workspace=build_workspace,
+        )
 
     if args.create_repo_only:
         return createrepo.create_repo_from_metadata(
             repo_dir=args.repo_dir,
             repo_name=args.repo_name,
-            base_url=args.base_url
+            base_url=args.base_url,
+            full_rescan=args.full_rescan,
+            keep_versions=args.keep_versions,
+            keep_days=args.keep_days,
+        )
+
+    specs_paths = resolve_specs(
+        args.specs or [os.path.join(os.curdir, 'image-specs')],
+        pattern=args.spec_pattern,
+    )
+    spec_index = None if args.no_spec_index else spec_module.SpecIndex(
+        index_path=args.spec_index,
+    )
+
+    if args.list_specs:
+        print(
+            list_specs(
+                load_specs(specs_paths, args.repo_format, spec_index)
+            )
         )
+        return
 
     generate_repo(
         specs=specs_paths,
@@ -203,6 +976,75 @@ def main(args):
         base_url=args.base_url,
         repo_name=args.repo_name,
         repo_format=args.repo_format,
+        jobs=args.jobs,
+        memory_budget=args.memory_budget,
+        disk_budget=args.disk_budget,
+        build_memory=args.build_memory,
+        build_disk=args.build_disk,
+        build_cache=build_cache,
+        base_store=base_store,
+        single_appliance=args.single_appliance,
+        publish_delta=args.delta,
+        seekable=args.seekable,
+        compression_name=args.compression,
+        compression_level=args.compression_level,
+        compression_threads=args.compression_threads,
+        finalize=args.finalize,
+        qcow2_compression=args.qcow2_compression,
+        qcow2_coroutines=args.qcow2_coroutines,
+        layered=args.layered,
+        publish_workers=args.publish_workers,
+        publish_depth=args.publish_queue_depth,
+        report_dir=args.report_dir,
+        prometheus_textfile=args.prometheus_textfile,
+        full_rescan=args.full_rescan,
+        keep_versions=args.keep_versions,
+        keep_days=args.keep_days,
+        spec_index=spec_index,
+        plan_only=args.plan,
+        coordinator=_get_coordinator(args),
+        build_workspace=build_workspace,
+        build_journal=None if args.no_journal else journal.Journal(
+            args.repo_dir
+        ),
+    )
+
+
+def _get_coordinator(args):
+    if not args.coordinator:
+        return None
+
+    # The local workers use the same cache and base store as this process
+    worker_args = ['--loglevel', args.loglevel]
+    if args.no_cache:
+        worker_args.append('--no-cache')
+    else:
+        worker_args.extend([
+            '--cache-dir', args.cache_dir,
+            '--cache-size', str(args.cache_size),
+        ])
+    if args.no_base_store:
+        worker_args.append('--no-base-store')
+    else:
+        worker_args.extend([
+            '--base-store-dir', args.base_store_dir,
+            '--base-store-size', str(args.base_store_size),
+        ])
+    worker_args.extend([
+        '--build-disk', str(args.build_disk),
+        '--fast-scratch-threshold', str(args.fast_scratch_threshold),
+    ])
+    if args.scratch_dir:
+        worker_args.extend(['--scratch-dir', args.scratch_dir])
+    if args.fast_scratch_dir:
+        worker_args.extend(['--fast-scratch-dir', args.fast_scratch_dir])
+
+    return distributed.Coordinator(
+        args.coordinator,
+        max_attempts=args.max_attempts,
+        heartbeat_timeout=args.heartbeat_timeout,
+        local_workers=args.local_workers,
+        worker_cmd=distributed.local_worker_cmd(*worker_args),
     )
 
 
@@ -0,0 +1,336 @@
+"""
+Compression codecs the images can be published with
+
+Each codec knows how to compress and decompress a stream with its command
+line tool, as a single stream or by blocks (see :mod:`seekable`), and how
+to recognize its files by their first bytes and their extension. Only xz
+compressed images can be used by the stock lago clients, the rest are meant
+for repos whose clients know about them, through the ``compression`` prop
+of the image metadata.
+
+Blocks are compressed in this process instead, if the python bindings of
+the codec are installed (``lzma`` or ``backports.lzma`` for xz,
+``zstandard`` for zstd, ``zlib`` for gzip), see
+:meth:`Codec.block_compressor`, to not start a process for each block.
+"""
+import functools
+import multiprocessing
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_CODEC = 'xz'
+# Size of the blocks xz splits the stream in, taken from the virt-builder
+# page, it also makes xz compress in parallel
+XZ_BLOCK_SIZE = 16777216
+
+
+class CompressionException(Exception):
+    pass
+
+
+def _find_executable(name):
+    for dir_path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        file_path = os.path.join(dir_path, name)
+        if os.path.isfile(file_path) and os.access(file_path, os.X_OK):
+            return file_path
+
+    return None
+
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class Codec(object):
+    """
+    Attributes:
+        name (str): name of the codec, as used in the specs and metadata
+        ext (str): extension of the files compressed with it
+        exts (tuple of str): all the extensions its files usually have
+        magic (bytes): first bytes of its files
+        default_level (int): level to use if none is given
+        levels (tuple of int): min and max levels
+    """
+    name = None
+    ext = ''
+    exts = ()
+    magic = None
+    default_level = None
+    levels = (None, None)
+
+    def check_level(self, level):
+        """
+        Returns:
+            int: the given level, or the default one if it's None
+
+        Raises:
+            CompressionException: if it's not a valid level of the codec
+        """
+        if level is None:
+            return self.default_level
+
+        level = int(level)
+        if not self.levels[0] <= level <= self.levels[1]:
+            raise CompressionException(
+                'Invalid {} level {}, it must be between {} and {}'.format(
+                    self.name, level, self.levels[0], self.levels[1]
+                )
+            )
+        return level
+
+    def compress_cmd(self, level=None, threads=0):
+        """
+        Args:
+            level (int): compression level, the default one if None
+            threads (int): threads to use, 0 to use all the cpus
+
+        Returns:
+            list of str: command that compresses its stdin into its stdout
+        """
+        raise NotImplementedError('Should be implemented in a subclass')
+
+    def block_compress_cmd(self, block_size, level=None):
+        """
+        Returns:
+            list of str: single threaded command that compresses a block,
+                from its stdin into its stdout, see :mod:`seekable`
+        """
+        raise NotImplementedError('Should be implemented in a subclass')
+
+    def block_compressor(self, block_size, level=None):
+        """
+        Returns:
+            callable or list of str: function that compresses the data of
+                a block in this process, releasing the GIL, or the command
+                to run for each block if the python bindings of the codec
+                are not installed, see :meth:`block_compress_cmd`
+        """
+        return self.block_compress_cmd(block_size, level)
+
+    def decompress_cmd(self, threads=0):
+        """
+        Returns:
+            list of str: command that decompresses its stdin into its
+                stdout
+        """
+        raise NotImplementedError('Should be implemented in a subclass')
+
+
+class XzCodec(Codec):
+    name = 'xz'
+    ext = '.xz'
+    exts = ('.xz', )
+    magic = b'\xfd7zXZ\x00'
+    default_level = 9
+    levels = (0, 9)
+
+    def compress_cmd(self, level=None, threads=0):
+        return [
+            'xz',
+            '--compress',
+            '--threads={}'.format(threads),
+            '-{}'.format(self.check_level(level)),
+            '--block-size={}'.format(XZ_BLOCK_SIZE),
+            '--stdout',
+        ]
+
+    def block_compress_cmd(self, block_size, level=None):
+        # No bigger dictionary than the block itself, it'd only waste memory
+        return [
+            'xz',
+            '--compress',
+            '--stdout',
+            '--threads=1',
+            '--lzma2=preset={},dict={}'.format(
+                self.check_level(level), max(block_size, 4096)
+            ),
+        ]
+
+    def block_compressor(self, block_size, level=None):
+        if lzma is None:
+            return self.block_compress_cmd(block_size, level)
+
+        # The same stream the block command writes
+        return functools.partial(
+            lzma.compress,
+            format=lzma.FORMAT_XZ,
+            check=lzma.CHECK_CRC64,
+            filters=[{
+                'id': lzma.FILTER_LZMA2,
+                'preset': self.check_level(level),
+                'dict_size': max(block_size, 4096),
+            }],
+        )
+
+    def decompress_cmd(self, threads=0):
+        return [
+            'xz',
+            '--decompress',
+            '--threads={}'.format(threads),
+            '--stdout',
+        ]
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    ext = '.zst'
+    exts = ('.zst', '.zstd')
+    magic = b'\x28\xb5\x2f\xfd'
+    default_level = 3
+    levels = (1, 22)
+
+    def _level_args(self, level):
+        level = self.check_level(level)
+        args = ['-{}'.format(level)]
+        if level > 19:
+            args.insert(0, '--ultra')
+        return args
+
+    def compress_cmd(self, level=None, threads=0):
+        return (
+            ['zstd', '--quiet', '--stdout', '-T{}'.format(threads)]
+            + self._level_args(level)
+        )
+
+    def block_compress_cmd(self, block_size, level=None):
+        return ['zstd', '--quiet', '--stdout'] + self._level_args(level)
+
+    def block_compressor(self, block_size, level=None):
+        if zstandard is None:
+            return self.block_compress_cmd(block_size, level)
+
+        level = self.check_level(level)
+        # The compressors can't be shared by threads
+        local = threading.local()
+
+        def _compress(data):
+            if not hasattr(local, 'compressor'):
+                local.compressor = zstandard.ZstdCompressor(level=level)
+            return local.compressor.compress(data)
+
+        return _compress
+
+    def decompress_cmd(self, threads=0):
+        return ['zstd', '--decompress', '--quiet', '--stdout']
+
+
+class GzipCodec(Codec):
+    """
+    Uses pigz if it's installed, gzip otherwise
+    """
+    name = 'gzip'
+    ext = '.gz'
+    exts = ('.gz', '.tgz')
+    magic = b'\x1f\x8b'
+    default_level = 6
+    levels = (1, 9)
+
+    def compress_cmd(self, level=None, threads=0):
+        level_arg = '-{}'.format(self.check_level(level))
+        if _find_executable('pigz'):
+            return [
+                'pigz',
+                '--processes', str(threads or _cpu_count()),
+                level_arg,
+                '--stdout',
+            ]
+
+        return ['gzip', level_arg, '--stdout']
+
+    def block_compress_cmd(self, block_size, level=None):
+        # Concatenated gzip members are a valid gzip file too
+        return ['gzip', '-{}'.format(self.check_level(level)), '--stdout']
+
+    def block_compressor(self, block_size, level=None):
+        level = self.check_level(level)
+
+        def _compress(data):
+            # A gzip member, as the block command writes
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+
+        return _compress
+
+    def decompress_cmd(self, threads=0):
+        return ['gzip', '--decompress', '--stdout']
+
+
+class NoCodec(Codec):
+    """
+    The image is published uncompressed
+    """
+    name = 'none'
+
+    def check_level(self, level):
+        return None
+
+
+CODECS = OrderedDict(
+    (codec.name, codec)
+    for codec in (XzCodec(), ZstdCodec(), GzipCodec(), NoCodec())
+)
+
+
+def get_codec(name=None):
+    """
+    Args:
+        name (str): name of the codec, the default one if None
+
+    Returns:
+        Codec: the codec with that name
+
+    Raises:
+        CompressionException: if there's no such codec
+    """
+    name = name or DEFAULT_CODEC
+    if name not in CODECS:
+        raise CompressionException(
+            'Unknown compression {}, it must be one of {}'.format(
+                name, ', '.join(CODECS)
+            )
+        )
+
+    return CODECS[name]
+
+
+def compressed_codecs():
+    """
+    Returns:
+        list of Codec: the codecs that actually compress
+    """
+    return [codec for codec in CODECS.values() if codec.magic]
+
+
+def codec_from_ext(file_path):
+    """
+    Returns:
+        Codec or None: the codec matching the extension of file_path
+    """
+    for codec in compressed_codecs():
+        for ext in codec.exts:
+            if file_path.endswith(ext):
+                return codec
+
+    return None
+
+
+# Extensions of all the compressed artifacts an image can have
+ARTIFACT_EXTS = tuple(codec.ext for codec in compressed_codecs())
@@ -1,5 +1,44 @@
+"""
+Lago repo metadata of a dir of published images
+
+Each build of an image is published under its own handle,
+``<name>-<version>``, and its files (see :data:`ARTIFACT_SUFFIXES`) are
+never modified afterwards, so clients that got an older handle from the
+repo metadata can still download it. The ``latest`` version of each
+template points to its newest build, and is switched atomically by
+replacing the whole repo.metadata file.
+
+Versions published with a delta advertise it in their ``delta`` key, with
+the handle of the version it applies on, see
+:meth:`images.Image.create_delta`. Versions published as thin overlays
+declare the published image they need in their ``backing`` key, see
+:data:`images.LAYERED_MODES`.
+"""
+import errno
+import fcntl
+import logging
 import os
 import json
+import time
+
+import compression
+
+LOGGER = logging.getLogger(__name__)
+
+REPO_METADATA = 'repo.metadata'
+# Stat and parsed entry of each image metadata file, from the last run
+MANIFEST = '.repo.manifest'
+LATEST = 'latest'
+# Compressed qcow2 overlay of an image on top of an older version, its
+# handle is the one of the image plus .delta
+DELTA_SUFFIX = '.delta.xz'
+# Files of each published image, the .metadata one must be the last, it's
+# what makes the others part of the repo
+ARTIFACT_SUFFIXES = ('', ) + compression.ARTIFACT_EXTS + (
+    '.hash',
+    DELTA_SUFFIX,
+    '.metadata',
+)
 
 
 class Spec(object):
@@ -27,7 +66,15 @@ class Spec(object):
         templates = self.get_templates()
         templates[name] = {'versions': {}}
 
-    def add_version(self, template, version, handle, timestamp):
+    def add_version(
+        self,
+        template,
+        version,
+        handle,
+        timestamp,
+        delta=None,
+        backing=None,
+    ):
         if not self.has_template(template):
             self.add_template(template)
 
@@ -37,46 +84,329 @@ class Spec(object):
             'handle': handle,
             'timestamp': timestamp
         }
+        if delta is not None:
+            templates[template]['versions'][version]['delta'] = delta
+        if backing is not None:
+            templates[template]['versions'][version]['backing'] = backing
+
+    def add_latest_versions(self):
+        """
+        Points the latest version of each template to its newest one,
+        unless there's a version actually named latest
+        """
+        for template in self.get_templates().values():
+            versions = template['versions']
+            if not versions or LATEST in versions:
+                continue
+
+            versions[LATEST] = dict(
+                max(
+                    versions.values(),
+                    key=lambda version: version['timestamp'],
+                )
+            )
 
     def dump(self, file_name):
-        with open(file_name, 'w') as fd:
-            fd.write(json.dumps(self.spec, indent=2))
+        _dump_atomic(file_name, json.dumps(self.spec, indent=2))
+
+
+def version_handle(name, version):
+    """
+    Returns:
+        str: handle to publish the given version of an image as, the file
+            names of its artifacts are based on it
+    """
+    return '{}-{}'.format(name, version)
+
+
+def is_published(repo_dir, handle):
+    return os.path.exists(os.path.join(repo_dir, handle + '.metadata'))
+
+
+def _metadata_stat(file_path):
+    stat = os.stat(file_path)
+    return {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'inode': stat.st_ino,
+    }
+
+
+def _parse_metadata(file_path, file_name):
+    with open(file_path, 'r') as f:
+        spec = json.load(f)
+
+    handle = file_name.rsplit('.', 1)[0]
+    entry = {
+        'template': spec['name'],
+        # Images published before they had versions
+        'version': spec.get('version') or handle,
+        'handle': handle,
+        'timestamp': spec['timestamp'],
+    }
+    if spec.get('delta_base'):
+        entry['delta'] = {
+            'handle': handle + '.delta',
+            'base': spec['delta_base'],
+            'base_version': spec['delta_base_version'],
+            'size': spec['delta_compressed_size'],
+            'sha1': spec['delta_compressed_sha1'],
+        }
+    if spec.get('backing_handle'):
+        entry['backing'] = {
+            'handle': spec['backing_handle'],
+            'sha1': spec['backing_sha1'],
+            'checksum': spec['backing_checksum'],
+        }
+
+    return entry
+
+
+def _scan_metadata(repo_dir, old_manifest):
+    """
+    Returns:
+        tuple(dict, int): the manifest entry of each image metadata file in
+            repo_dir, and how many of them had to be parsed again
+    """
+    manifest = {}
+    parsed = 0
+    for file_name in sorted(os.listdir(repo_dir)):
+        if not file_name.endswith('.metadata') or file_name == REPO_METADATA:
+            continue
+
+        file_path = os.path.join(repo_dir, file_name)
+        if not os.path.isfile(file_path):
+            continue
+
+        stat = _metadata_stat(file_path)
+        old_entry = old_manifest.get(file_name)
+        if old_entry is not None and old_entry['stat'] == stat:
+            manifest[file_name] = old_entry
+            continue
+
+        manifest[file_name] = {
+            'stat': stat,
+            'entry': _parse_metadata(file_path, file_name),
+        }
+        parsed += 1
+
+    return manifest, parsed
+
+
+def published_versions(repo_dir, template):
+    """
+    Args:
+        repo_dir (str): Repo to look in
+        template (str): Name of the template
+
+    Returns:
+        list of dict: parsed metadata of the published versions of the
+            template, newest first
+    """
+    manifest, _ = _scan_metadata(
+        repo_dir, _load_manifest(os.path.join(repo_dir, MANIFEST))
+    )
+    versions = [
+        manifest_entry['entry'] for manifest_entry in manifest.values()
+        if manifest_entry['entry']['template'] == template
+    ]
+    versions.sort(key=lambda entry: entry['timestamp'], reverse=True)
+    return versions
+
+
+def newest_published_props(repo_dir, template):
+    """
+    Args:
+        repo_dir (str): Repo to look in
+        template (str): Name of the template
 
+    Returns:
+        dict or None: metadata of the newest published version of the
+            template, None if there's none
+    """
+    if not os.path.isdir(repo_dir):
+        return None
+
+    versions = published_versions(repo_dir, template)
+    if not versions:
+        return None
+
+    with open(
+        os.path.join(repo_dir, versions[0]['handle'] + '.metadata')
+    ) as metadata_fd:
+        return json.load(metadata_fd)
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as manifest_fd:
+            return json.load(manifest_fd)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _dump_atomic(file_name, content):
+    tmp_file = file_name + '.tmp'
+    with open(tmp_file, 'w') as fd:
+        fd.write(content)
+    os.rename(tmp_file, file_name)
+
+
+def select_expired(entries, keep_versions=None, keep_days=None, now=None):
+    """
+    Applies the retention policy to the published versions of the images
+
+    A version is kept if it's one of the ``keep_versions`` newest of its
+    template, or if it was built in the last ``keep_days`` days. The newest
+    version of each template is always kept, and so are the versions the
+    kept ones are overlays of.
+
+    Args:
+        entries (dict of str: dict): parsed metadata of each published
+            version, by metadata file name
+        keep_versions (int): Number of versions to keep of each template
+        keep_days (int): Days to keep the versions for
+
+    Returns:
+        list of str: the metadata file names of the expired versions
+    """
+    if keep_versions is None and keep_days is None:
+        return []
+
+    if now is None:
+        now = time.time()
+
+    by_template = {}
+    for file_name, entry in entries.items():
+        by_template.setdefault(entry['template'], []).append(
+            (entry['timestamp'], file_name)
+        )
+
+    expired = []
+    for versions in by_template.values():
+        versions.sort(reverse=True)
+        for index, (timestamp, file_name) in enumerate(versions):
+            if index == 0:
+                continue
+            if keep_versions is not None and index < keep_versions:
+                continue
+            if (
+                keep_days is not None
+                and now - timestamp < keep_days * 24 * 60 * 60
+            ):
+                continue
+            expired.append(file_name)
+
+    return sorted(_keep_backings(entries, set(expired)))
+
+
+def _keep_backings(entries, expired):
+    by_handle = dict(
+        (entry['handle'], file_name) for file_name, entry in entries.items()
+    )
+    pending = [
+        entry for file_name, entry in entries.items()
+        if file_name not in expired
+    ]
+    while pending:
+        backing = pending.pop().get('backing')
+        file_name = backing and by_handle.get(backing['handle'])
+        if file_name in expired:
+            expired.remove(file_name)
+            pending.append(entries[file_name])
 
-def create_repo_from_metadata(repo_dir, repo_name, base_url):
+    return expired
+
+
+def _remove_artifacts(repo_dir, handle):
+    for suffix in ARTIFACT_SUFFIXES:
+        file_path = os.path.join(repo_dir, handle + suffix)
+        try:
+            os.unlink(file_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def create_repo_from_metadata(
+    repo_dir,
+    repo_name,
+    base_url,
+    full_rescan=False,
+    keep_versions=None,
+    keep_days=None,
+):
     """
     Generates the json metadata file for this repo, as needed to be used by the
     lago clients
 
+    Only the image .metadata files that changed since the last run (by
+    mtime, size and inode, as kept in the .repo.manifest file) are parsed
+    again, the rest are taken from the manifest.
+
+    The versions expired by the retention policy, if any, are left out of
+    the new repo metadata, and their files removed once it's in place.
+
     Args:
         repo_dir (str): Repo to generate the metadata file for
         repo_name (str): Name of this repo
         url (str): External URL for this repo
+        full_rescan (bool): Ignore the manifest and parse all the metadata
+            files
+        keep_versions (int): Number of versions to keep of each template,
+            see :func:`select_expired`
+        keep_days (int): Days to keep the versions of each template for,
+            see :func:`select_expired`
 
     Returns:
         None
     """
+    dst_file = os.path.join(repo_dir, REPO_METADATA)
+    manifest_path = os.path.join(repo_dir, MANIFEST)
 
-    repo_metadata = Spec(repo_name, base_url)
-    dst_file = os.path.join(repo_dir, 'repo.metadata')
-
-    _, _, files = os.walk(repo_dir).next()
-
-    for file_name in files:
-        if not file_name.endswith('.metadata'):
-            continue
+    with open(manifest_path + '.lock', 'a') as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        old_manifest = {} if full_rescan else _load_manifest(manifest_path)
+        manifest, parsed = _scan_metadata(repo_dir, old_manifest)
+        LOGGER.debug(
+            'Parsed %d of %d metadata files of %s',
+            parsed,
+            len(manifest),
+            repo_dir,
+        )
 
-        with open(os.path.join(repo_dir, file_name), 'r') as f:
-            spec = json.load(f)
+        expired = select_expired(
+            dict(
+                (file_name, manifest_entry['entry'])
+                for file_name, manifest_entry in manifest.items()
+            ),
+            keep_versions=keep_versions,
+            keep_days=keep_days,
+        )
+        for file_name in expired:
+            del manifest[file_name]
 
-        repo_metadata.add_version(
-            template=spec['name'],
-            version=spec['version'],
-            handle=file_name.rsplit('.', 1)[0],
-            timestamp=spec['timestamp']
+        handles = set(
+            manifest_entry['entry']['handle']
+            for manifest_entry in manifest.values()
         )
+        repo_metadata = Spec(repo_name, base_url)
+        for file_name in sorted(manifest):
+            entry = dict(manifest[file_name]['entry'])
+            # A delta is of no use once its base is gone
+            if entry.get('delta') and entry['delta']['base'] not in handles:
+                del entry['delta']
+            repo_metadata.add_version(**entry)
+        repo_metadata.add_latest_versions()
+
+        repo_metadata.dump(dst_file)
+        _dump_atomic(manifest_path, json.dumps(manifest))
 
-    repo_metadata.dump(dst_file)
+        # Only once no repo metadata points to them anymore
+        for file_name in expired:
+            handle = file_name.rsplit('.', 1)[0]
+            LOGGER.info('Pruning expired image %s', handle)
+            _remove_artifacts(repo_dir, handle)
 
 
 def generate_virt_builder_repo_metadata(repo_dir, images):
@@ -105,7 +435,7 @@ def generate_virt_builder_repo_metadata(repo_dir, images):
 def generate_lago_repo_metadata(repo_dir, repo_name, url):
     """
     Generates the json metadata file for this repo, as needed to be used by the
-    lago clients
+    lago clients, with all the published versions of each image
 
     Args:
         repo_dir (str): Repo to generate the metadata file for
@@ -115,37 +445,4 @@ def generate_lago_repo_metadata(repo_dir, repo_name, url):
     Returns:
         None
     """
-    templates = {}
-    metadata = {
-        'name': repo_name,
-        'templates': templates,
-    }
-    _, _, files = os.walk(repo_dir).next()
-    for file_name in files:
-        if not file_name.endswith('.xz'):
-            continue
-        name = file_name.rsplit('.', 1)[0]
-        templates[name] = {
-            "versions": {
-                "latest": {
-                    "source": repo_name,
-                    "handle": file_name.rsplit('.', 1)[0],
-                    "timestamp": os.stat(
-                        os.path.join(repo_dir, file_name)
-                    ).st_mtime,
-                },
-            },
-        }
-
-    metadata['sources'] = {
-        repo_name: {
-            "args": {
-                "baseurl": url,
-            },
-            "type": "http"
-        }
-    }
-
-    with open(os.path.join(repo_dir, 'repo.metadata'), 'w') as fd:
-        fd.write(json.dumps(metadata))
-
+    create_repo_from_metadata(repo_dir, repo_name, url)
@@ -0,0 +1,748 @@
+"""
+Distributed builds through a job queue on a shared filesystem
+
+The coordinator (see :class:`Coordinator`) runs the spec DAG the same as a
+local build, but instead of building each image it puts a job for it in
+the queue dir and waits for its result. Workers (see :func:`run_worker`),
+on this or other hosts that mount the queue and repo dirs at the same
+paths, claim the jobs, build and publish the images right into the repo
+dir, and write back their stage metrics. The coordinator generates the
+repo metadata once all of them are done.
+
+Layout of the queue dir::
+
+    specs/<spec id>                   copies of the specs being built
+    pending/<spec id>.json            jobs waiting for a worker
+    claimed/<spec id>@<worker>.json   jobs being built, their mtime is the
+                                      heartbeat of the worker
+    results/<spec id>.json            results of the finished jobs
+    locks/                            locks shared by the workers
+    stop                              tells the workers to exit once idle
+
+A job is claimed by renaming it from pending to claimed, which is atomic,
+so each job is built by a single worker. If a worker dies, its claim stops
+getting heartbeats, and the coordinator queues the job again, the same as
+the jobs that failed, up to a max number of attempts. A worker that lost
+its claim, as it stalled for too long, aborts its job before publishing
+it, so it never publishes the image the next attempt is building.
+"""
+import errno
+import fcntl
+import functools
+import glob
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from lago import log_utils
+
+import images
+import metrics
+import scheduler
+import spec as spec_module
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_HEARTBEAT_INTERVAL = 10
+# A claim without heartbeats for this long belongs to a dead worker
+DEFAULT_HEARTBEAT_TIMEOUT = 120
+
+DONE = 'done'
+FAILED = 'failed'
+
+# Image options that are sent along with the jobs, the rest, like the base
+# image store, are set up by each worker
+JOB_IMAGE_OPTS = (
+    'single_appliance',
+    'publish_delta',
+    'seekable',
+    'compression_name',
+    'compression_level',
+    'compression_threads',
+    'finalize',
+    'qcow2_compression',
+    'qcow2_coroutines',
+    'layered',
+)
+
+
+class DistributedBuildException(Exception):
+    pass
+
+
+class ClaimLostException(DistributedBuildException):
+    pass
+
+
+def _makedirs(dir_path):
+    try:
+        os.makedirs(dir_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _dump_json(file_path, data):
+    tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+    with open(tmp_path, 'w') as json_fd:
+        json.dump(data, json_fd)
+    os.rename(tmp_path, file_path)
+
+
+def _load_json(file_path):
+    try:
+        with open(file_path) as json_fd:
+            return json.load(json_fd)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Claim(object):
+    def __init__(self, path, job, worker_id):
+        self.path = path
+        self.job = job
+        self.worker_id = worker_id
+
+    def heartbeat(self):
+        """
+        Returns:
+            bool: If the claim is still held, False if the coordinator gave
+                the job to another worker
+        """
+        try:
+            os.utime(self.path, None)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+        return True
+
+
+class JobQueue(object):
+    """
+    The queue dir, see the module docs
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.specs_dir = os.path.join(queue_dir, 'specs')
+        self.pending_dir = os.path.join(queue_dir, 'pending')
+        self.claimed_dir = os.path.join(queue_dir, 'claimed')
+        self.results_dir = os.path.join(queue_dir, 'results')
+        self.locks_dir = os.path.join(queue_dir, 'locks')
+        self.stop_path = os.path.join(queue_dir, 'stop')
+        for dir_path in (
+            self.specs_dir,
+            self.pending_dir,
+            self.claimed_dir,
+            self.results_dir,
+            self.locks_dir,
+        ):
+            _makedirs(dir_path)
+
+    def reset(self):
+        """
+        Drops the jobs and results of any previous run
+        """
+        for dir_path in (
+            self.pending_dir, self.claimed_dir, self.results_dir
+        ):
+            for file_name in os.listdir(dir_path):
+                os.unlink(os.path.join(dir_path, file_name))
+
+        if os.path.exists(self.stop_path):
+            os.unlink(self.stop_path)
+
+    def add_spec(self, spec_file):
+        dst = os.path.join(self.specs_dir, os.path.basename(spec_file))
+        shutil.copyfile(spec_file, dst + '.tmp')
+        os.rename(dst + '.tmp', dst)
+        return dst
+
+    def spec_path(self, spec_id):
+        return os.path.join(self.specs_dir, spec_id)
+
+    def submit(self, job):
+        _dump_json(
+            os.path.join(self.pending_dir, job['id'] + '.json'), job
+        )
+
+    def claim(self, worker_id):
+        """
+        Returns:
+            Claim or None: the oldest pending job, now claimed by the given
+                worker, None if there are no pending jobs
+        """
+        pending = sorted(
+            (os.path.join(self.pending_dir, file_name)
+             for file_name in os.listdir(self.pending_dir)
+             if file_name.endswith('.json')),
+            key=lambda job_path: _mtime(job_path) or 0,
+        )
+        for job_path in pending:
+            job_id = os.path.basename(job_path)[:-len('.json')]
+            claim_path = os.path.join(
+                self.claimed_dir, '{}@{}.json'.format(job_id, worker_id)
+            )
+            try:
+                # The mtime of the claim is its heartbeat, so it has to be
+                # fresh before the coordinator can see it
+                os.utime(job_path, None)
+                os.rename(job_path, claim_path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # Claimed by another worker
+                    continue
+                raise
+
+            job = _load_json(claim_path)
+            if job is None:
+                LOGGER.error('Dropping unreadable job %s', claim_path)
+                os.unlink(claim_path)
+                continue
+
+            return Claim(claim_path, job, worker_id)
+
+        return None
+
+    def complete(self, claim, result):
+        """
+        Writes the result of a claimed job, unless the claim was lost
+
+        Returns:
+            bool: If the result was written
+        """
+        if not os.path.exists(claim.path):
+            return False
+
+        _dump_json(
+            os.path.join(self.results_dir, claim.job['id'] + '.json'),
+            result,
+        )
+        os.unlink(claim.path)
+        return True
+
+    def pop_result(self, job_id):
+        """
+        Returns:
+            dict or None: the result of the job, it's removed from the
+                queue
+        """
+        result_path = os.path.join(self.results_dir, job_id + '.json')
+        result = _load_json(result_path)
+        if result is not None:
+            os.unlink(result_path)
+        return result
+
+    def withdraw(self, job_id):
+        """
+        Removes the pending job and its claims, the workers that claimed it
+        abort it before publishing it
+        """
+        for job_path in [
+            os.path.join(self.pending_dir, job_id + '.json')
+        ] + self.claims(job_id):
+            try:
+                os.unlink(job_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def claims(self, job_id):
+        return glob.glob(os.path.join(self.claimed_dir, job_id + '@*.json'))
+
+    def drop_stale_claims(self, job_id, timeout):
+        """
+        Removes the claims of the job whose worker stopped sending
+        heartbeats
+
+        Returns:
+            list of str: the workers that held them
+        """
+        workers = []
+        for claim_path in self.claims(job_id):
+            mtime = _mtime(claim_path)
+            if mtime is None or time.time() - mtime < timeout:
+                continue
+            try:
+                os.unlink(claim_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            workers.append(
+                os.path.basename(claim_path)[:-len('.json')].split('@', 1)[1]
+            )
+
+        return workers
+
+    def stop(self):
+        open(self.stop_path, 'w').close()
+
+    def stopped(self):
+        return os.path.exists(self.stop_path)
+
+    @contextmanager
+    def lock(self, name):
+        """
+        Lock shared by all the workers, by name
+        """
+        lock_path = os.path.join(self.locks_dir, name + '.lock')
+        with open(lock_path, 'a') as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+
+def _mtime(file_path):
+    try:
+        return os.stat(file_path).st_mtime
+    except OSError:
+        return None
+
+
+def _recorder_from_result(result):
+    recorder = metrics.StageRecorder(result['id'])
+    for stage in result.get('stages') or []:
+        recorder.add(**stage)
+    return recorder
+
+
+class Coordinator(object):
+    def __init__(
+        self,
+        queue_dir,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        local_workers=0,
+        worker_cmd=None,
+    ):
+        """
+        Args:
+            queue_dir (str): Path of the queue dir, shared with the workers
+            max_attempts (int): Times to try to build each image, on any
+                worker, before giving up on it
+            heartbeat_timeout (int): Seconds without heartbeats after which
+                a worker is considered dead, and its job queued again
+            poll_interval (int): Seconds between checks for results
+            local_workers (int): Number of workers to run on this host, as
+                separate processes, they are started again if they die
+            worker_cmd (list of str): Command that runs a worker, the queue
+                dir and worker id options are appended to it
+        """
+        self.queue = JobQueue(queue_dir)
+        self.max_attempts = max(1, max_attempts)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.poll_interval = poll_interval
+        self.local_workers = local_workers
+        self.worker_cmd = worker_cmd
+        self.recorders = []
+        self._lock = threading.Lock()
+        self._processes = {}
+        self._stopping = False
+
+    def budget(self, nodes):
+        """
+        Returns:
+            scheduler.ResourceBudget: budget that lets every ready node be
+                queued, the workers take them at their own pace
+        """
+        return scheduler.ResourceBudget(
+            jobs=max(1, len(nodes)),
+            memory=sum(node.memory for node in nodes),
+            disk=sum(node.disk for node in nodes),
+        )
+
+    def start(self):
+        self.queue.reset()
+        self._stopping = False
+        for index in range(self.local_workers):
+            self._start_local_worker('local-{}-{}'.format(os.getpid(), index))
+
+    def stop(self):
+        """
+        Tells the workers to exit once idle, and waits for the local ones
+        """
+        with self._lock:
+            self._stopping = True
+        self.queue.stop()
+        for process in self._processes.values():
+            process.wait()
+
+    def _start_local_worker(self, worker_id):
+        LOGGER.debug('Starting local worker %s', worker_id)
+        self._processes[worker_id] = subprocess.Popen(
+            self.worker_cmd + [
+                '--worker', self.queue.queue_dir,
+                '--worker-id', worker_id,
+            ]
+        )
+
+    def _check_local_workers(self):
+        with self._lock:
+            if self._stopping:
+                return
+            for worker_id, process in list(self._processes.items()):
+                if process.poll() is not None:
+                    LOGGER.warning(
+                        'Local worker %s exited with %s, starting it again',
+                        worker_id,
+                        process.returncode,
+                    )
+                    self._start_local_worker(worker_id)
+
+    def build_action(
+        self,
+        spec_obj,
+        repo_dir,
+        repo_format,
+        run_version,
+        image_opts=None,
+    ):
+        """
+        Returns:
+            callable: scheduler action that builds the image of the spec on
+                a worker, see :func:`dispatch`
+        """
+        self.queue.add_spec(spec_obj.commands_file)
+        job = {
+            'id': spec_obj.id,
+            'repo_dir': os.path.abspath(repo_dir),
+            'repo_format': repo_format,
+            'run_version': run_version,
+            'image_opts': dict(
+                (key, value) for key, value in (image_opts or {}).items()
+                if key in JOB_IMAGE_OPTS
+            ),
+            'base': None,
+            'attempt': 0,
+        }
+        return functools.partial(self.dispatch, job)
+
+    def dispatch(self, job, base_result=None):
+        """
+        Queues the job and waits for a worker to build it, queuing it again
+        if it fails or its worker dies, up to max_attempts times
+
+        Args:
+            job (dict): the job to build
+            base_result (dict): result of the job of its base spec, if it
+                has one
+
+        Returns:
+            dict: the result of the job
+
+        Raises:
+            DistributedBuildException: if all the attempts failed
+        """
+        job = dict(job)
+        if base_result is not None:
+            job['base'] = {
+                'id': base_result['id'],
+                'image': base_result['image'],
+            }
+
+        errors = []
+        for attempt in range(self.max_attempts):
+            job['attempt'] = attempt
+            self.queue.submit(job)
+            result = self._wait(job)
+            if result.get('stages'):
+                with self._lock:
+                    self.recorders.append(_recorder_from_result(result))
+            if result['status'] == DONE:
+                LOGGER.info(
+                    'Worker %s built %s', result['worker'], job['id']
+                )
+                return result
+
+            errors.append(
+                '{}: {}'.format(result['worker'], result.get('error'))
+            )
+            LOGGER.warning(
+                'Attempt %d of %s failed on %s: %s',
+                attempt + 1,
+                job['id'],
+                result['worker'],
+                result.get('error'),
+            )
+
+        raise DistributedBuildException(
+            'Failed to build {} after {} attempts: {}'.format(
+                job['id'], self.max_attempts, '; '.join(errors)
+            )
+        )
+
+    def _wait(self, job):
+        while True:
+            result = self.queue.pop_result(job['id'])
+            if result is not None:
+                if result.get('attempt') == job['attempt']:
+                    return result
+                if result['status'] == DONE:
+                    # Completed right as it was queued again, its image is
+                    # already published
+                    LOGGER.info(
+                        'Attempt %d of %s completed late, using it',
+                        result['attempt'] + 1,
+                        job['id'],
+                    )
+                    self.queue.withdraw(job['id'])
+                    return result
+                LOGGER.debug('Ignoring outdated result of %s', job['id'])
+
+            dead_workers = self.queue.drop_stale_claims(
+                job['id'], self.heartbeat_timeout
+            )
+            if dead_workers:
+                return {
+                    'id': job['id'],
+                    'attempt': job['attempt'],
+                    'worker': dead_workers[0],
+                    'status': FAILED,
+                    'error': 'no heartbeat for {}s'.format(
+                        self.heartbeat_timeout
+                    ),
+                }
+
+            if self.local_workers:
+                self._check_local_workers()
+            time.sleep(self.poll_interval)
+
+
+class _Heartbeat(object):
+    def __init__(self, claim, interval):
+        self.claim = claim
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='heartbeat-' + claim.job['id']
+        )
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.claim.heartbeat():
+                LOGGER.warning(
+                    'Lost the claim of %s, aborting it',
+                    self.claim.job['id'],
+                )
+                self.lost = True
+                return
+
+    def check(self):
+        """
+        Raises:
+            ClaimLostException: if the claim was lost, so the job must not
+                be published, another worker is building it
+        """
+        if self.lost or not self.claim.heartbeat():
+            self.lost = True
+            raise ClaimLostException(
+                'Lost the claim of {}'.format(self.claim.job['id'])
+            )
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+class _ClaimedPublish(object):
+    """
+    Publishes the images of a job right away, as long as its claim is held,
+    see :class:`publish.PublishQueue`
+    """
+
+    def __init__(self, heartbeat, started_images):
+        self.heartbeat = heartbeat
+        self.started_images = started_images
+
+    def submit(self, spec_id, publish):
+        self.heartbeat.check()
+        self.started_images[spec_id].checkpoint = self._checkpoint
+        publish()
+
+    def _checkpoint(self, stage):
+        # Checked again once compressed, before writing its metadata, which
+        # is what publishes it
+        if stage != images.STAGE_PUBLISHED:
+            self.heartbeat.check()
+
+
+def _load_base_image(queue, spec_cls, job, build_workspace):
+    base = job['base']
+    base_spec = spec_cls.from_spec_file(queue.spec_path(base['id']))
+    uncompressed_image_path = os.path.join(job['repo_dir'], base['image'])
+    base_image = images.get_instance(
+        base_spec,
+        uncompressed_image_path,
+        base='simple:' + uncompressed_image_path,
+        workspace=build_workspace,
+    )
+    base_image.load_published(uncompressed_image_path)
+    # The children of the same base might be built by several workers
+    with queue.lock(base['image']):
+        base_image.ensure_uncompressed()
+    return base_image
+
+
+def _run_job(
+    queue,
+    claim,
+    heartbeat,
+    build_image,
+    build_cache,
+    base_store,
+    build_workspace,
+):
+    job = claim.job
+    spec_cls = spec_module.get_spec_cls(job['repo_format'])
+    started_images = OrderedDict()
+    result = {
+        'id': job['id'],
+        'attempt': job['attempt'],
+        'worker': claim.worker_id,
+    }
+    base_image = None
+    try:
+        spec_obj = spec_cls.from_spec_file(queue.spec_path(job['id']))
+        if job['base']:
+            base_image = _load_base_image(
+                queue, spec_cls, job, build_workspace
+            )
+
+        image_opts = dict(job['image_opts'])
+        image_opts['base_store'] = base_store
+        image_opts['workspace'] = build_workspace
+        image = build_image(
+            spec_obj,
+            job['repo_dir'],
+            job['run_version'],
+            build_cache,
+            image_opts,
+            started_images,
+            _ClaimedPublish(heartbeat, started_images),
+            base_image,
+        )
+        result['status'] = DONE
+        result['image'] = os.path.relpath(
+            image.uncompressed_image_path, job['repo_dir']
+        )
+    except Exception as e:
+        LOGGER.exception('Failed to build %s', job['id'])
+        result['status'] = FAILED
+        result['error'] = str(e)
+    finally:
+        # The images based on this one decompress it on their own
+        for image in list(started_images.values()) + [base_image]:
+            if image is not None:
+                image.cleanup()
+
+    if job['id'] in started_images:
+        result['stages'] = [
+            stage.to_dict() for stage in started_images[job['id']].metrics
+            .stages
+        ]
+
+    return result
+
+
+def run_worker(
+    queue_dir,
+    build_image,
+    worker_id=None,
+    build_cache=None,
+    base_store=None,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+    heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+    build_workspace=None,
+):
+    """
+    Builds the jobs of the queue, one at a time, until the coordinator
+    tells the workers to stop
+
+    Args:
+        queue_dir (str): Path of the queue dir, shared with the coordinator
+        build_image (callable): builds an image, see
+            :func:`cmd._build_image`
+        worker_id (str): Unique id of this worker, defaults to the host name
+            and pid
+        build_cache (cache.BuildCache): Cache of this worker
+        base_store (basestore.BaseImageStore): Base image store of this
+            worker
+        poll_interval (int): Seconds between checks for new jobs
+        heartbeat_interval (int): Seconds between heartbeats, it must be
+            well below the heartbeat timeout of the coordinator
+        build_workspace (workspace.Workspace): Workspace of this worker
+
+    Returns:
+        int: number of jobs built
+    """
+    queue = JobQueue(queue_dir)
+    worker_id = worker_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+    built = 0
+    LOGGER.info('Worker %s waiting for jobs in %s', worker_id, queue_dir)
+    while True:
+        claim = queue.claim(worker_id)
+        if claim is None:
+            if queue.stopped():
+                LOGGER.info('Worker %s done, built %d', worker_id, built)
+                if build_workspace is not None:
+                    build_workspace.close()
+                return built
+            time.sleep(poll_interval)
+            continue
+
+        with LogTask('Building {} for attempt {}'.format(
+            claim.job['id'], claim.job['attempt'] + 1
+        )):
+            with _Heartbeat(claim, heartbeat_interval) as heartbeat:
+                result = _run_job(
+                    queue,
+                    claim,
+                    heartbeat,
+                    build_image,
+                    build_cache,
+                    base_store,
+                    build_workspace,
+                )
+
+        if heartbeat.lost or not queue.complete(claim, result):
+            LOGGER.warning(
+                'Dropping the result of %s, it was queued again',
+                claim.job['id'],
+            )
+        elif result['status'] == DONE:
+            built += 1
+
+
+def local_worker_cmd(*args):
+    """
+    Returns:
+        list of str: command that runs a worker of this same install, with
+            the given extra args
+    """
+    return [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cmd.py'),
+    ] + list(args)
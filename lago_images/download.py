@@ -0,0 +1,513 @@
+"""
+Resumable, parallel HTTP downloads
+
+If the server supports range requests, the file is split in segments that
+are downloaded concurrently over a pooled session into ``<dst>.part``. The
+progress of each segment is saved in the ``<dst>.download`` sidecar state
+file, so an interrupted download continues where it stopped. The
+destination file only shows up, atomically, once it was fully downloaded
+(and verified, if a digest was given).
+
+Files that are processed as they arrive, like compressed images that are
+decompressed on the fly, are streamed instead, see :meth:`Downloader.stream`,
+resuming the stream with a range request if the connection fails.
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from lago import log_utils
+
+import hashing
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+DEFAULT_SEGMENTS = 4
+DEFAULT_CHUNK_SIZE = 1024 * 256
+# Seconds to wait for the server to connect or send more data
+DEFAULT_TIMEOUT = 60
+# Times a stream is resumed after its connection failed
+DEFAULT_RETRIES = 3
+# Segments smaller than this are not worth their own connection
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+# Seconds between progress and state file updates
+PROGRESS_INTERVAL = 1.0
+
+
+class DownloadException(Exception):
+    pass
+
+
+class Progress(object):
+    """
+    Thread safe progress reporter, printing at most once per interval
+    """
+
+    def __init__(self, total=None, done=0, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_report = 0
+
+    def update(self, size):
+        with self._lock:
+            self.done += size
+            now = time.time()
+            if now - self._last_report < self.interval:
+                return
+            self._last_report = now
+            self._report()
+
+    def finish(self):
+        with self._lock:
+            self._report()
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+    def _report(self):
+        if self.total:
+            sys.stdout.write(
+                '\r% 3.1f%% complete (%d Kilobytes)' %
+                (self.done * 100 / float(self.total), self.done / 1024)
+            )
+        else:
+            sys.stdout.write('\rcomplete (%d Kilobytes)' % (self.done / 1024))
+        sys.stdout.flush()
+
+
+class Segment(object):
+    """
+    Byte range [start, end] of the file, of which [start, offset) is already
+    downloaded
+    """
+
+    def __init__(self, start, end, offset=None):
+        self.start = start
+        self.end = end
+        self.offset = start if offset is None else offset
+
+    @property
+    def done(self):
+        return self.offset > self.end
+
+    def to_list(self):
+        return [self.start, self.end, self.offset]
+
+
+class DownloadState(object):
+    """
+    Persisted progress of a download, enough to resume it
+    """
+
+    def __init__(self, url, size, validator, segments):
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.segments = segments
+
+    @classmethod
+    def load(cls, state_path):
+        try:
+            with open(state_path) as state_fd:
+                data = json.load(state_fd)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return cls(
+            url=data['url'],
+            size=data['size'],
+            validator=data['validator'],
+            segments=[Segment(*segment) for segment in data['segments']],
+        )
+
+    def dump(self, state_path):
+        tmp_path = state_path + '.tmp'
+        with open(tmp_path, 'w') as state_fd:
+            json.dump(
+                {
+                    'url': self.url,
+                    'size': self.size,
+                    'validator': self.validator,
+                    'segments': [
+                        segment.to_list() for segment in self.segments
+                    ],
+                },
+                state_fd,
+            )
+        os.rename(tmp_path, state_path)
+
+    def matches(self, url, size, validator):
+        return (
+            self.url == url and self.size == size
+            and self.validator == validator
+        )
+
+    @property
+    def downloaded(self):
+        return sum(segment.offset - segment.start for segment in self.segments)
+
+
+def _write_all(fd, data):
+    # Unbuffered files might do partial writes
+    view = memoryview(data)
+    while view:
+        written = fd.write(view)
+        if written is None:
+            return
+        view = view[written:]
+
+
+def split_segments(size, segments):
+    """
+    Args:
+        size (int): Size of the file
+        segments (int): Max number of segments to split it to
+
+    Returns:
+        list of Segment: segments covering the whole file
+    """
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    segment_size = size // segments
+    result = []
+    for index in range(segments):
+        start = index * segment_size
+        end = size - 1 if index == segments - 1 else start + segment_size - 1
+        result.append(Segment(start, end))
+
+    return result
+
+
+def new_session(pool_size=DEFAULT_SEGMENTS):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Downloader(object):
+    def __init__(
+        self,
+        url,
+        dst,
+        segments=DEFAULT_SEGMENTS,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        session=None,
+        timeout=DEFAULT_TIMEOUT,
+    ):
+        """
+        Args:
+            url (str): URL to download
+            dst (str): Path to download it to
+            segments (int): Max number of concurrent range requests
+            chunk_size (int): Size of each read from the connections
+            session (requests.Session): Session to use, a pooled one is
+                created if not passed
+            timeout (float): Seconds to wait for the server to connect or
+                send more data
+        """
+        self.url = url
+        self.dst = dst
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.session = session or new_session(segments)
+        self.timeout = timeout
+        self.part_path = dst + '.part'
+        self.state_path = dst + '.download'
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def _probe(self):
+        """
+        Returns:
+            tuple(int or None, str or None, bool): size of the file, its
+                ETag or Last-Modified and if it can be downloaded by ranges
+        """
+        r = self.session.head(
+            self.url, allow_redirects=True, timeout=self.timeout
+        )
+        r.raise_for_status()
+        size = r.headers.get('Content-Length')
+        size = int(size) if size is not None else None
+        validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+        ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return size, validator, ranges
+
+    def _save_state(self, state):
+        with self._lock:
+            state.dump(self.state_path)
+
+    def _download_segment(self, state, segment, progress):
+        try:
+            r = self.session.get(
+                self.url,
+                headers={
+                    'Range': 'bytes={}-{}'.format(segment.offset, segment.end),
+                    'If-Range': state.validator,
+                },
+                stream=True,
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise DownloadException(
+                    '{} changed or ignored the range request'.format(self.url)
+                )
+
+            last_save = time.time()
+            # Unbuffered, so the saved offsets never get ahead of the data
+            # the kernel has, even if this process dies
+            with open(self.part_path, 'r+b', buffering=0) as part_fd:
+                part_fd.seek(segment.offset)
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    chunk = chunk[:segment.end + 1 - segment.offset]
+                    _write_all(part_fd, chunk)
+                    segment.offset += len(chunk)
+                    progress.update(len(chunk))
+                    if time.time() - last_save > PROGRESS_INTERVAL:
+                        self._save_state(state)
+                        last_save = time.time()
+                    if segment.done:
+                        break
+
+            if not segment.done:
+                raise DownloadException(
+                    'Connection closed before the end of {}'.format(self.url)
+                )
+        except Exception as e:
+            LOGGER.debug('Failed to download segment of %s', self.url,
+                         exc_info=True)
+            with self._lock:
+                self._errors.append(e)
+
+    def _download_ranges(self, size, validator):
+        state = DownloadState.load(self.state_path)
+        if (
+            state is None or not state.matches(self.url, size, validator)
+            or not os.path.isfile(self.part_path)
+        ):
+            state = DownloadState(
+                url=self.url,
+                size=size,
+                validator=validator,
+                segments=split_segments(size, self.segments),
+            )
+            with open(self.part_path, 'wb') as part_fd:
+                part_fd.truncate(size)
+            self._save_state(state)
+        else:
+            LOGGER.info(
+                'Resuming download of %s from %d bytes', self.url,
+                state.downloaded
+            )
+
+        progress = Progress(total=size, done=state.downloaded)
+        threads = []
+        for segment in state.segments:
+            if segment.done:
+                continue
+            thread = threading.Thread(
+                target=self._download_segment,
+                args=(state, segment, progress),
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        self._save_state(state)
+        progress.finish()
+        if self._errors:
+            raise DownloadException(
+                'Failed to download {}: {}'.format(self.url, self._errors[0])
+            )
+
+    def _download_stream(self, size):
+        r = self.session.get(self.url, stream=True, timeout=self.timeout)
+        r.raise_for_status()
+        expected = r.headers.get('Content-Length', size)
+        if r.headers.get('Content-Encoding'):
+            # Content-Length is the size of the encoded body then
+            expected = None
+        progress = Progress(total=size)
+        received = 0
+        try:
+            with open(self.part_path, 'wb') as part_fd:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    part_fd.write(chunk)
+                    received += len(chunk)
+                    progress.update(len(chunk))
+        except requests.exceptions.RequestException as e:
+            os.unlink(self.part_path)
+            raise DownloadException(
+                'Failed to download {}: {}'.format(self.url, e)
+            )
+        finally:
+            progress.finish()
+
+        if expected is not None and received != int(expected):
+            # Without ranges there's nothing to resume, start over next time
+            os.unlink(self.part_path)
+            raise DownloadException(
+                'Connection closed after {} of the {} bytes of {}'.format(
+                    received, expected, self.url
+                )
+            )
+
+    def _verify(self, checksum, expected_digest):
+        result = hashing.hash_file(self.part_path, [checksum])
+        if result[checksum] != expected_digest.lower():
+            os.unlink(self.part_path)
+            self._remove_state()
+            raise DownloadException(
+                '{} digest mismatch for {}, expected {} got {}'.format(
+                    checksum, self.url, expected_digest, result[checksum]
+                )
+            )
+
+    def head(self, size):
+        """
+        Args:
+            size (int): Number of bytes to get
+
+        Returns:
+            bytes: the first bytes of the file, requested as a range so the
+                rest of it is not sent
+        """
+        r = self.session.get(
+            self.url,
+            headers={'Range': 'bytes=0-{}'.format(size - 1)},
+            stream=True,
+            timeout=self.timeout,
+        )
+        try:
+            r.raise_for_status()
+            return r.raw.read(size, decode_content=True)
+        except requests.exceptions.RequestException as e:
+            raise DownloadException(
+                'Failed to download {}: {}'.format(self.url, e)
+            )
+        finally:
+            r.close()
+
+    def stream(self, retries=DEFAULT_RETRIES):
+        """
+        Yields the content of the url as it's received, without writing it
+        to disk. If the connection fails, it's resumed from where it
+        stopped with a range request, if the server supports them
+
+        Args:
+            retries (int): Times to resume it
+
+        Yields:
+            bytes: the next chunk of the file
+
+        Raises:
+            DownloadException: if the download failed and could not be
+                resumed
+        """
+        size, validator, ranges = self._probe()
+        resumable = ranges and size and validator
+        received = 0
+        while True:
+            headers = {}
+            if received:
+                headers = {
+                    'Range': 'bytes={}-'.format(received),
+                    'If-Range': validator,
+                }
+            try:
+                r = self.session.get(
+                    self.url,
+                    headers=headers,
+                    stream=True,
+                    timeout=self.timeout,
+                )
+                r.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                raise DownloadException(
+                    'Failed to download {}: {}'.format(self.url, e)
+                )
+            except requests.exceptions.RequestException as e:
+                error = e
+            else:
+                try:
+                    if received and r.status_code != 206:
+                        raise DownloadException(
+                            '{} changed or ignored the range request'.format(
+                                self.url
+                            )
+                        )
+                    if r.headers.get('Content-Encoding'):
+                        # The ranges and size are of the encoded body then
+                        resumable = False
+                        size = None
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        received += len(chunk)
+                        yield chunk
+                    if size is None or received >= size:
+                        return
+                    error = 'connection closed after {} of {} bytes'.format(
+                        received, size
+                    )
+                except requests.exceptions.RequestException as e:
+                    error = e
+                finally:
+                    r.close()
+
+            if not resumable or retries <= 0:
+                raise DownloadException(
+                    'Failed to download {}: {}'.format(self.url, error)
+                )
+            retries -= 1
+            LOGGER.warning(
+                'Resuming download of %s from %d bytes: %s', self.url,
+                received, error
+            )
+
+    def _remove_state(self):
+        if os.path.exists(self.state_path):
+            os.unlink(self.state_path)
+
+    def download(self, checksum=None, expected_digest=None):
+        """
+        Downloads the url, resuming any previous interrupted download
+
+        Args:
+            checksum (str): hashlib name of the digest to verify
+            expected_digest (str): expected hex digest of the file, if given
+                the file is verified before being moved in place
+
+        Returns:
+            str: path to the downloaded file
+
+        Raises:
+            DownloadException: if the download or its verification failed
+        """
+        size, validator, ranges = self._probe()
+        if ranges and size and validator:
+            self._download_ranges(size, validator)
+        else:
+            LOGGER.debug(
+                '%s does not support ranges, downloading sequentially',
+                self.url
+            )
+            self._download_stream(size)
+
+        if expected_digest:
+            self._verify(checksum or 'sha1', expected_digest)
+
+        os.rename(self.part_path, self.dst)
+        self._remove_state()
+        return self.dst
@@ -0,0 +1,328 @@
+"""
+Cheapest available file copies, for multi GB sparse images
+
+Strategies, in the order they are tried:
+
+* reflink: ``FICLONE`` ioctl, a copy on write clone that only touches
+  metadata (XFS, btrfs)
+* copy_file_range: in kernel copy, that can also be offloaded to the storage
+* sendfile: in kernel copy
+* buffered: plain read/write
+
+All but reflink walk the source with ``SEEK_DATA``/``SEEK_HOLE`` and only
+copy the data segments, so sparse files stay sparse.
+
+Pythons without ``os.copy_file_range`` or ``os.sendfile``, like python 2,
+call them from libc through ctypes instead. copy_file_range needs glibc
+2.27, it's skipped with an older one.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Not exposed by the os module in older pythons
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+BUFFERED = 'buffered'
+
+BUFFER_SIZE = 4 * 1024 * 1024
+# Max bytes per copy_file_range/sendfile call, keeps them interruptible
+CHUNK_SIZE = 1024 * 1024 * 1024
+
+# Errors that mean the strategy is not supported here, not that the copy
+# failed
+_UNSUPPORTED_ERRNOS = set((
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EBADF,
+    errno.EPERM,
+))
+
+
+def data_segments(fd, size, offset=0):
+    """
+    Walks the data segments of a file, skipping its holes
+
+    Args:
+        fd (int): file descriptor of the file
+        size (int): size of the file
+        offset (int): Where to start walking it from
+
+    Yields:
+        tuple(int, int): offset and length of each data segment
+    """
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole left
+                return
+            if e.errno in _UNSUPPORTED_ERRNOS:
+                yield offset, size - offset
+                return
+            raise
+
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+
+def reflink(src_fd, dst_fd):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def reflink_file(src, dst):
+    """
+    Makes dst a copy on write clone of src
+
+    Raises:
+        EnvironmentError: if the filesystem does not support it, dst is
+            not left behind in that case
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(
+            dst,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            os.fstat(src_fd).st_mode & 0o777,
+        )
+        try:
+            reflink(src_fd, dst_fd)
+        except EnvironmentError:
+            os.close(dst_fd)
+            os.unlink(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+
+def _libc_function(libc, name, argtypes):
+    """
+    Returns:
+        callable or None: the function of libc with that name, None if
+            there's none
+    """
+    if libc is None:
+        return None
+
+    try:
+        func = getattr(libc, name)
+    except AttributeError:
+        return None
+
+    func.argtypes = argtypes
+    func.restype = ctypes.c_ssize_t
+    return func
+
+
+def _call_libc(func, *args):
+    while True:
+        ret = func(*args)
+        if ret >= 0:
+            return ret
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+
+def _libc_copy_file_range(src_fd, dst_fd, count, offset_src, offset_dst):
+    offset_src = ctypes.c_int64(offset_src)
+    offset_dst = ctypes.c_int64(offset_dst)
+    return _call_libc(
+        _LIBC_COPY_FILE_RANGE,
+        src_fd,
+        ctypes.byref(offset_src),
+        dst_fd,
+        ctypes.byref(offset_dst),
+        count,
+        0,
+    )
+
+
+def _libc_sendfile(out_fd, in_fd, offset, count):
+    offset = ctypes.c_int64(offset)
+    return _call_libc(
+        _LIBC_SENDFILE, out_fd, in_fd, ctypes.byref(offset), count
+    )
+
+
+_libc = _load_libc()
+_LIBC_COPY_FILE_RANGE = _libc_function(
+    _libc,
+    'copy_file_range',
+    [
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_size_t,
+        ctypes.c_uint,
+    ],
+)
+# The 64 bit offset variant, so it also works on 32 bit hosts
+_LIBC_SENDFILE = _libc_function(
+    _libc,
+    'sendfile64',
+    [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_size_t,
+    ],
+)
+
+if hasattr(os, 'copy_file_range'):
+    _os_copy_file_range = os.copy_file_range
+elif _LIBC_COPY_FILE_RANGE is not None:
+    _os_copy_file_range = _libc_copy_file_range
+else:
+    _os_copy_file_range = None
+
+if hasattr(os, 'sendfile'):
+    _os_sendfile = os.sendfile
+elif _LIBC_SENDFILE is not None:
+    _os_sendfile = _libc_sendfile
+else:
+    _os_sendfile = None
+
+
+def _copy_file_range(src_fd, dst_fd, offset, length):
+    while length > 0:
+        copied = _os_copy_file_range(
+            src_fd, dst_fd, min(length, CHUNK_SIZE), offset, offset
+        )
+        if copied == 0:
+            raise IOError(errno.EIO, 'Unexpected end of file')
+        offset += copied
+        length -= copied
+
+
+def _sendfile(src_fd, dst_fd, offset, length):
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while length > 0:
+        copied = _os_sendfile(
+            dst_fd, src_fd, offset, min(length, CHUNK_SIZE)
+        )
+        if copied == 0:
+            raise IOError(errno.EIO, 'Unexpected end of file')
+        offset += copied
+        length -= copied
+
+
+def _buffered(src_fd, dst_fd, offset, length):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while length > 0:
+        data = os.read(src_fd, min(length, BUFFER_SIZE))
+        if not data:
+            raise IOError(errno.EIO, 'Unexpected end of file')
+        while data:
+            written = os.write(dst_fd, data)
+            data = data[written:]
+            length -= written
+
+
+_SEGMENT_COPIERS = [BUFFERED]
+if _os_sendfile is not None:
+    _SEGMENT_COPIERS.insert(0, SENDFILE)
+if _os_copy_file_range is not None:
+    _SEGMENT_COPIERS.insert(0, COPY_FILE_RANGE)
+
+_COPIER_FUNCS = {
+    COPY_FILE_RANGE: _copy_file_range,
+    SENDFILE: _sendfile,
+    BUFFERED: _buffered,
+}
+
+
+def _copy_segments(src_fd, dst_fd, size, strategy):
+    copier = _COPIER_FUNCS[strategy]
+    for offset, length in data_segments(src_fd, size):
+        copier(src_fd, dst_fd, offset, length)
+
+    # Keeps any trailing hole
+    os.ftruncate(dst_fd, size)
+
+
+def copy_file(src, dst, allow_reflink=True):
+    """
+    Copies src to dst with the cheapest strategy that works
+
+    Args:
+        src (str): Path of the file to copy
+        dst (str): Path of the copy, replaced if it exists
+        allow_reflink (bool): If it can be a copy on write clone
+
+    Returns:
+        str: name of the strategy used, one of reflink, copy_file_range,
+            sendfile or buffered
+    """
+    # Never truncate dst in place, it might be a hard link of something else
+    if os.path.lexists(dst):
+        os.unlink(dst)
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        stat = os.fstat(src_fd)
+        dst_fd = os.open(
+            dst,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            stat.st_mode & 0o777,
+        )
+        try:
+            strategies = list(_SEGMENT_COPIERS)
+            if allow_reflink:
+                strategies.insert(0, REFLINK)
+
+            for strategy in strategies:
+                try:
+                    if strategy == REFLINK:
+                        reflink(src_fd, dst_fd)
+                    else:
+                        _copy_segments(
+                            src_fd, dst_fd, stat.st_size, strategy
+                        )
+                except (IOError, OSError) as e:
+                    if (
+                        strategy == BUFFERED
+                        or e.errno not in _UNSUPPORTED_ERRNOS
+                    ):
+                        raise
+                    LOGGER.debug(
+                        '%s not supported for %s: %s', strategy, src, e
+                    )
+                    os.ftruncate(dst_fd, 0)
+                    continue
+
+                LOGGER.debug('Copied %s to %s with %s', src, dst, strategy)
+                return strategy
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
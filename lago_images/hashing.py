@@ -0,0 +1,372 @@
+"""
+Single pass, multi digest hashing for (possibly very large) image files
+
+The file is read once, in large reused buffers, and every chunk is handed to
+one worker thread per digest. ``hashlib`` releases the GIL while updating
+with big buffers, so the digests are actually computed in parallel and the
+total cost is bound by the slowest digest instead of the sum of all of them.
+
+Sparse files are walked by their data segments (see
+:func:`fastcopy.data_segments`), and their holes are fed as a shared buffer
+of zeros instead of being read, so the digests are the same but only the
+allocated data is read from disk.
+"""
+import functools
+import hashlib
+import logging
+import mmap
+import os
+import stat
+import threading
+import time
+
+from future.moves.queue import Queue
+
+import fastcopy
+
+LOGGER = logging.getLogger(__name__)
+
+# 4MiB chunks are big enough to amortize the per update overhead and make
+# hashlib drop the GIL, and small enough to keep a few of them in flight
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+DEFAULT_BUFFER_COUNT = 4
+
+
+def alloc_buffer(size):
+    """
+    Allocates a page aligned, writable buffer of the given size
+
+    Args:
+        size (int): Size of the buffer in bytes
+
+    Returns:
+        mmap.mmap or bytearray: anonymous mmap if it can be used with
+            ``readinto``, a plain bytearray otherwise
+    """
+    try:
+        buf = mmap.mmap(-1, size)
+        memoryview(buf)
+    except (TypeError, EnvironmentError):
+        return bytearray(size)
+
+    return buf
+
+
+def _noop():
+    pass
+
+
+def _file_segments(fd, sparse):
+    """
+    Yields:
+        tuple(int or None, int or None, bool): offset, length and if it
+            holds data of each segment of the file from its current
+            position, a single data segment of unknown offset and length
+            if it can't be walked
+    """
+    file_stat = os.fstat(fd.fileno())
+    if not sparse or not stat.S_ISREG(file_stat.st_mode):
+        yield None, None, True
+        return
+
+    offset = fd.tell()
+    size = file_stat.st_size
+    for start, length in fastcopy.data_segments(fd.fileno(), size, offset):
+        if start > offset:
+            yield offset, start - offset, False
+        yield start, length, True
+        offset = start + length
+
+    if offset < size:
+        yield offset, size - offset, False
+
+
+def iter_chunks(
+    fd,
+    buffer_size=DEFAULT_BUFFER_SIZE,
+    buffer_count=DEFAULT_BUFFER_COUNT,
+    sparse=True,
+):
+    """
+    Reads the given file in chunks, reusing a fixed pool of buffers
+
+    Each chunk is yielded along with a ``release`` callable that must be
+    called once the chunk data is no longer used, so its buffer can be
+    reused. If more than ``buffer_count`` chunks are held unreleased, this
+    blocks until one of them is released.
+
+    The holes of sparse regular files are not read, they are yielded as
+    chunks of a buffer of zeros that must not be modified.
+
+    Args:
+        fd (file): unbuffered file object opened for binary reading
+        buffer_size (int): Size of each read buffer
+        buffer_count (int): How many buffers can be in flight at once
+        sparse (bool): Skip reading the holes of the file
+
+    Yields:
+        tuple(memoryview, callable): chunk of data and its release callable
+    """
+    free_buffers = Queue()
+    for _ in range(buffer_count):
+        free_buffers.put(alloc_buffer(buffer_size))
+    zeros = None
+
+    for offset, length, is_data in _file_segments(fd, sparse):
+        if not is_data:
+            if zeros is None:
+                zeros = memoryview(alloc_buffer(buffer_size))
+            while length:
+                size = min(length, buffer_size)
+                yield zeros[:size], _noop
+                length -= size
+            continue
+
+        if offset is not None:
+            fd.seek(offset)
+        while length is None or length:
+            buf = free_buffers.get()
+            size = buffer_size if length is None else min(length, buffer_size)
+            read = fd.readinto(memoryview(buf)[:size])
+            if not read:
+                # The file was truncated while reading it
+                return
+
+            if length is not None:
+                length -= read
+            yield memoryview(buf)[:read], functools.partial(
+                free_buffers.put, buf
+            )
+
+
+class _Chunk(object):
+    """
+    A piece of data shared by all the digest workers, the ``on_release``
+    callback is called once every one of them is done with it
+    """
+
+    def __init__(self, data, users, on_release=None):
+        self.data = data
+        self._users = users
+        self._lock = threading.Lock()
+        self._on_release = on_release
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            last = self._users == 0
+
+        if last and self._on_release is not None:
+            self._on_release()
+
+
+class _DigestWorker(threading.Thread):
+    def __init__(self, checksum):
+        super(_DigestWorker, self).__init__(
+            name='digest-{}'.format(checksum)
+        )
+        self.daemon = True
+        self.checksum = checksum
+        self.hash_obj = hashlib.new(checksum)
+        self.queue = Queue()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+
+            try:
+                self.hash_obj.update(chunk.data)
+            finally:
+                chunk.release()
+
+
+class HashResult(object):
+    """
+    Digests of a single pass over some data, along with throughput stats
+
+    Attributes:
+        digests (dict of str: str): hex digest per checksum name
+        size (int): Number of bytes hashed
+        elapsed (float): Wall time in seconds it took to hash them
+    """
+
+    def __init__(self, digests, size, elapsed):
+        self.digests = digests
+        self.size = size
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self):
+        """
+        Returns:
+            float: Hashed bytes per second
+        """
+        if not self.elapsed:
+            return 0.0
+
+        return self.size / float(self.elapsed)
+
+    def __getitem__(self, checksum):
+        return self.digests[checksum]
+
+    def __repr__(self):
+        return '%s(size=%d, elapsed=%.2fs, %.1f MiB/s)' % (
+            self.__class__.__name__,
+            self.size,
+            self.elapsed,
+            self.throughput / (1024 * 1024),
+        )
+
+
+class MultiHasher(object):
+    """
+    Computes several digests over the same stream of data, in one pass
+
+    Usage::
+
+        with MultiHasher(['sha1', 'sha512']) as hasher:
+            for chunk in stream:
+                hasher.update(chunk)
+        hasher.result()['sha512']
+
+    Data passed to :func:`update` must not be modified until
+    :func:`finish` is called, use :func:`update_shared` for reused buffers.
+    """
+
+    def __init__(self, checksums, threaded=None):
+        """
+        Args:
+            checksums (list of str): hashlib names of the digests to compute
+            threaded (bool or None): Compute each digest on its own thread,
+                by default only if there's more than one digest
+        """
+        self.checksums = list(checksums)
+        if not self.checksums:
+            raise ValueError('At least one checksum is required')
+
+        if threaded is None:
+            threaded = len(self.checksums) > 1
+
+        self.size = 0
+        self._start = None
+        self._elapsed = None
+        self._workers = []
+        self._hash_objs = {}
+        if threaded:
+            for checksum in self.checksums:
+                worker = _DigestWorker(checksum)
+                self._workers.append(worker)
+                self._hash_objs[checksum] = worker.hash_obj
+        else:
+            for checksum in self.checksums:
+                self._hash_objs[checksum] = hashlib.new(checksum)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.finish()
+
+    def start(self):
+        self._start = time.time()
+        for worker in self._workers:
+            worker.start()
+
+    def update_shared(self, data, on_release=None):
+        """
+        Feeds the given data to all the digests
+
+        Args:
+            data (buffer): data to hash
+            on_release (callable): called once all the digests are done
+                with ``data`` and it can be reused
+
+        Returns:
+            None
+        """
+        if self._start is None:
+            self.start()
+
+        self.size += len(data)
+        if not self._workers:
+            for hash_obj in self._hash_objs.values():
+                hash_obj.update(data)
+
+            if on_release is not None:
+                on_release()
+
+            return
+
+        chunk = _Chunk(data, len(self._workers), on_release)
+        for worker in self._workers:
+            worker.queue.put(chunk)
+
+    def update(self, data):
+        self.update_shared(data)
+
+    def finish(self):
+        """
+        Waits for all the digests to consume all the data fed so far and
+        stops the workers, no more data can be fed after this
+        """
+        if self._elapsed is not None:
+            return
+
+        if self._start is None:
+            self.start()
+
+        for worker in self._workers:
+            worker.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+        self._elapsed = time.time() - self._start
+
+    def result(self):
+        """
+        Returns:
+            HashResult: the digests of all the data fed
+        """
+        self.finish()
+        return HashResult(
+            digests=dict(
+                (checksum, hash_obj.hexdigest())
+                for checksum, hash_obj in self._hash_objs.items()
+            ),
+            size=self.size,
+            elapsed=self._elapsed,
+        )
+
+
+def hash_file(
+    file_path,
+    checksums=('sha1', ),
+    buffer_size=DEFAULT_BUFFER_SIZE,
+    buffer_count=DEFAULT_BUFFER_COUNT,
+):
+    """
+    Calculates all the given digests of a file reading it only once
+
+    Args:
+        file_path (str): Path to the file to hash
+        checksums (list of str): hashlib names of the digests to compute
+        buffer_size (int): Size of each read buffer
+        buffer_count (int): How many buffers can be in flight at once
+
+    Returns:
+        HashResult: digests and throughput of the hashing
+    """
+    hasher = MultiHasher(checksums)
+    if not hasher._workers:
+        buffer_count = 1
+
+    with open(file_path, 'rb', buffering=0) as fd, hasher:
+        for data, release in iter_chunks(fd, buffer_size, buffer_count):
+            hasher.update_shared(data, on_release=release)
+
+    result = hasher.result()
+    LOGGER.debug('Hashed %s: %r', file_path, result)
+    return result
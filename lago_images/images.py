@@ -6,75 +6,494 @@ import os
 from os import path
 import datetime
 import re
+import shutil
+import threading
 from textwrap import dedent
 from future.utils import raise_from
 from future.builtins import super
 from requests.exceptions import HTTPError
 
+import appliance
 import build_utils
+import cache
+import compression
+import createrepo
+import metrics
+import seekable
 
 from lago import log_utils
 
 LOGGER = logging.getLogger(__name__)
 LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
 
+# How the built image is turned into the published artifact, sparsified
+# and compressed with the codec, or converted into a compressed qcow2 that
+# can be used as is, recorded in the finalize prop of its metadata
+FINALIZE_COMPRESS = 'compress'
+FINALIZE_QCOW2 = 'qcow2'
+FINALIZE_MODES = (FINALIZE_COMPRESS, FINALIZE_QCOW2)
+QCOW2_COMPRESSION_TYPES = ('zlib', 'zstd')
+DEFAULT_QCOW2_COROUTINES = 8
+# Max of qemu-img convert -m
+MAX_QCOW2_COROUTINES = 16
+# How the layered images are published, flattened into standalone images,
+# or as thin qcow2 overlays of their base, a published image of the same
+# repo, recorded in the layered prop of their metadata along with the
+# handle and digests of their base (backing_handle, backing_sha1 and
+# backing_checksum)
+LAYERED_FLATTEN = 'flatten'
+LAYERED_OVERLAY = 'overlay'
+LAYERED_MODES = (LAYERED_FLATTEN, LAYERED_OVERLAY)
+# Stages an image build reports to its checkpoint callback as it completes
+# them, in order, see :mod:`journal`
+STAGE_BUILT = 'built'
+STAGE_COMPRESSED = 'compressed'
+STAGE_PUBLISHED = 'published'
+STAGES = (STAGE_BUILT, STAGE_COMPRESSED, STAGE_PUBLISHED)
+
 
 class Image(object):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, spec, dst_path, base_image):
+    def __init__(
+        self,
+        spec,
+        dst_path,
+        base_image,
+        base_store=None,
+        single_appliance=False,
+        publish_delta=False,
+        seekable=False,
+        compression_name=None,
+        compression_level=None,
+        compression_threads=0,
+        workspace=None,
+        finalize=None,
+        qcow2_compression=None,
+        qcow2_coroutines=DEFAULT_QCOW2_COROUTINES,
+        layered=None,
+        backing_image=None,
+    ):
         self.spec = spec
         self.dst_path = dst_path
         self.compressed = False
         self.built = False
         self.base_image = base_image
         self.built_image_path = None
+        self.uncompressed_image_path = None
+        self.base_store = base_store
+        self.single_appliance = single_appliance
+        self.publish_delta = publish_delta
+        self.seekable = seekable
+        self._set_finalize(finalize, qcow2_compression, qcow2_coroutines)
+        if self.finalize == FINALIZE_QCOW2:
+            # The qcow2 clusters are already compressed
+            compression_name = compression.NoCodec.name
+            if spec.props.get('compression') not in (None, compression_name):
+                LOGGER.warning(
+                    'Ignoring the %s compression of %s, it is finalized as '
+                    'compressed qcow2',
+                    spec.props['compression'],
+                    spec.id,
+                )
+            spec.props['compression'] = compression_name
+        # The compression of the spec, if any, wins over the default one,
+        # it's recorded in the props so it's part of the build cache key too
+        self.codec = compression.get_codec(
+            spec.props.get('compression') or compression_name
+        )
+        level = self.codec.check_level(
+            spec.props.get('compression_level', compression_level)
+        )
+        spec.props['compression'] = self.codec.name
+        if level is None:
+            spec.props.pop('compression_level', None)
+        else:
+            spec.props['compression_level'] = level
+        self.compression_threads = compression_threads
+        self.layered = layered
+        self.backing_image = backing_image
+        # Handle of the published image this one is an overlay of, and the
+        # path of its backing file while building it
+        self.backing_handle = None
+        self.backing_path = None
+        self.workspace = workspace
+        self.image_workspace = None
+        # Files outside the workspace to remove once published
+        self._intermediates = []
+        # Digests of the uncompressed and the compressed image, once
+        # compressed
+        self.compress_hashes = None
+        # Called with each completed stage, see STAGES
+        self.checkpoint = None
+        self.metrics = metrics.StageRecorder(spec.id)
+        self._lock = threading.Lock()
+        self._published = threading.Event()
+        self._publish_error = None
+        # Set once compress_hashes is known, or compressing it failed
+        self._compressed = threading.Event()
 
     @abstractmethod
     def custom_build_action(self, *args, **kwargs):
         raise NotImplementedError('Should be implemented in a subclass')
 
-    def build(self):
+    def _set_finalize(self, finalize, qcow2_compression, qcow2_coroutines):
+        """
+        Like the compression, the finalize mode of the spec, if any, wins
+        over the default one, and it's recorded in the props only when it's
+        not the default, to keep the cache keys of the existing images
+        """
+        props = self.spec.props
+        self.qcow2_coroutines = qcow2_coroutines
+        self.finalize = props.get('finalize') or finalize or \
+            FINALIZE_COMPRESS
+        if self.finalize not in FINALIZE_MODES:
+            raise LagoImagesBuildException(
+                'Unknown finalize mode {} of {}, should be one of {}'.format(
+                    self.finalize, self.spec.id, ', '.join(FINALIZE_MODES)
+                )
+            )
+
+        if self.finalize == FINALIZE_COMPRESS:
+            props.pop('finalize', None)
+            props.pop('qcow2_compression', None)
+            return
+
+        qcow2_compression = props.get('qcow2_compression') or \
+            qcow2_compression or QCOW2_COMPRESSION_TYPES[0]
+        if qcow2_compression not in QCOW2_COMPRESSION_TYPES:
+            raise LagoImagesBuildException(
+                'Unknown qcow2 compression {} of {}, should be one of '
+                '{}'.format(
+                    qcow2_compression,
+                    self.spec.id,
+                    ', '.join(QCOW2_COMPRESSION_TYPES),
+                )
+            )
+        if not 1 <= qcow2_coroutines <= MAX_QCOW2_COROUTINES:
+            raise LagoImagesBuildException(
+                'The qcow2 coroutines should be between 1 and {}'.format(
+                    MAX_QCOW2_COROUTINES
+                )
+            )
+
+        props['finalize'] = self.finalize
+        props['qcow2_compression'] = qcow2_compression
+
+    def allocate_workspace(self):
+        """
+        Reserves the scratch space for building this image, if it has a
+        workspace, with the sizes of its newest published version as the
+        predicted ones
+
+        Raises:
+            workspace.WorkspaceException: if they don't fit
+        """
+        if self.workspace is None or self.image_workspace is not None:
+            return
+
+        repo_dir = path.dirname(self.dst_path)
+        props = self.spec.props
+        if 'size' not in props:
+            props = createrepo.newest_published_props(
+                repo_dir, self.spec.name
+            ) or {}
+        self.image_workspace = self.workspace.allocate(
+            path.basename(self.dst_path),
+            repo_dir,
+            size=props.get('size'),
+            compressed_size=props.get('compressed_size'),
+        )
+
+    def work_path(self, name):
+        """
+        Returns:
+            str: Path for the intermediate file name, in the workspace of
+                this image, or in the repo dir if it has none
+        """
+        if self.workspace is None:
+            return path.join(path.dirname(self.dst_path), name)
+
+        self.allocate_workspace()
+        return self.image_workspace.path(name)
+
+    def cleanup(self):
+        """
+        Removes the intermediate files of this image, including its
+        uncompressed image, unless it's a published artifact
+        """
+        with self._lock:
+            for file_path in self._intermediates:
+                if path.isdir(file_path):
+                    shutil.rmtree(file_path, ignore_errors=True)
+                elif path.exists(file_path):
+                    os.unlink(file_path)
+            self._intermediates = []
+            if self.image_workspace is not None:
+                self.image_workspace.cleanup()
+                self.image_workspace = None
+            if self.uncompressed_image_path is not None and \
+                    not path.exists(self.uncompressed_image_path):
+                self.uncompressed_image_path = self.dst_path
+
+    def _checkpoint(self, stage):
+        if self.checkpoint is not None:
+            self.checkpoint(stage)
+
+    def journal_state(self):
+        """
+        Returns:
+            dict: what is needed to resume the build of this image from its
+                last completed stage, see :meth:`restore_journal_state`
+        """
+        intermediates = list(self._intermediates)
+        if self.image_workspace is not None:
+            intermediates.append(self.image_workspace.dir_path)
+
+        return {
+            'props': dict(self.spec.props),
+            'built_image_path': self.built_image_path,
+            'uncompressed_image_path': self.uncompressed_image_path,
+            'backing_handle': self.backing_handle,
+            'backing_path': self.backing_path,
+            'intermediates': intermediates,
+        }
+
+    def restore_journal_state(self, state, compress_hashes=None):
+        """
+        Resumes the interrupted build of this image, by another process,
+        from its last completed stage
+
+        Args:
+            state (dict): state of the image at that stage, see
+                :meth:`journal_state`
+            compress_hashes (tuple(hashing.HashResult, hashing.HashResult)):
+                digests of the uncompressed and the compressed image, if it
+                was already compressed
+
+        Returns:
+            None
+        """
+        self.spec.props = dict(state['props'])
+        self.built_image_path = state['built_image_path']
+        self.uncompressed_image_path = state['uncompressed_image_path']
+        self.backing_handle = state['backing_handle']
+        self.backing_path = state['backing_path']
+        self._intermediates = list(state['intermediates'])
+        self.built = True
+        if compress_hashes is not None:
+            self.compress_hashes = compress_hashes
+            self.compressed = True
+            self._compressed.set()
+
+    @property
+    def is_published(self):
+        return self._published.is_set() and self._publish_error is None
+
+    def build(self, publish=True):
+        """
+        Builds the image
+
+        Args:
+            publish (bool): Also publish it, if False :func:`publish` has
+                to be called afterwards
+
+        Returns:
+            None
+        """
         with LogTask('Building image {}'.format(self.base_image)):
             self.built_image_path = self.custom_build_action()
             if path.isfile(self.built_image_path):
                 self.built = True
+                self.uncompressed_image_path = self.built_image_path
             else:
                 raise RuntimeError(
                     'Failed to build image {}'.format(self.base_image)
                 )
-            self._update_meta_data_pre_compress()
-            self.compress()
-            self._update_meta_data_post_compress()
-            self.write_lago_metadata()
+        self._checkpoint(STAGE_BUILT)
+
+        if publish:
+            self.publish()
+
+    def publish(self):
+        """
+        Compresses the built image and writes its metadata, the CPU bound
+        part of the build, see :mod:`publish`
+
+        Returns:
+            None
+        """
+        try:
+            with LogTask('Publishing image {}'.format(self.spec.name)):
+                if self.compress_hashes is None:
+                    with self.metrics.measure('compress'):
+                        self.compress_hashes = self.compress()
+                    self._compressed.set()
+                    self._checkpoint(STAGE_COMPRESSED)
+                hashes, compressed_hashes = self.compress_hashes
+                if self.publish_delta:
+                    with self.metrics.measure('delta'):
+                        self.create_delta()
+                with self.metrics.measure('metadata'):
+                    self._update_meta_data_pre_compress(hashes)
+                    self._update_meta_data_post_compress(compressed_hashes)
+                    self.write_lago_metadata()
+                self._checkpoint(STAGE_PUBLISHED)
+        except Exception as e:
+            self._publish_error = e
+            raise
+        finally:
+            self._compressed.set()
+            self._published.set()
+
+        LOGGER.info(
+            'Stage timings of %s: %s',
+            self.spec.name,
+            self.metrics.format(),
+        )
+
+    def wait_published(self):
+        """
+        Waits for the image to be published, by another thread
 
-    def _update_meta_data_pre_compress(self):
+        Raises:
+            RuntimeError: if publishing it failed
+        """
+        self._published.wait()
+        if self._publish_error is not None:
+            raise RuntimeError(
+                'Image {} failed to publish: {}'.format(
+                    self.spec.name, self._publish_error
+                )
+            )
+
+    @property
+    def publish_changes_image(self):
+        """
+        bool: If publishing the image moves or rewrites its uncompressed
+            image, so the images based on it have to wait for it
+        """
+        return (
+            self.backing_handle is not None
+            or self.finalize == FINALIZE_QCOW2 or self.codec.magic is None
+        )
+
+    def get_fingerprint(self):
+        """
+        Waits for the image to be compressed, by another thread, as it's
+        hashed while compressing it
+
+        Returns:
+            str: sha512 of the uncompressed image, for the cache keys of the
+                images based on it, the same as its published checksum
+
+        Raises:
+            RuntimeError: if it's not built yet, or compressing it failed
+        """
+        if not self.built:
+            raise RuntimeError('You must build the image first')
+
+        self._compressed.wait()
+        if self.compress_hashes is not None:
+            return self.compress_hashes[0]['sha512']
+        if self.is_published:
+            return self.spec.props['checksum']
+
+        raise RuntimeError(
+            'Image {} failed to compress: {}'.format(
+                self.spec.name, self._publish_error
+            )
+        )
+
+    def _update_meta_data_pre_compress(self, hashes):
         LOGGER.debug('Writing pre compression lago metadata')
-        self.spec.props['size'] = os.stat(self.built_image_path).st_size
+        self.spec.props['size'] = hashes.size
         # Lago uses sha1 to validate images
-        self.spec.props['sha1'] = build_utils.get_hash(
-            self.built_image_path,
-            checksum='sha1',
-        )
+        self.spec.props['sha1'] = hashes['sha1']
         # virt builder index requires sha 512
-        self.spec.props['checksum'] = build_utils.get_hash(
-            self.built_image_path,
-            checksum='sha512',
-        )
+        self.spec.props['checksum'] = hashes['sha512']
 
-    def _update_meta_data_post_compress(self):
+    def _update_meta_data_post_compress(self, hashes):
         LOGGER.debug('Writing post compression lago metadata')
-        self.spec.props['compressed_size'] = os.stat(self.built_image_path).st_size
-        self.spec.props['compressed_sha1'] = build_utils.get_hash(
-            self.built_image_path,
-            checksum='sha1',
+        self.spec.props['compressed_size'] = hashes.size
+        self.spec.props['compressed_sha1'] = hashes['sha1']
+        self.spec.props['uncompressed_checksum'] = hashes['sha512']
+        self.spec.props['timestamp'] = os.stat(self.built_image_path).st_ctime
+
+    def create_delta(self):
+        """
+        Generates the xz compressed qcow2 overlay that turns the newest
+        published version of this template into this image, and adds its
+        digests, and the handle of the version it applies on, to the
+        metadata
+
+        Returns:
+            bool: If the delta was generated, there might be no published
+                version to generate it against
+        """
+        repo_dir = path.dirname(self.dst_path)
+        handle = path.basename(self.dst_path)
+        previous = [
+            version
+            for version in createrepo.published_versions(
+                repo_dir, self.spec.name
+            ) if version['handle'] != handle
+        ]
+        if not previous:
+            LOGGER.info(
+                'No published version of %s to generate a delta against',
+                self.spec.name,
+            )
+            return False
+
+        base = previous[0]
+        base_path = path.join(repo_dir, base['handle'])
+        with open(base_path + '.metadata') as metadata_fd:
+            base_props = json.load(metadata_fd)
+        if not path.isfile(base_path):
+            # The delta refers to its base by its handle, so it has to be
+            # next to it
+            base_codec = compression.get_codec(base_props.get('compression'))
+            build_utils.decompress(
+                base_path + base_codec.ext, base_path, base_codec
+            )
+            self._intermediates.append(base_path)
+
+        delta_path = self.dst_path + '.delta'
+        try:
+            build_utils.create_delta_image(
+                image=self.uncompressed_image_path,
+                base_image=base['handle'],
+                dst_image=delta_path,
+            )
+            hashes, compressed_hashes = build_utils.xz_compress_and_hash(
+                delta_path,
+                block_size=16777216,
+                checksums=['sha1'],
+                compressed_checksums=['sha1', 'sha512'],
+            )
+        finally:
+            if path.exists(delta_path):
+                os.unlink(delta_path)
+
+        self.spec.props['delta_base'] = base['handle']
+        self.spec.props['delta_base_version'] = base['version']
+        self.spec.props['delta_base_sha1'] = base_props['sha1']
+        self.spec.props['delta_size'] = hashes.size
+        self.spec.props['delta_sha1'] = hashes['sha1']
+        self.spec.props['delta_compressed_size'] = compressed_hashes.size
+        self.spec.props['delta_compressed_sha1'] = compressed_hashes['sha1']
+        self.spec.props['delta_compressed_checksum'] = (
+            compressed_hashes['sha512']
         )
-        self.spec.props['uncompressed_checksum'] = build_utils.get_hash(
-            self.built_image_path,
-            checksum='sha512',
+        LOGGER.info(
+            'Delta of %s over %s: %d bytes compressed',
+            handle,
+            base['handle'],
+            compressed_hashes.size,
         )
-        self.spec.props['timestamp'] = os.stat(self.built_image_path).st_ctime
+        return True
 
     def get_lago_metadata(self):
         if not self.built:
@@ -84,11 +503,7 @@ class Image(object):
 
     def write_lago_metadata(self):
         with LogTask('Dumping image metadata and hash'):
-            if self.compressed:
-                base_path = self.built_image_path.rsplit('.', 1)[0]
-            else:
-                base_path = self.built_image_path
-
+            base_path = self.dst_path
             metadata_path = base_path + '.metadata'
             with open(metadata_path, 'w') as metadata_fd:
                 metadata_fd.write(self.get_lago_metadata())
@@ -97,66 +512,421 @@ class Image(object):
             with open(hash_path, 'w') as hash_fd:
                 hash_fd.write(self.spec.props['sha1'])
 
+    def prepare_guest(self, image_path, customize=True):
+        """
+        Customizes, syspreps and sparsifies the given image, in a single
+        libguestfs appliance if enabled and possible for this spec, with the
+        virt-* tools otherwise, falling back to virt-sparsify if trimming in
+        the appliance freed nothing. The images finalized as qcow2 are not
+        sparsified by the virt-* tools, see :meth:`compress`
+
+        Args:
+            image_path (str): Path to the image
+            customize (bool): If False, it's only sysprepped and sparsified
+
+        Returns:
+            None
+        """
+        commands_file = self.spec.commands_file if customize else None
+        if self.single_appliance and appliance.is_supported(commands_file):
+            with self.metrics.measure('appliance'):
+                timings, trimmed = appliance.customize_sysprep_trim(
+                    image_path, commands_file
+                )
+            for stage, secs in timings.items():
+                self.metrics.add('appliance-' + stage, secs)
+            if trimmed:
+                return
+            # The discards did not reach the image, sparsify it instead
+        else:
+            if customize:
+                with self.metrics.measure('customize'):
+                    build_utils.virt_customize(
+                        dst_image=image_path,
+                        commands_file=commands_file
+                    )
+
+            with self.metrics.measure('sysprep'):
+                build_utils.virt_sysprep(
+                    dst_image=image_path
+                )
+
+        if self.finalize == FINALIZE_QCOW2:
+            # The conversion leaves the zero clusters out already
+            return
+
+        with self.metrics.measure('sparsify'):
+            build_utils.virt_sprsify(
+                dst_image=image_path
+            )
+
+    def get_base_image_file(self, dst, writable=True):
+        """
+        Places the uncompressed base image at dst, cloning it from the base
+        image store if there's one
+
+        Args:
+            dst (str): Path to put the base image at, can be a dir
+            writable (bool): If the image at dst is going to be modified
+
+        Returns:
+            str: Path to the uncompressed base image
+        """
+        with self.metrics.measure('base-image'):
+            if self.base_store is None:
+                return build_utils.get_uncompressed_file(self.base_image, dst)
+
+            return self.base_store.clone(
+                self.base_image, dst, writable=writable
+            )
+
+    def get_base_fingerprint(self):
+        """
+        Returns:
+            str or None: A string that changes whenever the base image
+                changes, None if there's no way to know it
+        """
+        if build_utils.is_url(self.base_image):
+            return build_utils.url_fingerprint(self.base_image)
+
+        return build_utils.get_hash(self.base_image, checksum='sha512')
+
+    def get_base_download_size(self):
+        """
+        Returns:
+            int or None: Bytes that getting the base image would download,
+                None if unknown
+        """
+        if not build_utils.is_url(self.base_image):
+            return 0
+
+        if self.base_store is not None and \
+                self.base_store.is_stored(self.base_image):
+            return 0
+
+        return build_utils.url_size(self.base_image)
+
+    def get_cache_key(self, base_fingerprint=None):
+        """
+        Args:
+            base_fingerprint (str): fingerprint of the base image, if
+                already known
+
+        Returns:
+            str or None: build cache key of this image, None if it can't be
+                cached
+        """
+        if base_fingerprint is None:
+            base_fingerprint = self.get_base_fingerprint()
+
+        if base_fingerprint is None:
+            return None
+
+        return cache.build_key(self.spec, base_fingerprint)
+
+    def restore_from_cache(self, entry):
+        """
+        Uses the artifacts of a cached build instead of building the image
+
+        Args:
+            entry (cache.CacheEntry): the cached build of this image
+
+        Returns:
+            None
+        """
+        with LogTask('Using cached build of {}'.format(self.spec.name)), \
+                self.metrics.measure('cache-restore'):
+            base_dir = path.dirname(self.dst_path)
+            entry.restore(base_dir)
+            self.load_published(path.join(base_dir, entry.info['image']))
+
+    def load_published(self, uncompressed_image_path):
+        """
+        Uses an image that is already published, by another process, with
+        its compressed image and metadata next to uncompressed_image_path
+
+        Args:
+            uncompressed_image_path (str): Path of the uncompressed image,
+                it might not exist, see :func:`ensure_uncompressed`
+
+        Returns:
+            None
+        """
+        self.uncompressed_image_path = uncompressed_image_path
+        with open(self.uncompressed_image_path + '.metadata') as fd:
+            self.spec.props = json.load(fd)
+        self.codec = compression.get_codec(self.spec.props.get('compression'))
+        self.built_image_path = self.uncompressed_image_path + self.codec.ext
+        self.built = True
+        self.compressed = True
+        self._compressed.set()
+        self._published.set()
+
+    def store_in_cache(self, build_cache, key):
+        """
+        Adds the published artifacts of this image to the given build cache
+
+        Args:
+            build_cache (cache.BuildCache): cache to add them to
+            key (str): cache key of this image, see :func:`get_cache_key`
+
+        Returns:
+            None
+        """
+        if not self.compressed:
+            raise RuntimeError('You must build and compress the image first')
+
+        base_dir = path.dirname(self.dst_path)
+        image = path.relpath(self.dst_path, base_dir)
+        files = [
+            image + self.codec.ext,
+            image + '.metadata',
+            image + '.hash',
+        ]
+        if self.spec.props.get('delta_base'):
+            files.append(image + createrepo.DELTA_SUFFIX)
+        build_cache.put(
+            key,
+            src_dir=base_dir,
+            files=files,
+            info={'image': image},
+        )
+
+    def ensure_uncompressed(self):
+        """
+        Makes sure the uncompressed image exists, as it's not kept when the
+        image is restored from the build cache
+
+        Returns:
+            str: Path to the uncompressed image
+        """
+        with self._lock:
+            if not path.isfile(self.uncompressed_image_path):
+                if self.workspace is not None:
+                    self.uncompressed_image_path = self.work_path(
+                        path.basename(self.dst_path)
+                    )
+                with self.metrics.measure('decompress'):
+                    if self.spec.props.get('compressed_blocks'):
+                        seekable.decompress_file(
+                            self.built_image_path,
+                            self.uncompressed_image_path,
+                            index=self.spec.props['compressed_blocks'],
+                            block_size=self.spec.props[
+                                'compression_block_size'
+                            ],
+                            decompress_cmd=self.codec.decompress_cmd(
+                                threads=1
+                            ),
+                        )
+                    else:
+                        build_utils.decompress(
+                            self.built_image_path,
+                            self.uncompressed_image_path,
+                            self.codec,
+                        )
+
+        return self.uncompressed_image_path
+
     def compress(self):
+        """
+        Compresses the built image, hashing it on the way, or converts it to
+        a compressed qcow2 if finalized as such
+
+        Returns:
+            tuple(hashing.HashResult, hashing.HashResult): digests of the
+                uncompressed and the compressed image
+        """
         if not self.built:
             raise RuntimeError('You must build the image first')
 
         if self.compressed:
-            LOGGER.info('Already compressed')
-            return
+            raise RuntimeError('Already compressed')
 
-        # Block size take from virt-builder page
-        build_utils.xz_compress(self.dst_path, block_size=16777216)
-        self.built_image_path += '.xz'
+        level = self.spec.props.get('compression_level')
+        checksums = ['sha1', 'sha512']
+        dst = self.dst_path + self.codec.ext
+        backing_format = None
+        if self.backing_handle is not None:
+            backing_format = build_utils.image_format(self.backing_path)
+            if self.finalize != FINALIZE_QCOW2:
+                # The clients find the backing file next to the image
+                build_utils.rebase_image(
+                    self.built_image_path, self.backing_handle, backing_format
+                )
+
+        if self.finalize == FINALIZE_QCOW2:
+            # Might be converting the image in place
+            tmp_dst = dst + '.tmp'
+            try:
+                build_utils.qcow2_convert(
+                    self.built_image_path,
+                    tmp_dst,
+                    compression_type=self.spec.props['qcow2_compression'],
+                    coroutines=self.qcow2_coroutines,
+                    backing_file=self.backing_path,
+                    backing_format=backing_format,
+                )
+                if self.backing_handle is not None:
+                    build_utils.rebase_image(
+                        tmp_dst, self.backing_handle, backing_format
+                    )
+                os.rename(tmp_dst, dst)
+            finally:
+                if path.exists(tmp_dst):
+                    os.unlink(tmp_dst)
+            self.uncompressed_image_path = dst
+            hashes = build_utils.get_hashes(dst, checksums)
+            compressed_hashes = hashes
+        elif self.codec.magic is None:
+            # Published as is
+            if self.built_image_path != dst:
+                shutil.move(self.built_image_path, dst)
+                self.uncompressed_image_path = dst
+            hashes = build_utils.get_hashes(dst, checksums)
+            compressed_hashes = hashes
+        elif self.seekable:
+            block_size = seekable.DEFAULT_BLOCK_SIZE
+            with LogTask('Compressing {} by blocks with {}'.format(
+                self.built_image_path, self.codec.name
+            )):
+                hashes, compressed_hashes, index = seekable.compress_file(
+                    self.built_image_path,
+                    dst,
+                    compress_cmd=self.codec.block_compressor(
+                        block_size, level
+                    ),
+                    block_size=block_size,
+                    jobs=self.compression_threads or None,
+                    checksums=checksums,
+                    compressed_checksums=checksums,
+                )
+            self.spec.props['compression_block_size'] = block_size
+            self.spec.props['compressed_blocks'] = index
+        else:
+            hashes, compressed_hashes = build_utils.compress_and_hash(
+                self.built_image_path,
+                dst,
+                compress_cmd=self.codec.compress_cmd(
+                    level, self.compression_threads
+                ),
+                checksums=checksums,
+                compressed_checksums=checksums,
+            )
+        self.built_image_path = dst
         self.compressed = True
+        return hashes, compressed_hashes
 
 
 class LibguestFSImage(Image):
-    def custom_build_action(self, *args, **kwargs):
-        build_utils.virt_builder(
-            base_image=self.base_image,
-            dst_image=self.dst_path,
-            commands_file=self.spec.commands_file
+    def get_base_fingerprint(self):
+        return json.dumps(
+            build_utils.virt_builder_template_info(self.base_image),
+            sort_keys=True,
         )
 
-        build_utils.virt_sysprep(
-            dst_image=self.dst_path
-        )
+    def get_base_download_size(self):
+        # virt-builder keeps its own cache of the templates, this is the
+        # worst case
+        return build_utils.virt_builder_template_info(
+            self.base_image
+        ).get('compressed_size')
 
-        build_utils.virt_sprsify(
-            dst_image=self.dst_path
-        )
+    def custom_build_action(self, *args, **kwargs):
+        # virt-builder customizes on its own appliance anyway
+        with self.metrics.measure('virt-builder'):
+            dst_image = self.work_path(path.basename(self.dst_path))
+            build_utils.virt_builder(
+                base_image=self.base_image,
+                dst_image=dst_image,
+                commands_file=self.spec.commands_file
+            )
+
+        self.prepare_guest(dst_image, customize=False)
 
-        return self.dst_path
+        return dst_image
 
 
 class LayeredImage(Image):
+    """
+    Image built as a qcow2 overlay of its base, published flattened or as
+    a thin overlay, see :data:`LAYERED_MODES`
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.layered = get_layered_mode(self.spec, self.layered)
+        self.spec.props['layered'] = self.layered
+
+    def _backing_metadata(self):
+        """
+        Returns:
+            tuple(str, dict): handle and metadata of the published image the
+                base of this one is
+
+        Raises:
+            LagoImagesBuildException: if the base is not a published image
+                of the repo of this one
+        """
+        if self.backing_image is not None:
+            return (
+                path.basename(self.backing_image.dst_path),
+                self.backing_image.spec.props,
+            )
+
+        base_path = build_utils.strip_compression_ext(self.base_image)
+        handle = path.basename(base_path)
+        if build_utils.is_url(self.base_image) or not createrepo.is_published(
+            path.dirname(self.dst_path), handle
+        ):
+            raise LagoImagesBuildException(
+                'Can not publish {} as an overlay of {}, it is not a '
+                'published image of the same repo'.format(
+                    self.spec.name, self.base_image
+                )
+            )
+
+        with open(base_path + '.metadata') as metadata_fd:
+            return handle, json.load(metadata_fd)
+
     def custom_build_action(self, *args, **kwargs):
-        base_image_path = build_utils.get_uncompressed_file(
-            self.base_image, self.dst_path
-        )
-        layered_image_path = path.join(
-            self.dst_path,
-            self.spec.name
-        )
+        if self.layered == LAYERED_OVERLAY:
+            # Before building it, the base might not be usable
+            self.backing_handle, backing_props = self._backing_metadata()
 
-        build_utils.create_layered_image(
-            dst_image=layered_image_path,
-            base_image=base_image_path
+        # The base is only used as backing file, it can be shared
+        base_image_path = self.get_base_image_file(
+            self.work_path(path.basename(self.dst_path) + '.base'),
+            writable=False,
         )
+        if self.workspace is None:
+            self._intermediates.append(base_image_path)
+        layered_image_path = self.work_path(path.basename(self.dst_path))
 
-        build_utils.virt_customize(
-            dst_image=layered_image_path,
-            commands_file=self.spec.commands_file
-        )
+        with self.metrics.measure('layer'):
+            build_utils.create_layered_image(
+                dst_image=layered_image_path,
+                base_image=base_image_path
+            )
 
-        build_utils.virt_sysprep(
-            dst_image=layered_image_path
-        )
+        self.prepare_guest(layered_image_path)
 
-        build_utils.virt_sprsify(
-            dst_image=layered_image_path
-        )
+        if self.layered == LAYERED_OVERLAY:
+            self.backing_path = base_image_path
+            self.spec.props['backing_handle'] = self.backing_handle
+            self.spec.props['backing_sha1'] = backing_props['sha1']
+            self.spec.props['backing_checksum'] = backing_props['checksum']
+        elif self.finalize != FINALIZE_QCOW2:
+            # The qcow2 conversion flattens it already
+            flat_image_path = layered_image_path + '.flat'
+            with self.metrics.measure('flatten'):
+                build_utils.qcow2_convert(
+                    layered_image_path,
+                    flat_image_path,
+                    compress=False,
+                    coroutines=self.qcow2_coroutines,
+                )
+            os.rename(flat_image_path, layered_image_path)
 
         return layered_image_path
 
@@ -164,8 +934,8 @@ class LayeredImage(Image):
 class SimpleImage(Image):
     def custom_build_action(self, *args, **kwargs):
         try:
-            base_image_path = build_utils.get_uncompressed_file(
-                self.base_image, self.dst_path
+            base_image_path = self.get_base_image_file(
+                self.work_path(path.basename(self.dst_path))
             )
 
         except (OSError, HTTPError) as e:
@@ -180,27 +950,69 @@ class SimpleImage(Image):
         if getattr(self.spec, 'meta_data_only', None):
                 return base_image_path
 
-        build_utils.virt_customize(
-            dst_image=base_image_path,
-            commands_file=self.spec.commands_file
-        )
-
-        build_utils.virt_sysprep(
-            dst_image=base_image_path
-        )
-
-        build_utils.virt_sprsify(
-            dst_image=base_image_path
-        )
+        self.prepare_guest(base_image_path)
 
         return base_image_path
 
 
-def get_instance(spec, dst_path):
+def get_instance(
+    spec,
+    dst_path,
+    base=None,
+    base_store=None,
+    single_appliance=False,
+    publish_delta=False,
+    seekable=False,
+    compression_name=None,
+    compression_level=None,
+    compression_threads=0,
+    workspace=None,
+    finalize=None,
+    qcow2_compression=None,
+    qcow2_coroutines=DEFAULT_QCOW2_COROUTINES,
+    layered=None,
+    backing_image=None,
+):
+    """
+    Args:
+        spec (spec.Spec): spec of the image
+        dst_path (str): Path to build the image on
+        base (str): <image_type>:<base_image> to use instead of the spec one
+        base_store (basestore.BaseImageStore): Store to get the base images
+            from, if None they are downloaded or copied every time
+        single_appliance (bool): Customize, sysprep and sparsify the image
+            in a single libguestfs appliance when possible
+        publish_delta (bool): Also publish the delta from the newest
+            published version of the image, see :meth:`Image.create_delta`
+        seekable (bool): Compress the image by blocks, and add the block
+            index to its metadata, see :mod:`seekable`
+        compression_name (str): codec to compress the image with, if its
+            spec has no compression prop, see :mod:`compression`
+        compression_level (int): level of the codec, if its spec has no
+            compression_level prop, the default of the codec if None
+        compression_threads (int): threads to compress with, 0 to use all
+            the cpus
+        workspace (workspace.Workspace): Workspace to build the image in,
+            if None it's built in the repo dir
+        finalize (one of FINALIZE_MODES): how to turn the built image into
+            the published one, if its spec has no finalize prop, compressed
+            with the codec by default
+        qcow2_compression (one of QCOW2_COMPRESSION_TYPES): compression of
+            the clusters of the images finalized as qcow2, if its spec has
+            no qcow2_compression prop, zlib by default
+        qcow2_coroutines (int): parallel coroutines of the qcow2 conversions
+        layered (one of LAYERED_MODES): how to publish the layered images,
+            if its spec has no layered prop, flattened by default
+        backing_image (Image): image of the spec this one is based on, to
+            publish it as an overlay of
+
+    Returns:
+        Image: instance of the image class matching the base image type
+    """
     p = re.compile(
         r'(?P<image_type>.*?):(?P<base_image>.*)'
     )
-    m = p.match(spec.base)
+    m = p.match(base or spec.base)
     if not m:
         raise RuntimeError(
             dedent(
@@ -233,10 +1045,57 @@ def get_instance(spec, dst_path):
     )
 
     return image_type_to_cls[d['image_type']](
-        spec, dst_path, d['base_image']
+        spec,
+        dst_path,
+        d['base_image'],
+        base_store=base_store,
+        single_appliance=single_appliance,
+        publish_delta=publish_delta,
+        seekable=seekable,
+        compression_name=compression_name,
+        compression_level=compression_level,
+        compression_threads=compression_threads,
+        workspace=workspace,
+        finalize=finalize,
+        qcow2_compression=qcow2_compression,
+        qcow2_coroutines=qcow2_coroutines,
+        layered=layered,
+        backing_image=backing_image,
     )
 
 
+def get_layered_mode(spec, layered=None):
+    """
+    Returns:
+        str: how to publish the image of the spec if layered, the layered
+            prop of the spec wins over the given default
+
+    Raises:
+        LagoImagesBuildException: if it's not one of LAYERED_MODES
+    """
+    layered = spec.props.get('layered') or layered or LAYERED_FLATTEN
+    if layered not in LAYERED_MODES:
+        raise LagoImagesBuildException(
+            'Unknown layered mode {} of {}, should be one of {}'.format(
+                layered, spec.id, ', '.join(LAYERED_MODES)
+            )
+        )
+
+    return layered
+
+
+def base_reference(spec, base_path, layered=None):
+    """
+    Returns:
+        str: the base to build the image of the spec on, when it's based on
+            the image of another spec at base_path, see :func:`get_instance`
+    """
+    if get_layered_mode(spec, layered) == LAYERED_OVERLAY:
+        return 'layer:' + base_path
+
+    return 'simple:' + base_path
+
+
 image_type_to_cls = {
     'libguestfs': LibguestFSImage,
     'layer': LayeredImage,
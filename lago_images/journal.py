@@ -0,0 +1,267 @@
+"""
+Journal of the image builds of a run, to resume them if the run dies
+
+Each stage an image completes (see :data:`images.STAGES`) is recorded in a
+json file in the repo dir, along with the path, size and sha1 (or inode
+and mtime, see below) of the artifact it produced and the state of the
+image needed to go on from there. If the run dies, from an OOM of the
+libguestfs appliance or a network error, the next run validates the
+artifacts of each image against the journal and resumes it at its first
+incomplete stage, with the same version, instead of building it
+again. The journal is removed once a run completes.
+
+An image is only resumed if its spec and base did not change, by the same
+key the build cache uses, minus the tool versions. The files of the builds
+that can be resumed are kept in the workspace when the run fails.
+
+The uncompressed image is not hashed when it's built, as that costs a
+whole read of it, the size, inode and mtime it had then tell if it changed
+since instead. The compressed artifacts are hashed while compressing them
+anyway.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+import build_utils
+import cache
+import hashing
+import images
+
+LOGGER = logging.getLogger(__name__)
+
+JOURNAL_FILE = '.build-journal.json'
+JOURNAL_VERSION = 1
+
+
+def _artifact(file_path, size, sha1):
+    return {'path': file_path, 'size': size, 'sha1': sha1}
+
+
+def _stat_artifact(file_path):
+    stat = os.stat(file_path)
+    return {
+        'path': file_path,
+        'size': stat.st_size,
+        'inode': stat.st_ino,
+        'mtime': stat.st_mtime,
+    }
+
+
+def _hashes_to_dict(hashes):
+    return {'digests': hashes.digests, 'size': hashes.size}
+
+
+def _hashes_from_dict(hashes):
+    return hashing.HashResult(hashes['digests'], hashes['size'], 0)
+
+
+def _remove(file_path):
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path, ignore_errors=True)
+    elif os.path.exists(file_path):
+        os.unlink(file_path)
+
+
+class Journal(object):
+    def __init__(self, repo_dir):
+        """
+        Args:
+            repo_dir (str): Repo dir the images are built for, the journal
+                is kept in it
+        """
+        self.path = os.path.join(repo_dir, JOURNAL_FILE)
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as journal_fd:
+                journal = json.load(journal_fd)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        if journal.get('version') != JOURNAL_VERSION:
+            LOGGER.warning('Ignoring journal %s of another version', self.path)
+            return {}
+
+        return journal['images']
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as journal_fd:
+            json.dump(
+                {'version': JOURNAL_VERSION, 'images': self._entries},
+                journal_fd,
+                indent=2,
+            )
+        os.rename(tmp_path, self.path)
+
+    @staticmethod
+    def spec_digest(spec, base):
+        """
+        Args:
+            spec (spec.Spec): spec of the image, before building it
+            base (str): fingerprint of the base image, or its reference if
+                there's no cheap one
+
+        Returns:
+            str: what has to be the same for a build to be resumed
+        """
+        return cache.build_key(spec, base, tool_versions={})
+
+    def get(self, spec_id, digest):
+        """
+        Returns:
+            dict or None: the journal entry of the image of the spec, None
+                if there's none or it's from another version of the spec,
+                the latter is discarded along with its files
+        """
+        with self._lock:
+            entry = self._entries.get(spec_id)
+            if entry is None or entry['digest'] == digest:
+                return entry
+
+        LOGGER.info(
+            '%s changed since its journal entry, discarding it', spec_id
+        )
+        self.discard(spec_id)
+        return None
+
+    def start(self, spec_id, digest, handle, version):
+        """
+        Records that the image of the spec is being built as handle
+        """
+        with self._lock:
+            self._entries[spec_id] = {
+                'digest': digest,
+                'handle': handle,
+                'version': version,
+                'stages': {},
+            }
+            self._save()
+
+    def record(self, spec_id, image, stage):
+        """
+        Records that the image completed the given stage, used as the
+        checkpoint callback of the images, see
+        :meth:`images.Image.checkpoint`
+
+        Args:
+            spec_id (str): id of the spec of the image
+            image (images.Image): the image
+            stage (one of images.STAGES): the completed stage
+
+        Returns:
+            None
+        """
+        data = {'state': image.journal_state()}
+        if stage == images.STAGE_BUILT:
+            data['artifact'] = _stat_artifact(image.built_image_path)
+        elif stage == images.STAGE_COMPRESSED:
+            hashes, compressed_hashes = image.compress_hashes
+            data['artifact'] = _artifact(
+                image.built_image_path,
+                compressed_hashes.size,
+                compressed_hashes['sha1'],
+            )
+            data['hashes'] = _hashes_to_dict(hashes)
+            data['compressed_hashes'] = _hashes_to_dict(compressed_hashes)
+        else:
+            data['artifact'] = _artifact(
+                image.built_image_path,
+                image.spec.props['compressed_size'],
+                image.spec.props['compressed_sha1'],
+            )
+
+        with self._lock:
+            entry = self._entries.get(spec_id)
+            if entry is None:
+                return
+            entry['stages'][stage] = data
+            self._save()
+
+    def _is_valid(self, artifact):
+        file_path = artifact['path']
+        if not os.path.isfile(file_path) or \
+                os.path.getsize(file_path) != artifact['size']:
+            return False
+
+        if artifact.get('sha1') is None:
+            stat = os.stat(file_path)
+            return (
+                stat.st_ino == artifact['inode']
+                and stat.st_mtime == artifact['mtime']
+            )
+
+        return build_utils.get_hash(file_path, 'sha1') == artifact['sha1']
+
+    def resume(self, image, entry):
+        """
+        Restores the image to the last stage of its journal entry whose
+        artifact is still valid
+
+        Args:
+            image (images.Image): the image, as built with the handle of
+                the entry
+            entry (dict): its journal entry, see :func:`get`
+
+        Returns:
+            str or None: the stage it was resumed at, None if there's none
+                to resume it from
+        """
+        for stage in reversed(images.STAGES):
+            data = entry['stages'].get(stage)
+            if data is None:
+                continue
+
+            if not self._is_valid(data['artifact']):
+                LOGGER.warning(
+                    'The %s artifact of %s does not match the journal',
+                    stage,
+                    entry['handle'],
+                )
+                continue
+
+            LOGGER.info(
+                'Resuming %s from its %s stage', entry['handle'], stage
+            )
+            if stage == images.STAGE_PUBLISHED:
+                image.load_published(image.dst_path)
+            else:
+                image.restore_journal_state(
+                    data['state'],
+                    compress_hashes=(
+                        _hashes_from_dict(data['hashes']),
+                        _hashes_from_dict(data['compressed_hashes']),
+                    ) if stage == images.STAGE_COMPRESSED else None,
+                )
+            return stage
+
+        return None
+
+    def discard(self, spec_id):
+        """
+        Removes the entry of the image of the spec, along with the
+        intermediate files of its build
+        """
+        with self._lock:
+            entry = self._entries.pop(spec_id, None)
+            if entry is None:
+                return
+            self._save()
+
+        for data in entry['stages'].values():
+            for file_path in data['state']['intermediates']:
+                _remove(file_path)
+
+    def remove(self):
+        """
+        Removes the journal, once all its images are published
+        """
+        with self._lock:
+            self._entries = {}
+            if os.path.exists(self.path):
+                os.unlink(self.path)
@@ -0,0 +1,284 @@
+"""
+Per stage resource usage of the image builds
+
+Each stage records its wall time, cpu time (of this process and its reaped
+children), the peak RSS of its children and the bytes read from and
+written to storage, as reported by ``/proc/self/io`` (which includes the
+reaped children too).
+
+Except for the wall time, those counters are process wide, so they are only
+recorded for the stages that ran alone, with no stage of another thread
+running at the same time. When several images are built or published in
+parallel, the overlapping stages only get their wall time, use a single job
+and publish worker to get all of them. The peak RSS of the children is a
+lifetime peak too, so it's only known for the stages whose children raised
+it.
+"""
+import csv
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+
+# Outside of the repo dir, so the reports are not served along the images
+DEFAULT_REPORT_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'lago-images', 'build-stats'
+)
+
+FIELDS = (
+    'wall_seconds',
+    'cpu_seconds',
+    'children_max_rss_kb',
+    'read_bytes',
+    'write_bytes',
+)
+
+
+def read_proc_io():
+    """
+    Returns:
+        tuple(int, int): bytes read from and written to storage by this
+            process and its reaped children, None if not available
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as io_fd:
+            for line in io_fd:
+                key, _, value = line.partition(':')
+                counters[key.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        return None, None
+
+    return counters.get('read_bytes'), counters.get('write_bytes')
+
+
+def _cpu_seconds():
+    times = os.times()
+    # user, system, children user, children system
+    return sum(times[:4])
+
+
+def _delta(end, start):
+    if end is None or start is None:
+        return None
+
+    return end - start
+
+
+class _Measurement(object):
+    def __init__(self):
+        self.thread = threading.current_thread().ident
+        self.shared = False
+
+
+_active_lock = threading.Lock()
+_active = set()
+
+
+def _start_measurement():
+    measurement = _Measurement()
+    with _active_lock:
+        for other in _active:
+            # Nested stages of the same thread are part of the outer one
+            if other.thread != measurement.thread:
+                other.shared = measurement.shared = True
+        _active.add(measurement)
+
+    return measurement
+
+
+def _end_measurement(measurement):
+    """
+    Returns:
+        bool: If the measurement overlapped a stage of another thread
+    """
+    with _active_lock:
+        _active.discard(measurement)
+
+    return measurement.shared
+
+
+def _children_max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+class StageMetrics(object):
+    def __init__(
+        self,
+        stage,
+        wall_seconds,
+        cpu_seconds=None,
+        children_max_rss_kb=None,
+        read_bytes=None,
+        write_bytes=None,
+    ):
+        self.stage = stage
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.children_max_rss_kb = children_max_rss_kb
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    def to_dict(self):
+        data = OrderedDict([('stage', self.stage)])
+        for field in FIELDS:
+            data[field] = getattr(self, field)
+
+        return data
+
+
+class StageRecorder(object):
+    """
+    Collects the metrics of the stages of a single image build
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+
+    @contextmanager
+    def measure(self, stage):
+        """
+        Records the metrics of whatever runs inside this context manager
+        as the given stage, even if it fails. Only the wall time is
+        recorded if a stage of another thread ran at the same time
+        """
+        measurement = _start_measurement()
+        start_wall = time.time()
+        start_cpu = _cpu_seconds()
+        start_rss = _children_max_rss_kb()
+        start_read, start_write = read_proc_io()
+        try:
+            yield
+        finally:
+            end_read, end_write = read_proc_io()
+            end_rss = _children_max_rss_kb()
+            stage_metrics = StageMetrics(
+                stage=stage,
+                wall_seconds=time.time() - start_wall,
+            )
+            if not _end_measurement(measurement):
+                stage_metrics.cpu_seconds = _cpu_seconds() - start_cpu
+                stage_metrics.read_bytes = _delta(end_read, start_read)
+                stage_metrics.write_bytes = _delta(end_write, start_write)
+                if end_rss > start_rss:
+                    stage_metrics.children_max_rss_kb = end_rss
+            self.stages.append(stage_metrics)
+
+    def add(self, stage, wall_seconds, **kwargs):
+        """
+        Records an already measured stage, see :class:`StageMetrics`
+        """
+        self.stages.append(StageMetrics(stage, wall_seconds, **kwargs))
+
+    def rows(self):
+        """
+        Returns:
+            list of OrderedDict: one row per stage, with the image name
+        """
+        rows = []
+        for stage in self.stages:
+            row = OrderedDict([('image', self.name)])
+            row.update(stage.to_dict())
+            rows.append(row)
+
+        return rows
+
+    def format(self):
+        return ', '.join(
+            '{}={:.1f}s'.format(stage.stage, stage.wall_seconds)
+            for stage in self.stages
+        )
+
+
+def _atomic_open(file_path):
+    return open(file_path + '.tmp', 'w')
+
+
+def _atomic_commit(file_path):
+    os.rename(file_path + '.tmp', file_path)
+
+
+def write_json(file_path, recorders):
+    with _atomic_open(file_path) as report_fd:
+        json.dump(
+            [
+                {'image': recorder.name, 'stages': [
+                    stage.to_dict() for stage in recorder.stages
+                ]}
+                for recorder in recorders
+            ],
+            report_fd,
+            indent=2,
+        )
+    _atomic_commit(file_path)
+
+
+def write_csv(file_path, recorders):
+    with _atomic_open(file_path) as report_fd:
+        writer = csv.DictWriter(
+            report_fd, fieldnames=('image', 'stage') + FIELDS
+        )
+        writer.writeheader()
+        for recorder in recorders:
+            writer.writerows(recorder.rows())
+    _atomic_commit(file_path)
+
+
+def write_prometheus(file_path, recorders):
+    """
+    Writes the metrics in the node_exporter textfile collector format, the
+    file is replaced atomically so the collector never reads half of it
+    """
+    with _atomic_open(file_path) as prom_fd:
+        for field in FIELDS:
+            metric = 'lago_images_stage_{}'.format(field)
+            prom_fd.write('# TYPE {} gauge\n'.format(metric))
+            for recorder in recorders:
+                for stage in recorder.stages:
+                    value = getattr(stage, field)
+                    if value is None:
+                        continue
+                    prom_fd.write(
+                        '{}{{image="{}",stage="{}"}} {}\n'.format(
+                            metric,
+                            _escape_label(recorder.name),
+                            _escape_label(stage.stage),
+                            value,
+                        )
+                    )
+    _atomic_commit(file_path)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+def write_reports(report_dir, recorders, name, prometheus_textfile=None):
+    """
+    Writes the JSON and CSV reports of the given recorders
+
+    Args:
+        report_dir (str): Dir to write the reports in
+        recorders (list of StageRecorder): metrics to write
+        name (str): base name of the report files
+        prometheus_textfile (str): if given, also write the metrics there
+
+    Returns:
+        None
+    """
+    if not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+
+    write_json(os.path.join(report_dir, name + '.json'), recorders)
+    write_csv(os.path.join(report_dir, name + '.csv'), recorders)
+    if prometheus_textfile:
+        write_prometheus(prometheus_textfile, recorders)
@@ -0,0 +1,372 @@
+"""
+Dry run of a repo build, see ``--plan``
+
+Finds out which images :func:`cmd.generate_repo` would restore from the
+build cache and which ones it would build, the same way it does, by the
+cache key of each image (its spec and the fingerprint of its base), and
+estimates what each of them would cost from the stage metrics of the
+previous runs (see :mod:`metrics`). Nothing is built or published.
+
+An image based on another spec is always built if its base is, as its
+cache key depends on the checksum of the built base.
+"""
+import glob
+import json
+import logging
+import os
+
+import createrepo
+import images
+import scheduler
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of previous runs to average the stage metrics over
+DEFAULT_HISTORY_RUNS = 5
+
+CACHED = 'cached'
+BUILD = 'build'
+
+
+class StageHistory(object):
+    """
+    Stage metrics of the previous runs, from the run reports written to
+    the report dir, see :func:`metrics.write_reports`
+    """
+
+    def __init__(self, runs):
+        """
+        Args:
+            runs (list of list of dict): contents of each run report,
+                oldest first
+        """
+        self._builds = {}
+        self._restores = {}
+        for run in runs:
+            for record in run:
+                stages = dict(
+                    (stage['stage'], stage) for stage in record['stages']
+                )
+                if 'cache-restore' in stages:
+                    samples = self._restores
+                else:
+                    samples = self._builds
+                samples.setdefault(record['image'], []).append(stages)
+
+    @classmethod
+    def load(cls, report_dir, max_runs=DEFAULT_HISTORY_RUNS):
+        """
+        Args:
+            report_dir (str): Dir the run reports were written to
+            max_runs (int): Number of the newest runs to load
+
+        Returns:
+            StageHistory: the history of those runs, empty if there are
+                none
+        """
+        runs = []
+        run_files = sorted(glob.glob(os.path.join(report_dir, 'run-*.json')))
+        for run_file in run_files[-max_runs:]:
+            try:
+                with open(run_file) as run_fd:
+                    runs.append(json.load(run_fd))
+            except (IOError, OSError, ValueError):
+                LOGGER.debug('Ignoring broken run report %s', run_file)
+
+        return cls(runs)
+
+    def _average(self, samples, name, field):
+        totals = [
+            sum(stage[field] or 0 for stage in stages.values())
+            for stages in samples.get(name, [])
+        ]
+        if not totals:
+            return None
+
+        return sum(totals) / float(len(totals))
+
+    def build_seconds(self, name):
+        """
+        Returns:
+            float or None: average wall time of the builds of the image,
+                including its publishing, None if it was never built
+        """
+        return self._average(self._builds, name, 'wall_seconds')
+
+    def build_write_bytes(self, name):
+        return self._average(self._builds, name, 'write_bytes')
+
+    def restore_seconds(self, name):
+        return self._average(self._restores, name, 'wall_seconds')
+
+
+class PlanEntry(object):
+    def __init__(
+        self,
+        name,
+        action,
+        reason,
+        parent=None,
+        duration=None,
+        disk=None,
+        download=None,
+        props=None,
+    ):
+        """
+        Args:
+            name (str): id of the spec
+            action (one of CACHED, BUILD): what would be done with it
+            reason (str): why
+            parent (str): id of the spec it's based on, if any
+            duration (float): estimated seconds it'd take, None if unknown
+            disk (int): estimated bytes it'd take on disk, None if unknown
+            download (int): estimated bytes it'd download, None if unknown
+            props (dict): metadata of the cached image, if cached
+        """
+        self.name = name
+        self.action = action
+        self.reason = reason
+        self.parent = parent
+        self.duration = duration
+        self.disk = disk
+        self.download = download
+        self.props = props
+
+    def to_dict(self):
+        return dict(
+            (key, getattr(self, key)) for key in (
+                'name', 'action', 'reason', 'parent', 'duration', 'disk',
+                'download'
+            )
+        )
+
+
+def _dependency_order(spec_objs, spec_ids):
+    by_id = dict((spec_obj.id, spec_obj) for spec_obj in spec_objs)
+    ordered = []
+    visited = set()
+
+    def _visit(spec_obj):
+        if spec_obj.id in visited:
+            return
+        visited.add(spec_obj.id)
+        parent = scheduler.get_base_reference(spec_obj, spec_ids)
+        if parent:
+            _visit(by_id[parent])
+        ordered.append(spec_obj)
+
+    for spec_obj in spec_objs:
+        _visit(spec_obj)
+
+    return ordered
+
+
+def _cached_props(entry):
+    with open(
+        os.path.join(entry.path, entry.info['image'] + '.metadata')
+    ) as metadata_fd:
+        return json.load(metadata_fd)
+
+
+def _published_disk(repo_dir, template):
+    props = createrepo.newest_published_props(repo_dir, template) or {}
+    if not props.get('size') or not props.get('compressed_size'):
+        return None
+
+    # The uncompressed image is kept until it's compressed
+    return props['size'] + props['compressed_size']
+
+
+def plan_repo(
+    spec_objs,
+    repo_dir,
+    run_version,
+    build_cache=None,
+    image_opts=None,
+    history=None,
+):
+    """
+    Args:
+        spec_objs (list of spec.Spec): specs of the repo
+        repo_dir (str): Path the repo would be generated on
+        run_version (str): version the images without one would get
+        build_cache (cache.BuildCache): Cache the images would be restored
+            from, if None all of them would be built
+        image_opts (dict): Extra options for :func:`images.get_instance`
+        history (StageHistory): metrics of the previous runs to estimate
+            with, if None only the sizes are estimated
+
+    Returns:
+        list of PlanEntry: what would be done with each spec, the bases
+            before the specs based on them
+    """
+    history = history or StageHistory([])
+    spec_ids = set(spec_obj.id for spec_obj in spec_objs)
+    ordered = _dependency_order(spec_objs, spec_ids)
+    entries = {}
+    for spec_obj in ordered:
+        parent = scheduler.get_base_reference(spec_obj, spec_ids)
+        parent_entry = entries.get(parent)
+        opts = dict(image_opts or {})
+        base = None
+        base_fingerprint = None
+        if parent_entry is not None:
+            opts['base_store'] = None
+            base = images.base_reference(
+                spec_obj,
+                os.path.join(repo_dir, parent),
+                opts.get('layered'),
+            )
+            if parent_entry.action == CACHED:
+                base_fingerprint = parent_entry.props['checksum']
+
+        image = images.get_instance(
+            spec_obj,
+            os.path.join(
+                repo_dir,
+                createrepo.version_handle(
+                    spec_obj.name,
+                    spec_obj.props.get('version') or run_version,
+                ),
+            ),
+            base=base,
+            **opts
+        )
+
+        cache_entry = None
+        if build_cache is None:
+            reason = 'no build cache'
+        elif parent_entry is not None and parent_entry.action != CACHED:
+            reason = 'its base {} is built'.format(parent)
+        else:
+            cache_key = image.get_cache_key(base_fingerprint)
+            if cache_key is None:
+                reason = 'its base has no fingerprint'
+            else:
+                cache_entry = build_cache.get(cache_key, touch=False)
+                reason = 'not in the build cache'
+
+        if cache_entry is not None:
+            props = _cached_props(cache_entry)
+            entry = PlanEntry(
+                name=spec_obj.id,
+                action=CACHED,
+                reason='up to date in the build cache',
+                parent=parent,
+                duration=history.restore_seconds(spec_obj.id) or 0,
+                disk=props.get('compressed_size'),
+                download=0,
+                props=props,
+            )
+        else:
+            disk = _published_disk(repo_dir, spec_obj.name)
+            if disk is None:
+                disk = history.build_write_bytes(spec_obj.id)
+            entry = PlanEntry(
+                name=spec_obj.id,
+                action=BUILD,
+                reason=reason,
+                parent=parent,
+                duration=history.build_seconds(spec_obj.id),
+                disk=disk,
+                download=(
+                    0 if parent_entry is not None
+                    else image.get_base_download_size()
+                ),
+            )
+
+        entries[spec_obj.id] = entry
+
+    return [entries[spec_obj.id] for spec_obj in ordered]
+
+
+def estimate_duration(entries, jobs=1):
+    """
+    Args:
+        entries (list of PlanEntry): the plan
+        jobs (int): Max number of images built at the same time
+
+    Returns:
+        float: estimated seconds the whole run would take, the longest
+            chain of dependent images or the total split among the jobs,
+            whichever is longer, the images without estimate count as 0
+    """
+    by_name = dict((entry.name, entry) for entry in entries)
+    chains = {}
+
+    def _chain(entry):
+        if entry.name not in chains:
+            chains[entry.name] = (entry.duration or 0) + (
+                _chain(by_name[entry.parent]) if entry.parent else 0
+            )
+        return chains[entry.name]
+
+    longest = max([_chain(entry) for entry in entries] or [0])
+    total = sum(entry.duration or 0 for entry in entries)
+    return max(longest, total / float(max(1, jobs)))
+
+
+def _format_bytes(size):
+    if size is None:
+        return '?'
+
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.0
+
+    return '{:.1f}TiB'.format(size)
+
+
+def _format_secs(secs):
+    if secs is None:
+        return '?'
+
+    return '{:.0f}s'.format(secs)
+
+
+def _sum(values):
+    return sum(value or 0 for value in values)
+
+
+def format_plan(entries, jobs=1):
+    to_build = [entry for entry in entries if entry.action == BUILD]
+    lines = [
+        '{:<30} {:<7} {:>9} {:>10} {:>10}  {}'.format(
+            'image', 'action', 'duration', 'disk', 'download', 'reason'
+        )
+    ]
+    for entry in entries:
+        lines.append(
+            '{:<30} {:<7} {:>9} {:>10} {:>10}  {}'.format(
+                entry.name,
+                entry.action,
+                _format_secs(entry.duration),
+                _format_bytes(entry.disk),
+                _format_bytes(entry.download),
+                entry.reason,
+            )
+        )
+
+    lines.append(
+        '{} of {} images to build, estimated {} with {} jobs, {} of disk, '
+        '{} to download'.format(
+            len(to_build),
+            len(entries),
+            _format_secs(estimate_duration(entries, jobs)),
+            jobs,
+            _format_bytes(_sum(entry.disk for entry in entries)),
+            _format_bytes(_sum(entry.download for entry in entries)),
+        )
+    )
+    unknown = [
+        entry.name for entry in to_build if entry.duration is None
+    ]
+    if unknown:
+        lines.append(
+            'No previous builds of {}, their duration is not included'.format(
+                ', '.join(unknown)
+            )
+        )
+
+    return '\n'.join(lines)
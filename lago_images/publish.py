@@ -0,0 +1,103 @@
+"""
+Asynchronous publishing of the built images
+
+Building an image is mostly I/O and appliance bound, while publishing it
+(compressing and hashing it, see :meth:`images.Image.publish`) is CPU
+bound, so they overlap well. Once built, images are put in a queue that a
+pool of publish workers consumes, while the builders move on to the next
+images.
+
+The queue is bounded, so builders block once there are too many built
+images waiting to be published, as each of them takes the disk space of
+its uncompressed image.
+"""
+import functools
+import logging
+import threading
+
+from future.moves.queue import Queue
+
+from lago import log_utils
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+DEFAULT_WORKERS = 1
+DEFAULT_DEPTH = 2
+
+
+class PublishException(Exception):
+    pass
+
+
+class PublishQueue(object):
+    def __init__(self, workers=DEFAULT_WORKERS, depth=DEFAULT_DEPTH):
+        """
+        Args:
+            workers (int): Number of images to publish at the same time
+            depth (int): Max number of built images waiting to be
+                published, :func:`submit` blocks while it's reached
+        """
+        self.workers = max(1, workers)
+        self.depth = depth
+        self.errors = []
+        self._queue = Queue(maxsize=max(1, depth))
+        self._lock = threading.Lock()
+        self._threads = []
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,
+                name='publish-{}'.format(index),
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            name, action = item
+            try:
+                action()
+            except Exception as e:
+                LOGGER.exception('Failed to publish %s', name)
+                with self._lock:
+                    self.errors.append((name, e))
+
+    def submit(self, name, action):
+        """
+        Queues the publishing of an image, blocking while the queue is full
+
+        Args:
+            name (str): name of the image, for the logs
+            action (callable): publishes the image
+
+        Returns:
+            None
+        """
+        LOGGER.debug('Queueing %s to be published', name)
+        self._queue.put((name, action))
+
+    def drain(self):
+        """
+        Waits for all the queued images to be published, and stops the
+        workers, no more images can be submitted afterwards
+
+        Raises:
+            PublishException: if any of them failed to publish
+        """
+        with LogTask('Waiting for the queued images to be published'):
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+
+        if self.errors:
+            raise PublishException(
+                'Failed to publish {}'.format(
+                    ', '.join(name for name, _ in self.errors)
+                )
+            )
@@ -0,0 +1,333 @@
+"""
+Parallel build scheduling of images that might depend on each other
+
+Specs can use other specs as their base, by setting their base prop to the
+id (file name) of the other spec, for example::
+
+    #base=el7-base
+
+Those references make a DAG that is run on a pool of worker threads, where
+each node is started as soon as all of its parents are done, as long as it
+fits in the cpu, memory and disk budgets.
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from lago import log_utils
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+# Rough needs of a single image build, a libguestfs appliance plus the
+# uncompressed and compressed copies of the image
+DEFAULT_BUILD_MEMORY = 2048
+DEFAULT_BUILD_DISK = 20
+
+
+class BuildSchedulerException(Exception):
+    pass
+
+
+def default_jobs():
+    # Each build runs an appliance plus a multi-threaded xz, leave room
+    return max(1, multiprocessing.cpu_count() // 2)
+
+
+def total_memory():
+    """
+    Returns:
+        int: Physical memory of this host in MiB
+    """
+    return (
+        os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') //
+        (1024 * 1024)
+    )
+
+
+def free_disk(dir_path):
+    """
+    Returns:
+        int: Free space in GiB of the filesystem holding dir_path
+    """
+    stat = os.statvfs(dir_path)
+    return stat.f_bavail * stat.f_frsize // (1024 * 1024 * 1024)
+
+
+def get_base_reference(spec, spec_ids):
+    """
+    Args:
+        spec (spec.Spec): spec to get the base of
+        spec_ids (set of str): ids of all the specs being built
+
+    Returns:
+        str or None: id of the spec the given one is based on, if any
+    """
+    base = spec.base
+    if ':' in base:
+        return None
+
+    if base not in spec_ids:
+        raise BuildSchedulerException(
+            'Spec {} is based on {}, which is not one of the specs being '
+            'built'.format(spec.id, base)
+        )
+
+    return base
+
+
+class ResourceBudget(object):
+    """
+    Tracks how many jobs, memory (MiB) and disk (GiB) are in use
+    """
+
+    def __init__(self, jobs, memory, disk):
+        self.jobs = jobs
+        self.memory = memory
+        self.disk = disk
+        self.used_jobs = 0
+        self.used_memory = 0
+        self.used_disk = 0
+
+    def fits(self, node):
+        # Always allow a single build, even if it's bigger than the budget
+        if self.used_jobs == 0:
+            return True
+
+        return (
+            self.used_jobs + 1 <= self.jobs
+            and self.used_memory + node.memory <= self.memory
+            and self.used_disk + node.disk <= self.disk
+        )
+
+    def acquire(self, node):
+        self.used_jobs += 1
+        self.used_memory += node.memory
+        self.used_disk += node.disk
+
+    def release(self, node):
+        self.used_jobs -= 1
+        self.used_memory -= node.memory
+        self.used_disk -= node.disk
+
+
+class BuildNode(object):
+    """
+    A single build in the DAG
+
+    Attributes:
+        name (str): Unique name of this node
+        action (callable): called with the results of the parents, in the
+            same order, to run the build, its return value is this node
+            result
+        parents (list of str): names of the nodes this one depends on
+        memory (int): memory needed to run it, in MiB
+        disk (int): disk needed to run it, in GiB
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(
+        self,
+        name,
+        action,
+        parents=None,
+        memory=DEFAULT_BUILD_MEMORY,
+        disk=DEFAULT_BUILD_DISK,
+    ):
+        self.name = name
+        self.action = action
+        self.parents = parents or []
+        self.memory = memory
+        self.disk = disk
+        self.status = self.PENDING
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+
+        return self.end_time - self.start_time
+
+
+class BuildScheduler(object):
+    def __init__(self, nodes, budget):
+        """
+        Args:
+            nodes (list of BuildNode): nodes to run, the ones without
+                dependencies between them will be started in this order
+            budget (ResourceBudget): resources available for the builds
+        """
+        self.nodes = OrderedDict((node.name, node) for node in nodes)
+        self.budget = budget
+        self._cond = threading.Condition()
+        self._start_time = None
+        self._verify()
+
+    def _verify(self):
+        for node in self.nodes.values():
+            for parent in node.parents:
+                if parent not in self.nodes:
+                    raise BuildSchedulerException(
+                        'Unknown dependency {} of {}'.format(parent, node.name)
+                    )
+
+        visited = set()
+        in_progress = set()
+
+        def _visit(node):
+            if node.name in visited:
+                return
+            if node.name in in_progress:
+                raise BuildSchedulerException(
+                    'Dependency cycle found at {}'.format(node.name)
+                )
+            in_progress.add(node.name)
+            for parent in node.parents:
+                _visit(self.nodes[parent])
+            in_progress.remove(node.name)
+            visited.add(node.name)
+
+        for node in self.nodes.values():
+            _visit(node)
+
+    def _ready_nodes(self):
+        for node in self.nodes.values():
+            if node.status != BuildNode.PENDING:
+                continue
+
+            parents_status = set(
+                self.nodes[parent].status for parent in node.parents
+            )
+            if parents_status & {BuildNode.FAILED, BuildNode.SKIPPED}:
+                LOGGER.error(
+                    'Skipping %s, one of its dependencies failed', node.name
+                )
+                node.status = BuildNode.SKIPPED
+                continue
+
+            if parents_status <= {BuildNode.DONE}:
+                yield node
+
+    def _run_node(self, node):
+        try:
+            node.result = node.action(
+                *[self.nodes[parent].result for parent in node.parents]
+            )
+            status = BuildNode.DONE
+        except Exception as e:
+            LOGGER.exception('Failed to build %s', node.name)
+            node.error = e
+            status = BuildNode.FAILED
+
+        with self._cond:
+            node.end_time = time.time()
+            node.status = status
+            self.budget.release(node)
+            self._cond.notify_all()
+
+    def _start_ready_nodes(self):
+        started = False
+        for node in list(self._ready_nodes()):
+            if not self.budget.fits(node):
+                continue
+
+            self.budget.acquire(node)
+            node.status = BuildNode.RUNNING
+            node.start_time = time.time()
+            thread = threading.Thread(
+                target=self._run_node,
+                args=(node, ),
+                name='build-{}'.format(node.name),
+            )
+            thread.daemon = True
+            thread.start()
+            started = True
+
+        return started
+
+    def _pending(self):
+        return any(
+            node.status in (BuildNode.PENDING, BuildNode.RUNNING)
+            for node in self.nodes.values()
+        )
+
+    def run(self):
+        """
+        Runs all the nodes, waiting for them to finish
+
+        Returns:
+            None
+
+        Raises:
+            BuildSchedulerException: if any of the nodes failed
+        """
+        self._start_time = time.time()
+        with self._cond:
+            while self._pending():
+                self._start_ready_nodes()
+                self._cond.wait(1)
+
+        LOGGER.info(self.format_report())
+        failed = [
+            node.name for node in self.nodes.values()
+            if node.status != BuildNode.DONE
+        ]
+        if failed:
+            raise BuildSchedulerException(
+                'Failed to build {}'.format(', '.join(failed))
+            )
+
+    def report(self):
+        """
+        Returns:
+            list of dict: status and timings of each node, times relative to
+                the start of the run
+        """
+        entries = []
+        for node in self.nodes.values():
+            entry = {
+                'name': node.name,
+                'status': node.status,
+                'parents': node.parents,
+                'start': None,
+                'duration': node.duration,
+            }
+            if node.start_time is not None:
+                entry['start'] = node.start_time - self._start_time
+            entries.append(entry)
+
+        return entries
+
+    def format_report(self):
+        lines = ['Build timings:']
+        for entry in self.report():
+            lines.append(
+                '  {name:<30} {status:<8} {start:>10} {duration:>10}'.format(
+                    name=entry['name'],
+                    status=entry['status'],
+                    start=_format_secs(entry['start']),
+                    duration=_format_secs(entry['duration']),
+                )
+            )
+
+        return '\n'.join(lines)
+
+
+def _format_secs(secs):
+    if secs is None:
+        return '-'
+
+    return '{:.1f}s'.format(secs)
@@ -0,0 +1,356 @@
+"""
+Seekable compression, made of independently compressed blocks
+
+The input is split in fixed size blocks, and each of them is compressed on
+its own, in parallel, into a complete stream (for xz) or frame (for zstd).
+Both tools decompress concatenated streams as a single file, so the result
+is still a regular compressed file, but with the index of the blocks, as
+returned by :func:`compress_file`, any block can be decompressed on its own:
+in parallel, see :func:`decompress_file`, or after fetching just its byte
+range, see :func:`block_ranges` and :func:`decompress_url`.
+
+The index is a list with the ``[offset, size]`` of each compressed block,
+the uncompressed offset of block ``i`` is ``i * block_size``.
+
+The blocks that are all holes of a sparse file are not read nor compressed
+again, they all get the same compressed block of zeros.
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+
+from lago import log_utils
+
+import download
+import fastcopy
+import hashing
+
+LOGGER = logging.getLogger(__name__)
+LogTask = functools.partial(log_utils.LogTask, logger=LOGGER)
+
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class SeekableException(Exception):
+    pass
+
+
+def default_jobs():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _run_filter(cmd, data):
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise SeekableException(
+            '{} failed with {}: {}'.format(
+                ' '.join(cmd), proc.returncode, err.decode('utf-8', 'replace')
+            )
+        )
+    return out
+
+
+def _bounded(iterable, semaphore, stop):
+    # ThreadPool.imap consumes its input as fast as it can, this keeps the
+    # blocks in flight bounded
+    for item in iterable:
+        semaphore.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+
+def _read_blocks(src_fd, block_size, hasher):
+    """
+    Yields:
+        tuple(bytes, bool): data of each block, and if it's all a hole of
+            the file, those are not read
+    """
+    size = os.fstat(src_fd.fileno()).st_size
+    segments = fastcopy.data_segments(src_fd.fileno(), size)
+    segment = next(segments, None)
+    zeros = None
+    offset = 0
+    while offset < size:
+        length = min(block_size, size - offset)
+        while segment is not None and sum(segment) <= offset:
+            segment = next(segments, None)
+
+        is_hole = segment is None or segment[0] >= offset + length
+        if is_hole:
+            if zeros is None:
+                zeros = bytes(bytearray(block_size))
+            data = zeros[:length]
+        else:
+            src_fd.seek(offset)
+            data = src_fd.read(length)
+            if not data:
+                # The file was truncated while reading it
+                return
+
+        if hasher is not None:
+            hasher.update(data)
+        yield data, is_hole
+        offset += len(data)
+
+
+def compress_file(
+    src,
+    dst,
+    compress_cmd,
+    block_size=DEFAULT_BLOCK_SIZE,
+    jobs=None,
+    checksums=(),
+    compressed_checksums=(),
+):
+    """
+    Compresses src into dst block by block, see the module docs
+
+    Args:
+        src (str): Path of the file to compress
+        dst (str): Path of the compressed file, it's written to dst.tmp
+            and renamed once complete
+        compress_cmd (list of str or callable): Command that compresses
+            its stdin into its stdout as a single stream, or function that
+            compresses the data it gets, see
+            :meth:`compression.Codec.block_compressor`
+        block_size (int): Uncompressed size of each block
+        jobs (int): Max blocks to compress at the same time, defaults to
+            the number of cpus
+        checksums (list of str): digests to calculate over src
+        compressed_checksums (list of str): digests to calculate over dst
+
+    Returns:
+        tuple(hashing.HashResult, hashing.HashResult, list): digests of the
+            uncompressed and compressed data, and the block index
+    """
+    jobs = jobs or default_jobs()
+    if callable(compress_cmd):
+        compress = compress_cmd
+    else:
+        compress = functools.partial(_run_filter, compress_cmd)
+    compressed_holes = {}
+    holes_lock = threading.Lock()
+
+    def _compress(block):
+        data, is_hole = block
+        if not is_hole:
+            return compress(data)
+
+        with holes_lock:
+            if len(data) not in compressed_holes:
+                compressed_holes[len(data)] = compress(data)
+            return compressed_holes[len(data)]
+
+    hasher = hashing.MultiHasher(checksums) if checksums else None
+    output_hasher = (
+        hashing.MultiHasher(compressed_checksums)
+        if compressed_checksums else None
+    )
+    semaphore = threading.Semaphore(jobs * 2)
+    stop = threading.Event()
+    index = []
+    offset = 0
+    tmp_dst = dst + '.tmp'
+    pool = ThreadPool(jobs)
+    try:
+        with open(src, 'rb') as src_fd, open(tmp_dst, 'wb') as dst_fd:
+            blocks = _bounded(
+                _read_blocks(src_fd, block_size, hasher), semaphore, stop
+            )
+            for compressed in pool.imap(_compress, blocks):
+                dst_fd.write(compressed)
+                if output_hasher is not None:
+                    output_hasher.update(compressed)
+                index.append([offset, len(compressed)])
+                offset += len(compressed)
+                semaphore.release()
+    except Exception:
+        # Unblock the reader, if it's waiting for a free slot
+        stop.set()
+        semaphore.release()
+        if os.path.exists(tmp_dst):
+            os.unlink(tmp_dst)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    os.rename(tmp_dst, dst)
+    return (
+        hasher.result() if hasher else None,
+        output_hasher.result() if output_hasher else None,
+        index,
+    )
+
+
+def _is_zero(data, zero_block):
+    return data == zero_block[:len(data)]
+
+
+def decompress_blocks(
+    read_block,
+    dst,
+    index,
+    block_size,
+    decompress_cmd,
+    jobs=None,
+):
+    """
+    Decompresses the given blocks into dst in parallel, skipping the write
+    of the blocks that are all zeros, so dst stays sparse
+
+    Args:
+        read_block (callable): gets the offset and size of a compressed
+            block and returns its data
+        dst (str): Path of the decompressed file, it's written to dst.tmp
+            and renamed once complete
+        index (list): Block index of src, see :func:`compress_file`
+        block_size (int): Uncompressed size of each block
+        decompress_cmd (list of str): Command that decompresses its stdin
+            into its stdout
+        jobs (int): Max blocks to decompress at the same time, defaults to
+            the number of cpus
+
+    Returns:
+        str: dst
+    """
+    jobs = jobs or default_jobs()
+    zero_block = bytearray(block_size)
+    tmp_dst = dst + '.tmp'
+    sizes = {}
+    dst_fd = os.open(tmp_dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            def _decompress(block):
+                number, (offset, size) = block
+                out = _run_filter(decompress_cmd, read_block(offset, size))
+                sizes[number] = len(out)
+                if not _is_zero(out, zero_block):
+                    _pwrite(dst_fd, out, number * block_size)
+
+            pool = ThreadPool(jobs)
+            try:
+                # list() to raise the first error, if any
+                list(pool.imap_unordered(_decompress, enumerate(index)))
+            finally:
+                pool.close()
+                pool.join()
+
+            os.ftruncate(dst_fd, sum(sizes.values()))
+        finally:
+            os.close(dst_fd)
+    except Exception:
+        os.unlink(tmp_dst)
+        raise
+
+    os.rename(tmp_dst, dst)
+    return dst
+
+
+def decompress_file(src, dst, index, block_size, decompress_cmd, jobs=None):
+    """
+    Decompresses the local file src into dst, see :func:`decompress_blocks`
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        with LogTask('Decompressing {} by blocks'.format(src)):
+            return decompress_blocks(
+                lambda offset, size: _pread(src_fd, size, offset),
+                dst,
+                index,
+                block_size,
+                decompress_cmd,
+                jobs,
+            )
+    finally:
+        os.close(src_fd)
+
+
+def decompress_url(url, dst, index, block_size, decompress_cmd, jobs=None):
+    """
+    Downloads and decompresses the blocks of url into dst, with a range
+    request for each block, see :func:`decompress_blocks`
+    """
+    jobs = jobs or default_jobs()
+    session = download.new_session(jobs)
+
+    def _read_block(offset, size):
+        r = session.get(
+            url,
+            headers={'Range': 'bytes={}-{}'.format(offset, offset + size - 1)},
+        )
+        r.raise_for_status()
+        if r.status_code != 206 or len(r.content) != size:
+            raise SeekableException(
+                '{} ignored the range request'.format(url)
+            )
+        return r.content
+
+    with LogTask('Downloading and decompressing {} by blocks'.format(url)):
+        return decompress_blocks(
+            _read_block, dst, index, block_size, decompress_cmd, jobs
+        )
+
+
+# Python 2 has no pread/pwrite, there the file offset is shared
+_seek_lock = threading.Lock()
+
+
+def _pread(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def _pwrite(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def block_ranges(index, block_size, offset, length):
+    """
+    Args:
+        index (list): Block index of the compressed file
+        block_size (int): Uncompressed size of each block
+        offset (int): Start of the uncompressed range
+        length (int): Length of the uncompressed range
+
+    Returns:
+        list of tuple(int, int, int): number, compressed offset and
+            compressed size of each block needed to decompress the range,
+            for HTTP range requests
+    """
+    if length <= 0:
+        return []
+
+    first = offset // block_size
+    last = min((offset + length - 1) // block_size, len(index) - 1)
+    return [
+        (number, index[number][0], index[number][1])
+        for number in range(first, last + 1)
+    ]
@@ -1,27 +1,138 @@
+"""
+Image specs, virt-builder commands files with a header of props::
+
+    #property1=value1
+    #property2=value2
+    command1
+    command2
+
+Only the header is scanned for props, it ends at the first line that is not
+a comment. The parsed props of each spec can be kept in a :class:`SpecIndex`,
+so unchanged specs are not parsed again on each run.
+"""
+import errno
+import fnmatch
+import hashlib
+import json
 import re
 import os
 
+DEFAULT_INDEX_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'lago-images', 'spec-index.json'
+)
+DEFAULT_SPEC_PATTERN = '*'
+# Files in the spec dirs that are never specs, like editor leftovers
+IGNORED_SPEC_PATTERNS = ('.*', '*~', '*.swp', '*.bak', '*.orig', '*.rej')
+
+PROP_REGEX = re.compile(
+    r'^#(?P<prop_key>[^\s=]+)\s*=\s*(?P<prop_value>.*)\s*$'
+)
+
+
+def is_spec_file(file_name, pattern=DEFAULT_SPEC_PATTERN):
+    """
+    Args:
+        file_name (str): name of the file
+        pattern (str): shell pattern the spec file names match
+
+    Returns:
+        bool: If the file is a spec
+    """
+    if any(
+        fnmatch.fnmatch(file_name, ignored)
+        for ignored in IGNORED_SPEC_PATTERNS
+    ):
+        return False
+
+    return fnmatch.fnmatch(file_name, pattern)
+
+
+def parse_props(lines):
+    """
+    Args:
+        lines (iterable of str): lines of the spec
+
+    Returns:
+        dict of str: str: props of the header of the spec
+    """
+    props = {}
+    for line in lines:
+        if not line.startswith('#'):
+            if not line.strip():
+                continue
+            # First command, the end of the header
+            break
+
+        match = PROP_REGEX.match(line)
+        if match:
+            props[match.group('prop_key')] = match.group('prop_value')
+
+    return props
+
+
+class _Prop(object):
+    """
+    Attribute of the spec that maps to one of its props
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __get__(self, spec, owner):
+        if spec is None:
+            return self
+
+        try:
+            return spec.props[self.key]
+        except KeyError:
+            raise AttributeError(
+                "'%s' object has no attribute '%s'"
+                % (owner.__name__, self.key)
+            )
+
+
 class Spec(object):
-    prop_regex = re.compile(
-        r'^#(?P<prop_key>[^\s=]+)\s*=\s*(?P<prop_value>.*)\s*$'
-    )
+    __slots__ = ('props', 'commands_file')
+
     required_props = set((
         'name',
     ))
 
+    # The known props, the rest are still reachable as attributes, just
+    # slower, see __getattr__
+    id = _Prop('id')
+    name = _Prop('name')
+    base = _Prop('base')
+    distro = _Prop('distro')
+    osinfo = _Prop('osinfo')
+    arch = _Prop('arch')
+    expand = _Prop('expand')
+    version = _Prop('version')
+    compression = _Prop('compression')
+    compression_level = _Prop('compression_level')
+    finalize = _Prop('finalize')
+    layered = _Prop('layered')
+
     def __init__(self, props, commands_file):
         self.props = props
         self.commands_file = commands_file
 
     @classmethod
-    def from_spec_file(cls, spec_file):
-        props = {}
-        with open(spec_file) as spec_fd:
-            for line in spec_fd.readlines():
-                match = cls.prop_regex.match(line)
-                if match:
-                    prop = match.groupdict()
-                    props[prop['prop_key']] = prop['prop_value']
+    def from_spec_file(cls, spec_file, index=None):
+        """
+        Args:
+            spec_file (str): path to the spec
+            index (SpecIndex): index to get the props of the spec from, if
+                it did not change since it was indexed
+
+        Returns:
+            Spec: the loaded spec
+        """
+        if index is not None:
+            props = index.get_props(spec_file)
+        else:
+            with open(spec_file) as spec_fd:
+                props = parse_props(spec_fd)
 
         props['id'] = os.path.basename(spec_file)
         new_spec = cls(props=props, commands_file=spec_file)
@@ -38,7 +149,8 @@ class Spec(object):
             )
 
     def __getattr__(self, what):
-        if what in self.props:
+        # Only called for the props without their own attribute
+        if what != 'props' and what in self.props:
             return self.props[what]
 
         raise AttributeError(
@@ -58,6 +170,8 @@ class LagoSpec(Spec):
     * name: Name of the template
     * distro: Distribution of the template os (fc23/el7...)
     """
+    __slots__ = ()
+
     required_props = Spec.required_props.union(
         {
             'base',
@@ -78,6 +192,8 @@ class VirtBuilderSpec(Spec):
     * expand: The disk partition to expand when generating images from the
         template, like /dev/sda3
     """
+    __slots__ = ()
+
     required_props = Spec.required_props.union(
         {
             'base',
@@ -92,6 +208,103 @@ class AllSpec(Spec):
     """
     Spec file format that has to match all the other specs, required props:
     """
+    __slots__ = ()
+
     required_props = LagoSpec.required_props.union(
         VirtBuilderSpec.required_props
     )
+
+
+SPEC_CLASSES = {
+    'lago': LagoSpec,
+    'virt-builder': VirtBuilderSpec,
+    'all': AllSpec,
+}
+
+
+def get_spec_cls(repo_format):
+    """
+    Args:
+        repo_format (one of 'all', 'lago', 'virt-builder'): Format of the
+            repo
+
+    Returns:
+        type: the spec class of that repo format, AllSpec if unknown
+    """
+    return SPEC_CLASSES.get(repo_format, AllSpec)
+
+
+def _file_stat(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_mtime, stat.st_size, stat.st_ino]
+
+
+class SpecIndex(object):
+    """
+    Parsed props of the specs, by their absolute path
+
+    A spec is only parsed again if its mtime, size or inode changed and so
+    did the sha256 of its content.
+    """
+
+    def __init__(self, index_path=DEFAULT_INDEX_PATH):
+        self.index_path = index_path
+        self.parsed = 0
+        self._dirty = False
+        try:
+            with open(index_path) as index_fd:
+                self.entries = json.load(index_fd)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get_props(self, spec_file):
+        """
+        Returns:
+            dict of str: str: a copy of the props of the spec, safe to
+                modify
+        """
+        key = os.path.abspath(spec_file)
+        stat = _file_stat(key)
+        entry = self.entries.get(key)
+        if entry is not None and entry['stat'] == stat:
+            return dict(entry['props'])
+
+        with open(key, 'rb') as spec_fd:
+            content = spec_fd.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if entry is not None and entry['sha256'] == digest:
+            props = entry['props']
+        else:
+            props = parse_props(content.decode('utf-8').splitlines())
+            self.parsed += 1
+
+        self.entries[key] = {'stat': stat, 'sha256': digest, 'props': props}
+        self._dirty = True
+        return dict(props)
+
+    def save(self):
+        """
+        Writes the index, without the specs that don't exist anymore, if
+        anything changed
+        """
+        for key in list(self.entries):
+            if not os.path.exists(key):
+                del self.entries[key]
+                self._dirty = True
+
+        if not self._dirty:
+            return
+
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            try:
+                os.makedirs(index_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_fd:
+            json.dump(self.entries, index_fd)
+        os.rename(tmp_path, self.index_path)
+        self._dirty = False
@@ -0,0 +1,221 @@
+"""
+Scratch space for the intermediate files of the builds
+
+Each image is built in its own dir of the scratch dir, with its base image
+and any other intermediate file, and only the published artifacts (the
+compressed image, its metadata and hash) are written to the repo dir. The
+dir is removed once the image is published, or at the end of the run for
+the images other specs are based on.
+
+Small images, the ones whose last published version was under a
+threshold, can be built in a faster scratch dir, like a tmpfs or an NVMe
+drive. Before building, the predicted sizes of the image are checked
+against the free space of the scratch and repo dirs, minus what the
+builds already running reserved, so the builds fail up front instead of
+halfway through a multi GiB step.
+"""
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+SCRATCH_DIR_NAME = '.workspace'
+# In GiB
+DEFAULT_FAST_THRESHOLD = 4
+# Room on top of the predicted sizes, images grow between versions
+SIZE_MARGIN = 1.2
+
+
+class WorkspaceException(Exception):
+    pass
+
+
+def free_bytes(dir_path):
+    """
+    Returns:
+        int: Free space in bytes of the filesystem holding dir_path
+    """
+    stat = os.statvfs(dir_path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _makedirs(dir_path):
+    try:
+        os.makedirs(dir_path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _format_gib(size):
+    return '{:.1f}GiB'.format(size / (1024.0 * 1024 * 1024))
+
+
+class ImageWorkspace(object):
+    """
+    Scratch dir of a single image
+    """
+
+    def __init__(self, workspace, dir_path, reservations):
+        self.workspace = workspace
+        self.dir_path = dir_path
+        self._reservations = reservations
+
+    def path(self, name):
+        return os.path.join(self.dir_path, name)
+
+    def cleanup(self):
+        """
+        Removes the dir with all its files, and releases the space reserved
+        for it
+        """
+        if self.dir_path is None:
+            return
+
+        LOGGER.debug('Removing workspace %s', self.dir_path)
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+        self.dir_path = None
+        self.workspace.release(self._reservations)
+
+
+class Workspace(object):
+    def __init__(
+        self,
+        scratch_dir=None,
+        fast_dir=None,
+        fast_threshold=DEFAULT_FAST_THRESHOLD * 1024 * 1024 * 1024,
+        default_size=None,
+    ):
+        """
+        Args:
+            scratch_dir (str): Path to build the images in, defaults to a
+                hidden dir of the repo dir of each image
+            fast_dir (str): Path to build the small images in, a tmpfs or
+                NVMe mount for example
+            fast_threshold (int): Max predicted size in bytes of the images
+                built in fast_dir
+            default_size (int): Size in bytes to assume for the images
+                never published before, if None their free space is not
+                checked
+        """
+        self.scratch_dir = scratch_dir
+        self.fast_dir = fast_dir
+        self.fast_threshold = fast_threshold
+        self.default_size = default_size
+        self._lock = threading.Lock()
+        # Bytes reserved by the running builds, by filesystem
+        self._reserved = {}
+        self._created = set()
+
+    def _free(self, dir_path):
+        return free_bytes(dir_path) - self._reserved.get(
+            os.stat(dir_path).st_dev, 0
+        )
+
+    def _scratch_dir(self, repo_dir):
+        dir_path = self.scratch_dir or os.path.join(repo_dir, SCRATCH_DIR_NAME)
+        if not os.path.isdir(dir_path):
+            _makedirs(dir_path)
+            self._created.add(dir_path)
+        return dir_path
+
+    def _candidates(self, repo_dir, size):
+        if self.fast_dir and size is not None and \
+                size <= self.fast_threshold:
+            yield self.fast_dir
+        yield self._scratch_dir(repo_dir)
+
+    def allocate(self, name, repo_dir, size=None, compressed_size=None):
+        """
+        Reserves the space for an image and creates its scratch dir
+
+        Args:
+            name (str): Name of the image, for the dir name and the logs
+            repo_dir (str): Repo the image will be published on
+            size (int): Predicted uncompressed size of the image, in bytes
+            compressed_size (int): Predicted size of its published
+                artifacts, in bytes
+
+        Returns:
+            ImageWorkspace: the scratch dir of the image
+
+        Raises:
+            WorkspaceException: if the predicted sizes don't fit in the
+                free space
+        """
+        predicted = size is not None
+        if not predicted:
+            size = self.default_size or 0
+        need = int(size * SIZE_MARGIN)
+        repo_need = int((compressed_size or size) * SIZE_MARGIN)
+
+        with self._lock:
+            for dir_path in self._candidates(repo_dir, size if predicted
+                                             else None):
+                if self._free(dir_path) >= need:
+                    break
+                LOGGER.debug(
+                    'No room for %s in %s, %s needed',
+                    name,
+                    dir_path,
+                    _format_gib(need),
+                )
+            else:
+                self._no_room(name, dir_path, need, predicted)
+
+            scratch_dev = os.stat(dir_path).st_dev
+            repo_dev = os.stat(repo_dir).st_dev
+            # The scratch dir is in the repo dir by default, both have to
+            # fit then
+            repo_total = repo_need
+            if repo_dev == scratch_dev:
+                repo_total += need
+            if self._free(repo_dir) < repo_total:
+                self._no_room(name, repo_dir, repo_total, predicted)
+
+            reservations = [(scratch_dev, need), (repo_dev, repo_need)]
+            for dev, reserved in reservations:
+                self._reserved[dev] = self._reserved.get(dev, 0) + reserved
+
+            image_dir = tempfile.mkdtemp(prefix=name + '.', dir=dir_path)
+
+        LOGGER.debug(
+            'Building %s in %s, %s reserved', name, image_dir,
+            _format_gib(need)
+        )
+        return ImageWorkspace(self, image_dir, reservations)
+
+    def _no_room(self, name, dir_path, need, predicted):
+        msg = 'Not enough free space for {} in {}, {} needed, {} free'.format(
+            name,
+            dir_path,
+            _format_gib(need),
+            _format_gib(max(0, self._free(dir_path))),
+        )
+        if predicted:
+            raise WorkspaceException(msg)
+
+        # Only a guess, the build might still fit
+        LOGGER.warning(msg)
+
+    def release(self, reservations, locked=False):
+        if not locked:
+            with self._lock:
+                return self.release(reservations, locked=True)
+
+        for dev, reserved in reservations:
+            self._reserved[dev] -= reserved
+
+    def close(self):
+        """
+        Removes the scratch dirs this workspace created, if empty
+        """
+        for dir_path in self._created:
+            try:
+                os.rmdir(dir_path)
+            except OSError:
+                LOGGER.debug('Keeping non empty workspace %s', dir_path)
@@ -0,0 +1,147 @@
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import cache  # noqa: E402
+import spec as spec_module  # noqa: E402
+
+
+def _write(file_path, content):
+    with open(file_path, 'w') as file_fd:
+        file_fd.write(content)
+
+
+class BuildCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        os.mkdir(self.src_dir)
+        _write(os.path.join(self.src_dir, 'image.xz'), 'x' * 1000)
+        _write(os.path.join(self.src_dir, 'image.metadata'), '{}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _put(self, build_cache, key):
+        entry = build_cache.put(
+            key,
+            src_dir=self.src_dir,
+            files=['image.xz', 'image.metadata'],
+            info={'image': 'image'},
+        )
+        # The mtime of the entries is their last use
+        then = time.time() - 100 + len(build_cache.entries())
+        os.utime(os.path.join(entry.path, 'entry.json'), (then, then))
+        return entry
+
+    def _keys(self):
+        return sorted(
+            os.path.basename(entry.path)
+            for entry in cache.BuildCache(self.cache_dir).entries()
+        )
+
+    def test_put_and_restore(self):
+        build_cache = cache.BuildCache(self.cache_dir)
+        self._put(build_cache, 'a')
+
+        entry = build_cache.get('a')
+        dst_dir = os.path.join(self.tmp_dir, 'dst')
+        entry.restore(dst_dir)
+
+        self.assertEqual(entry.info, {'image': 'image'})
+        self.assertEqual(
+            sorted(os.listdir(dst_dir)), ['image.metadata', 'image.xz']
+        )
+        self.assertIsNone(build_cache.get('b'))
+
+    def test_evict_least_recently_used(self):
+        build_cache = cache.BuildCache(self.cache_dir)
+        for key in ('a', 'b', 'c'):
+            self._put(build_cache, key)
+        size = build_cache.get('a', touch=False).size()
+
+        # Makes a the most recently used one
+        build_cache.get('a')
+        build_cache.max_size = size * 2
+        build_cache.evict()
+
+        self.assertEqual(self._keys(), ['a', 'c'])
+
+    def test_evict_skipped_while_in_use(self):
+        build_cache = cache.BuildCache(self.cache_dir)
+        self._put(build_cache, 'a')
+        build_cache.max_size = 0
+
+        lock_path = os.path.join(self.cache_dir, cache.LOCK_FILE)
+        with cache._flocked(lock_path, fcntl.LOCK_SH):
+            build_cache.evict()
+            self.assertEqual(self._keys(), ['a'])
+
+        build_cache.evict()
+        self.assertEqual(self._keys(), [])
+
+    def test_restore_replaced_entry(self):
+        build_cache = cache.BuildCache(self.cache_dir)
+        self._put(build_cache, 'a')
+        entry = build_cache.get('a')
+
+        self._put(build_cache, 'a')
+
+        with self.assertRaises(cache.CacheException):
+            entry.restore(os.path.join(self.tmp_dir, 'dst'))
+
+
+class BuildKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _key(self, content, base='base', **props):
+        spec_file = os.path.join(self.tmp_dir, 'spec')
+        _write(spec_file, content)
+        spec_props = {'name': 'el7'}
+        spec_props.update(props)
+        spec = spec_module.Spec(props=spec_props, commands_file=spec_file)
+        return cache.build_key(spec, base, tool_versions={})
+
+    def test_normalized_commands(self):
+        self.assertEqual(
+            self._key('#name=el7\nrun-command true\n'),
+            self._key('#name=el7\n\n# comment\nrun-command true  \n'),
+        )
+        self.assertNotEqual(
+            self._key('run-command true\n'),
+            self._key('run-command false\n'),
+        )
+
+    def test_build_props_ignored(self):
+        self.assertEqual(
+            self._key('run-command true\n'),
+            self._key('run-command true\n', sha1='1234', size='10'),
+        )
+        self.assertNotEqual(
+            self._key('run-command true\n'),
+            self._key('run-command true\n', distro='el8'),
+        )
+
+    def test_base(self):
+        self.assertNotEqual(
+            self._key('run-command true\n'),
+            self._key('run-command true\n', base='other'),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import createrepo  # noqa: E402
+
+DAY = 24 * 60 * 60
+NOW = 100 * DAY
+
+
+def _entry(template, days_ago, backing=None):
+    entry = {
+        'template': template,
+        'handle': '{}-{}'.format(template, days_ago),
+        'timestamp': NOW - days_ago * DAY,
+    }
+    if backing is not None:
+        entry['backing'] = {'handle': backing}
+    return entry
+
+
+def _entries(*entries):
+    return dict((entry['handle'] + '.metadata', entry) for entry in entries)
+
+
+class SelectExpiredTest(unittest.TestCase):
+    def setUp(self):
+        self.entries = _entries(
+            _entry('el7', 1),
+            _entry('el7', 5),
+            _entry('el7', 10),
+            _entry('el7', 20),
+            _entry('fc30', 30),
+        )
+
+    def test_no_policy(self):
+        self.assertEqual(createrepo.select_expired(self.entries), [])
+
+    def test_keep_versions(self):
+        self.assertEqual(
+            createrepo.select_expired(self.entries, keep_versions=2, now=NOW),
+            ['el7-10.metadata', 'el7-20.metadata'],
+        )
+
+    def test_keep_days(self):
+        self.assertEqual(
+            createrepo.select_expired(self.entries, keep_days=7, now=NOW),
+            ['el7-10.metadata', 'el7-20.metadata'],
+        )
+
+    def test_keep_versions_or_days(self):
+        self.assertEqual(
+            createrepo.select_expired(
+                self.entries, keep_versions=3, keep_days=7, now=NOW
+            ),
+            ['el7-20.metadata'],
+        )
+
+    def test_newest_always_kept(self):
+        self.assertEqual(
+            createrepo.select_expired(
+                self.entries, keep_versions=1, keep_days=0, now=NOW
+            ),
+            ['el7-10.metadata', 'el7-20.metadata', 'el7-5.metadata'],
+        )
+
+    def test_backings_kept(self):
+        entries = _entries(
+            _entry('base', 1),
+            _entry('base', 10),
+            _entry('base', 20),
+            _entry('app', 1, backing='base-20'),
+        )
+
+        self.assertEqual(
+            createrepo.select_expired(entries, keep_versions=1, now=NOW),
+            ['base-10.metadata'],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
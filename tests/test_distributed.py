@@ -0,0 +1,94 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import distributed  # noqa: E402
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = distributed.JobQueue(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _age(self, file_path, secs):
+        then = time.time() - secs
+        os.utime(file_path, (then, then))
+
+    def test_claim_oldest_first(self):
+        self.queue.submit({'id': 'a'})
+        self.queue.submit({'id': 'b'})
+        self._age(os.path.join(self.queue.pending_dir, 'b.json'), 60)
+
+        claim = self.queue.claim('w1')
+
+        self.assertEqual(claim.job, {'id': 'b'})
+        self.assertEqual(claim.worker_id, 'w1')
+        self.assertEqual(self.queue.claims('b'), [claim.path])
+        self.assertEqual(self.queue.claim('w2').job, {'id': 'a'})
+        self.assertIsNone(self.queue.claim('w3'))
+
+    def test_complete(self):
+        self.queue.submit({'id': 'a'})
+        claim = self.queue.claim('w1')
+
+        self.assertTrue(self.queue.complete(claim, {'status': 'done'}))
+
+        self.assertEqual(self.queue.claims('a'), [])
+        self.assertEqual(self.queue.pop_result('a'), {'status': 'done'})
+        self.assertIsNone(self.queue.pop_result('a'))
+
+    def test_requeue_stale_claim(self):
+        self.queue.submit({'id': 'a'})
+        claim = self.queue.claim('w1')
+
+        self.assertEqual(self.queue.drop_stale_claims('a', timeout=60), [])
+        self._age(claim.path, 120)
+        self.assertEqual(
+            self.queue.drop_stale_claims('a', timeout=60), ['w1']
+        )
+
+        # The dead worker lost it, and the job can be claimed again
+        self.assertFalse(claim.heartbeat())
+        self.queue.submit(claim.job)
+        new_claim = self.queue.claim('w2')
+        self.assertEqual(new_claim.job, {'id': 'a'})
+        self.assertFalse(self.queue.complete(claim, {'status': 'done'}))
+        self.assertIsNone(self.queue.pop_result('a'))
+        self.assertTrue(self.queue.complete(new_claim, {'status': 'done'}))
+
+    def test_withdraw(self):
+        self.queue.submit({'id': 'a'})
+        claim = self.queue.claim('w1')
+        self.queue.submit({'id': 'a'})
+
+        self.queue.withdraw('a')
+
+        self.assertEqual(self.queue.claims('a'), [])
+        self.assertIsNone(self.queue.claim('w2'))
+        self.assertFalse(claim.heartbeat())
+
+    def test_heartbeat_check(self):
+        self.queue.submit({'id': 'a'})
+        claim = self.queue.claim('w1')
+        heartbeat = distributed._Heartbeat(claim, interval=60)
+
+        heartbeat.check()
+        self.queue.withdraw('a')
+
+        with self.assertRaises(distributed.ClaimLostException):
+            heartbeat.check()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from future.moves.http.server import BaseHTTPRequestHandler, HTTPServer
+from future.moves.socketserver import ThreadingMixIn
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import download  # noqa: E402
+
+PAYLOAD = os.urandom(1024 * 1024)
+RANGE_REGEX = re.compile(r'bytes=(\d+)-(\d*)$')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves PAYLOAD, with or without range support, and cuts the next
+    response short if the server is told to
+    """
+
+    def _send_headers(self, status, length, content_range=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', '"payload"')
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_headers(200, len(PAYLOAD))
+
+    def do_GET(self):
+        match = RANGE_REGEX.match(self.headers.get('Range') or '')
+        self.server.ranges_requested.append(self.headers.get('Range'))
+        if self.server.ranges and match:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(PAYLOAD) - 1)
+            body = PAYLOAD[start:end + 1]
+            self._send_headers(
+                206,
+                len(body),
+                'bytes {}-{}/{}'.format(start, end, len(PAYLOAD)),
+            )
+        else:
+            body = PAYLOAD
+            self._send_headers(200, len(body))
+
+        if self.server.truncate_after is not None:
+            body = body[:self.server.truncate_after]
+            self.server.truncate_after = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dst = os.path.join(self.tmp_dir, 'image')
+        self.server = _HTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.ranges = True
+        self.server.truncate_after = None
+        self.server.ranges_requested = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}/image'.format(
+            self.server.server_address[1]
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _downloader(self):
+        return download.Downloader(self.url, self.dst, chunk_size=4096)
+
+    def _read_dst(self):
+        with open(self.dst, 'rb') as dst_fd:
+            return dst_fd.read()
+
+    def assert_no_leftovers(self):
+        self.assertFalse(os.path.exists(self.dst + '.part'))
+        self.assertFalse(os.path.exists(self.dst + '.download'))
+
+    def test_download_ranges(self):
+        self._downloader().download()
+
+        self.assertEqual(self._read_dst(), PAYLOAD)
+        self.assertEqual(self.server.ranges_requested, ['bytes=0-1048575'])
+        self.assert_no_leftovers()
+
+    def test_resume(self):
+        self.server.truncate_after = len(PAYLOAD) // 2
+
+        with self.assertRaises(download.DownloadException):
+            self._downloader().download()
+
+        self.assertFalse(os.path.exists(self.dst))
+        with open(self.dst + '.download') as state_fd:
+            offset = json.load(state_fd)['segments'][0][2]
+        self.assertGreater(offset, 0)
+
+        self._downloader().download()
+
+        self.assertEqual(self._read_dst(), PAYLOAD)
+        self.assertEqual(
+            self.server.ranges_requested[-1],
+            'bytes={}-{}'.format(offset, len(PAYLOAD) - 1),
+        )
+        self.assert_no_leftovers()
+
+    def test_digest(self):
+        self._downloader().download(
+            checksum='sha256',
+            expected_digest=hashlib.sha256(PAYLOAD).hexdigest(),
+        )
+
+        self.assertEqual(self._read_dst(), PAYLOAD)
+
+    def test_digest_mismatch(self):
+        with self.assertRaises(download.DownloadException):
+            self._downloader().download(
+                checksum='sha1', expected_digest='0' * 40
+            )
+
+        self.assertFalse(os.path.exists(self.dst))
+        self.assert_no_leftovers()
+
+    def test_download_stream(self):
+        self.server.ranges = False
+
+        self._downloader().download()
+
+        self.assertEqual(self._read_dst(), PAYLOAD)
+        self.assertEqual(self.server.ranges_requested, [None])
+        self.assert_no_leftovers()
+
+    def test_download_stream_short_read(self):
+        self.server.ranges = False
+        self.server.truncate_after = len(PAYLOAD) // 2
+
+        with self.assertRaises(download.DownloadException):
+            self._downloader().download()
+
+        self.assertFalse(os.path.exists(self.dst))
+        self.assert_no_leftovers()
+
+    def test_head(self):
+        self.assertEqual(self._downloader().head(16), PAYLOAD[:16])
+        self.assertEqual(self.server.ranges_requested, ['bytes=0-15'])
+
+    def test_stream_resume(self):
+        self.server.truncate_after = len(PAYLOAD) // 2
+
+        data = b''.join(self._downloader().stream())
+
+        self.assertEqual(data, PAYLOAD)
+        self.assertEqual(
+            self.server.ranges_requested,
+            [None, 'bytes={}-'.format(len(PAYLOAD) // 2)],
+        )
+        self.assertFalse(os.path.exists(self.dst))
+        self.assert_no_leftovers()
+
+    def test_stream_short_read(self):
+        self.server.ranges = False
+        self.server.truncate_after = len(PAYLOAD) // 2
+
+        with self.assertRaises(download.DownloadException):
+            b''.join(self._downloader().stream())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import fastcopy  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+def _make_sparse(file_path):
+    """
+    Returns:
+        bytes: content of the file, 8 MiB with two data segments
+    """
+    data = os.urandom(MIB)
+    with open(file_path, 'wb') as file_fd:
+        file_fd.truncate(8 * MIB)
+        file_fd.seek(2 * MIB)
+        file_fd.write(data)
+        file_fd.seek(5 * MIB + 100)
+        file_fd.write(data[:1000])
+
+    with open(file_path, 'rb') as file_fd:
+        return file_fd.read()
+
+
+class CopyFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src')
+        self.dst = os.path.join(self.tmp_dir, 'dst')
+        self.content = _make_sparse(self.src)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _read_dst(self):
+        with open(self.dst, 'rb') as dst_fd:
+            return dst_fd.read()
+
+    def _allocated(self, file_path):
+        return os.stat(file_path).st_blocks * 512
+
+    def test_data_segments(self):
+        fd = os.open(self.src, os.O_RDONLY)
+        try:
+            segments = list(fastcopy.data_segments(fd, 8 * MIB))
+        finally:
+            os.close(fd)
+
+        data = b''.join(
+            self.content[offset:offset + length]
+            for offset, length in segments
+        )
+        self.assertIn(self.content[2 * MIB:3 * MIB], data)
+        if self._allocated(self.src) < 8 * MIB:
+            # The holes are skipped where the filesystem keeps them
+            self.assertLess(len(data), 8 * MIB)
+
+    def _test_strategy(self, strategy):
+        src_fd = os.open(self.src, os.O_RDONLY)
+        dst_fd = os.open(self.dst, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fastcopy._copy_segments(src_fd, dst_fd, 8 * MIB, strategy)
+        finally:
+            os.close(dst_fd)
+            os.close(src_fd)
+
+        self.assertEqual(self._read_dst(), self.content)
+        self.assertLessEqual(
+            self._allocated(self.dst), self._allocated(self.src)
+        )
+
+    @unittest.skipUnless(
+        fastcopy.COPY_FILE_RANGE in fastcopy._SEGMENT_COPIERS,
+        'copy_file_range not available',
+    )
+    def test_copy_file_range(self):
+        self._test_strategy(fastcopy.COPY_FILE_RANGE)
+
+    @unittest.skipUnless(
+        fastcopy.SENDFILE in fastcopy._SEGMENT_COPIERS,
+        'sendfile not available',
+    )
+    def test_sendfile(self):
+        self._test_strategy(fastcopy.SENDFILE)
+
+    def test_buffered(self):
+        self._test_strategy(fastcopy.BUFFERED)
+
+    def test_copy_file(self):
+        with open(self.dst, 'w') as dst_fd:
+            dst_fd.write('old content')
+        os.link(self.dst, self.dst + '.link')
+
+        strategy = fastcopy.copy_file(self.src, self.dst)
+
+        self.assertIn(
+            strategy, [fastcopy.REFLINK] + fastcopy._SEGMENT_COPIERS
+        )
+        self.assertEqual(self._read_dst(), self.content)
+        # Replaced, not rewritten in place
+        with open(self.dst + '.link') as link_fd:
+            self.assertEqual(link_fd.read(), 'old content')
+
+
+if __name__ == '__main__':
+    unittest.main()
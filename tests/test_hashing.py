@@ -0,0 +1,99 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import hashing  # noqa: E402
+
+MIB = 1024 * 1024
+
+
+class HashingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'image')
+        data = os.urandom(MIB + 123)
+        with open(self.path, 'wb') as image_fd:
+            image_fd.truncate(6 * MIB + 7)
+            image_fd.seek(MIB)
+            image_fd.write(data)
+            image_fd.seek(4 * MIB)
+            image_fd.write(data[:4096])
+        with open(self.path, 'rb') as image_fd:
+            self.content = image_fd.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _chunks(self, **kwargs):
+        chunks = []
+        with open(self.path, 'rb', buffering=0) as image_fd:
+            for data, release in hashing.iter_chunks(image_fd, **kwargs):
+                chunks.append(data.tobytes())
+                release()
+        return chunks
+
+    def test_iter_chunks(self):
+        for sparse in (True, False):
+            chunks = self._chunks(buffer_size=MIB // 2, sparse=sparse)
+
+            self.assertEqual(b''.join(chunks), self.content)
+            self.assertTrue(all(len(chunk) <= MIB // 2 for chunk in chunks))
+
+    def test_iter_chunks_holds_buffers(self):
+        with open(self.path, 'rb', buffering=0) as image_fd:
+            chunks = hashing.iter_chunks(
+                image_fd, buffer_size=MIB, buffer_count=2, sparse=False
+            )
+            first, release_first = next(chunks)
+            first = first.tobytes()
+            next(chunks)
+            release_first()
+            # Reuses the released buffer
+            third, _ = next(chunks)
+
+        self.assertEqual(first, self.content[:MIB])
+        self.assertEqual(third.tobytes(), self.content[2 * MIB:3 * MIB])
+
+    def test_multi_hasher(self):
+        for threaded in (True, False):
+            with hashing.MultiHasher(
+                ['sha1', 'sha512'], threaded=threaded
+            ) as hasher:
+                for offset in range(0, len(self.content), MIB):
+                    hasher.update(self.content[offset:offset + MIB])
+            result = hasher.result()
+
+            self.assertEqual(result.size, len(self.content))
+            self.assertEqual(
+                result['sha1'], hashlib.sha1(self.content).hexdigest()
+            )
+            self.assertEqual(
+                result['sha512'], hashlib.sha512(self.content).hexdigest()
+            )
+
+    def test_multi_hasher_no_checksums(self):
+        with self.assertRaises(ValueError):
+            hashing.MultiHasher([])
+
+    def test_hash_file(self):
+        result = hashing.hash_file(
+            self.path, ['sha256', 'md5'], buffer_size=MIB
+        )
+
+        self.assertEqual(result.size, len(self.content))
+        self.assertEqual(
+            result['sha256'], hashlib.sha256(self.content).hexdigest()
+        )
+        self.assertEqual(result['md5'], hashlib.md5(self.content).hexdigest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import hashing  # noqa: E402
+import images  # noqa: E402
+import journal  # noqa: E402
+
+
+class _Image(object):
+    """
+    The parts of :class:`images.Image` the journal uses
+    """
+
+    def __init__(self, built_image_path, intermediates=()):
+        self.built_image_path = built_image_path
+        self.intermediates = list(intermediates)
+        self.compress_hashes = None
+        self.restored = None
+
+    def journal_state(self):
+        return {
+            'built_image_path': self.built_image_path,
+            'intermediates': self.intermediates,
+        }
+
+    def restore_journal_state(self, state, compress_hashes=None):
+        self.restored = state
+        self.compress_hashes = compress_hashes
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image_path = os.path.join(self.tmp_dir, 'el7.qcow2')
+        with open(self.image_path, 'w') as image_fd:
+            image_fd.write('built image')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _record_built(self, image):
+        build_journal = journal.Journal(self.tmp_dir)
+        build_journal.start('el7.spec', 'digest', 'el7-1', '1')
+        build_journal.record('el7.spec', image, images.STAGE_BUILT)
+        return build_journal
+
+    def test_resume_built(self):
+        self._record_built(_Image(self.image_path))
+
+        build_journal = journal.Journal(self.tmp_dir)
+        entry = build_journal.get('el7.spec', 'digest')
+        image = _Image(None)
+
+        self.assertEqual(entry['version'], '1')
+        self.assertEqual(
+            build_journal.resume(image, entry), images.STAGE_BUILT
+        )
+        self.assertEqual(image.restored['built_image_path'], self.image_path)
+
+    def test_resume_compressed(self):
+        image = _Image(self.image_path)
+        build_journal = self._record_built(image)
+        image.compress_hashes = (
+            hashing.HashResult({'sha1': 'a', 'sha512': 'b'}, 10, 0),
+            hashing.hash_file(self.image_path, ['sha1']),
+        )
+        build_journal.record('el7.spec', image, images.STAGE_COMPRESSED)
+
+        build_journal = journal.Journal(self.tmp_dir)
+        resumed = _Image(None)
+        stage = build_journal.resume(
+            resumed, build_journal.get('el7.spec', 'digest')
+        )
+
+        self.assertEqual(stage, images.STAGE_COMPRESSED)
+        hashes, compressed_hashes = resumed.compress_hashes
+        self.assertEqual(hashes['sha512'], 'b')
+        self.assertEqual(compressed_hashes.size, len('built image'))
+
+    def test_changed_artifact(self):
+        self._record_built(_Image(self.image_path))
+        with open(self.image_path, 'w') as image_fd:
+            image_fd.write('other image')
+        os.utime(self.image_path, (0, 0))
+
+        build_journal = journal.Journal(self.tmp_dir)
+        image = _Image(None)
+        stage = build_journal.resume(
+            image, build_journal.get('el7.spec', 'digest')
+        )
+
+        self.assertIsNone(stage)
+        self.assertIsNone(image.restored)
+
+    def test_changed_spec(self):
+        intermediate = os.path.join(self.tmp_dir, 'workspace')
+        os.mkdir(intermediate)
+        self._record_built(_Image(self.image_path, [intermediate]))
+
+        build_journal = journal.Journal(self.tmp_dir)
+
+        self.assertIsNone(build_journal.get('el7.spec', 'other digest'))
+        self.assertFalse(os.path.exists(intermediate))
+        self.assertIsNone(
+            journal.Journal(self.tmp_dir).get('el7.spec', 'digest')
+        )
+
+    def test_remove(self):
+        build_journal = self._record_built(_Image(self.image_path))
+
+        build_journal.remove()
+
+        self.assertFalse(os.path.exists(build_journal.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
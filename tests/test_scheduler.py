@@ -0,0 +1,100 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import scheduler  # noqa: E402
+
+
+class BuildSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.order = []
+        self.lock = threading.Lock()
+
+    def _action(self, name, fail=False):
+        def _run(*parent_results):
+            with self.lock:
+                self.order.append(name)
+            if fail:
+                raise RuntimeError('{} failed'.format(name))
+            return (name, ) + parent_results
+
+        return _run
+
+    def _node(self, name, parents=None, fail=False):
+        return scheduler.BuildNode(
+            name, self._action(name, fail), parents=parents, memory=0, disk=0
+        )
+
+    def _scheduler(self, nodes, jobs=4):
+        return scheduler.BuildScheduler(
+            nodes, scheduler.ResourceBudget(jobs=jobs, memory=0, disk=0)
+        )
+
+    def test_parents_first(self):
+        build_scheduler = self._scheduler([
+            self._node('app', parents=['base']),
+            self._node('base', parents=['os']),
+            self._node('os'),
+        ])
+
+        build_scheduler.run()
+
+        self.assertEqual(self.order, ['os', 'base', 'app'])
+        self.assertEqual(
+            build_scheduler.nodes['app'].result,
+            ('app', ('base', ('os', ))),
+        )
+
+    def test_failed_parent_skips_children(self):
+        build_scheduler = self._scheduler([
+            self._node('os', fail=True),
+            self._node('base', parents=['os']),
+            self._node('other'),
+        ])
+
+        with self.assertRaises(scheduler.BuildSchedulerException):
+            build_scheduler.run()
+
+        self.assertEqual(sorted(self.order), ['os', 'other'])
+        self.assertEqual(
+            build_scheduler.nodes['base'].status, scheduler.BuildNode.SKIPPED
+        )
+        self.assertEqual(
+            build_scheduler.nodes['other'].status, scheduler.BuildNode.DONE
+        )
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(scheduler.BuildSchedulerException):
+            self._scheduler([self._node('base', parents=['os'])])
+
+    def test_cycle(self):
+        with self.assertRaises(scheduler.BuildSchedulerException):
+            self._scheduler([
+                self._node('a', parents=['b']),
+                self._node('b', parents=['a']),
+            ])
+
+    def test_budget(self):
+        budget = scheduler.ResourceBudget(jobs=2, memory=1024, disk=10)
+        small = scheduler.BuildNode('small', None, memory=512, disk=5)
+        big = scheduler.BuildNode('big', None, memory=2048, disk=20)
+
+        # A single build always fits
+        self.assertTrue(budget.fits(big))
+        budget.acquire(small)
+        self.assertTrue(budget.fits(small))
+        self.assertFalse(budget.fits(big))
+        budget.acquire(small)
+        self.assertFalse(budget.fits(small))
+        budget.release(small)
+        self.assertTrue(budget.fits(small))
+
+
+if __name__ == '__main__':
+    unittest.main()
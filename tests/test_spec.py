@@ -0,0 +1,118 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'lago_images')
+)
+
+import spec as spec_module  # noqa: E402
+
+SPEC = '''#name=el7
+#distro = el7
+#base=centos-7
+
+# not a prop
+run-command true
+#version=ignored
+'''
+
+
+class SpecTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spec_file = os.path.join(self.tmp_dir, 'el7.spec')
+        with open(self.spec_file, 'w') as spec_fd:
+            spec_fd.write(SPEC)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_props(self):
+        self.assertEqual(
+            spec_module.parse_props(SPEC.splitlines()),
+            {'name': 'el7', 'distro': 'el7', 'base': 'centos-7'},
+        )
+
+    def test_from_spec_file(self):
+        spec = spec_module.Spec.from_spec_file(self.spec_file)
+
+        self.assertEqual(spec.id, 'el7.spec')
+        self.assertEqual(spec.name, 'el7')
+        self.assertEqual(spec.distro, 'el7')
+        with self.assertRaises(AttributeError):
+            spec.version
+
+    def test_missing_props(self):
+        with open(self.spec_file, 'w') as spec_fd:
+            spec_fd.write('#distro=el7\n')
+
+        with self.assertRaises(Exception):
+            spec_module.Spec.from_spec_file(self.spec_file)
+
+    def test_is_spec_file(self):
+        self.assertTrue(spec_module.is_spec_file('el7.spec'))
+        self.assertTrue(spec_module.is_spec_file('el7.spec', '*.spec'))
+        self.assertFalse(spec_module.is_spec_file('el7', '*.spec'))
+        for name in ('.el7.spec.swp', 'el7.spec~', 'el7.spec.orig'):
+            self.assertFalse(spec_module.is_spec_file(name))
+
+
+class SpecIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'index.json')
+        self.spec_file = os.path.join(self.tmp_dir, 'el7.spec')
+        with open(self.spec_file, 'w') as spec_fd:
+            spec_fd.write(SPEC)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parsed_once(self):
+        index = spec_module.SpecIndex(self.index_path)
+        props = index.get_props(self.spec_file)
+        index.save()
+
+        index = spec_module.SpecIndex(self.index_path)
+        self.assertEqual(index.get_props(self.spec_file), props)
+        self.assertEqual(index.parsed, 0)
+
+    def test_touched_spec(self):
+        index = spec_module.SpecIndex(self.index_path)
+        index.get_props(self.spec_file)
+        os.utime(self.spec_file, (0, 0))
+
+        # Same content, it's only hashed again
+        index.get_props(self.spec_file)
+        self.assertEqual(index.parsed, 1)
+
+    def test_changed_spec(self):
+        index = spec_module.SpecIndex(self.index_path)
+        index.get_props(self.spec_file)
+        with open(self.spec_file, 'w') as spec_fd:
+            spec_fd.write('#name=el8\n')
+
+        self.assertEqual(index.get_props(self.spec_file), {'name': 'el8'})
+        self.assertEqual(index.parsed, 2)
+
+    def test_props_copied(self):
+        index = spec_module.SpecIndex(self.index_path)
+        index.get_props(self.spec_file)['name'] = 'changed'
+
+        self.assertEqual(index.get_props(self.spec_file)['name'], 'el7')
+
+    def test_removed_specs_dropped(self):
+        index = spec_module.SpecIndex(self.index_path)
+        index.get_props(self.spec_file)
+        os.unlink(self.spec_file)
+        index.save()
+
+        self.assertEqual(spec_module.SpecIndex(self.index_path).entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()